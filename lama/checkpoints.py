@@ -0,0 +1,156 @@
+"""
+Completion manifests that let a rerun of the registration pipeline skip work that has already been done.
+
+When a unit of work (a registration stage, a specimen within a stage, or a later step such as the deformations) is
+finished, a manifest is written recording what it was made from: hashes of the input files and of the parameters
+used. On a rerun the work is skipped if its manifest exists and the inputs and parameters are unchanged.
+
+File hashes are of the file contents, so copying an unchanged input (as lama_job_runner does on each run) does not
+cause the work to be redone. They are cached by path, size and modification time so each file is only read once.
+"""
+
+from pathlib import Path
+from typing import Union, Iterable, Dict
+from datetime import datetime
+import hashlib
+import json
+import os
+import tempfile
+
+from logzero import logger as logging
+
+MANIFEST_NAME = 'lama_completed.json'
+CHECKPOINT_DIR = 'checkpoints'
+HASH_CACHE_NAME = 'file_hashes.json'
+
+
+class Checkpoints:
+    def __init__(self, checkpoint_dir: Path, enabled: bool = True):
+        """
+        Parameters
+        ----------
+        checkpoint_dir
+            Where the manifests for the pipeline steps and the file hash cache are kept
+        enabled
+            If False, nothing is ever reported as done (manifests are still written). A disabled Checkpoints is also
+            falsy, so callers can skip building the parts of work that would never be skipped
+        """
+        self.dir = Path(checkpoint_dir)
+        self.dir.mkdir(parents=True, exist_ok=True)
+        self.enabled = enabled
+
+        # Keys of the work done so far in this run. Later steps include these in their own keys
+        self.keys: Dict[str, str] = {}
+
+        self._hash_cache_file = self.dir / HASH_CACHE_NAME
+        try:
+            with open(self._hash_cache_file, 'r') as fh:
+                self._hash_cache = json.load(fh)
+        except (OSError, ValueError):
+            self._hash_cache = {}
+
+    def __bool__(self):
+        return self.enabled
+
+    def file_hash(self, path: Union[Path, str, None]) -> Union[str, None]:
+        """
+        sha1 of the contents of a file. None if no path is given (eg. an optional config entry that is not set)
+        """
+        if not path:
+            return None
+
+        path = Path(path).resolve()
+        stat = path.stat()
+        cache_key = f'{path}|{stat.st_size}|{stat.st_mtime_ns}'
+
+        digest = self._hash_cache.get(cache_key)
+        if digest:
+            return digest
+
+        sha = hashlib.sha1()
+        with open(path, 'rb') as fh:
+            for block in iter(lambda: fh.read(2 ** 23), b''):
+                sha.update(block)
+        digest = sha.hexdigest()
+
+        self._hash_cache[cache_key] = digest
+        _write_json(self._hash_cache_file, self._hash_cache)
+
+        return digest
+
+    @staticmethod
+    def key(parts: dict) -> str:
+        """
+        A hash of the inputs and parameters of a unit of work
+        """
+        return hashlib.sha1(json.dumps(parts, sort_keys=True, default=str).encode()).hexdigest()
+
+    def _manifest(self, location: Union[Path, str]) -> Path:
+        """
+        A folder gets a manifest inside it. A name is a pipeline step with a manifest in the checkpoint folder
+        """
+        if isinstance(location, Path):
+            return location / MANIFEST_NAME
+        return self.dir / f'{location}.json'
+
+    def is_done(self, location: Union[Path, str], parts: dict, outputs: Iterable[Path] = ()) -> bool:
+        """
+        Parameters
+        ----------
+        location
+            A folder, or the name of a pipeline step
+        parts
+            The input hashes and parameters of the work
+        outputs
+            Paths that must still exist for the work to count as done
+
+        Returns
+        -------
+        True if the work was completed with the same inputs and parameters
+        """
+        if not self.enabled:
+            return False
+
+        try:
+            with open(self._manifest(location), 'r') as fh:
+                manifest = json.load(fh)
+        except (OSError, ValueError):
+            return False
+
+        if manifest.get('key') != self.key(parts):
+            return False
+
+        for output in outputs:
+            if not Path(output).exists():
+                return False
+
+        return True
+
+    def mark_done(self, location: Union[Path, str], parts: dict):
+        _write_json(self._manifest(location), {'key': self.key(parts),
+                                               'completed': datetime.now().strftime('%Y-%m-%d %H:%M:%S'),
+                                               'inputs': parts})
+
+    def step(self, name: str, parts: dict, outputs: Iterable[Path] = ()) -> bool:
+        """
+        Check whether a pipeline step is done, and record its key for the steps that depend on it.
+
+        Returns
+        -------
+        True if the step can be skipped
+        """
+        self.keys[name] = self.key(parts)
+        done = self.is_done(name, parts, outputs)
+        if done:
+            logging.info(f'Skipping {name}. Already completed with the same inputs and parameters')
+        return done
+
+
+def _write_json(path: Path, obj):
+    """
+    Write to a temporary file and rename so a crash never leaves a partial manifest
+    """
+    fd, tmp = tempfile.mkstemp(dir=Path(path).parent, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        json.dump(obj, fh, indent=1, default=str)
+    os.replace(tmp, path)
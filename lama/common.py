@@ -3,7 +3,8 @@ import shutil
 from pathlib import Path
 from traceback import format_exception
 from os.path import abspath, join, basename, splitext
-from collections import defaultdict, namedtuple
+from collections import defaultdict, namedtuple, deque
+from concurrent.futures import ThreadPoolExecutor
 import sys
 import os
 from datetime import datetime
@@ -16,6 +17,7 @@ import csv
 import datetime
 import signal
 import decimal
+import threading
 
 from logzero import logger as logging
 import logzero
@@ -580,38 +582,93 @@ def get_inputs_from_file_list(file_list_path, config_dir):
     return filtered_paths
 
 
-def average(img_paths: List[Path]) -> sitk.Image:
+class ImageAverager:
+    """
+    Accumulates the mean of a series of images in float64, so integer images do not overflow.
+
+    Images can be added as they become available (eg. as each registration finishes) so the average is ready as soon
+    as the last one has been added. add() can be called from multiple threads.
+    """
+    def __init__(self):
+        self.count = 0
+        self._summed = None
+        self._dtype = None
+        self._direction = None
+        self._lock = threading.Lock()
+
+    def add(self, img: Union[str, Path, sitk.Image]):
+        """
+        Add an image to the average. Images not the same shape as the first one are skipped with a warning
+        """
+        if not isinstance(img, sitk.Image):
+            img = sitk.ReadImage(str(img))
+
+        array = sitk.GetArrayFromImage(img)
+
+        with self._lock:
+            if self._summed is None:
+                self._summed = np.zeros(array.shape, dtype=np.float64)
+                self._dtype = array.dtype
+                # Get the direction from the first image.
+                self._direction = img.GetDirection()
+
+            if array.shape != self._summed.shape:
+                logging.warning(f"Numpy can't average this volume. Shape {array.shape} != {self._summed.shape}")
+                return
+
+            self._summed += array
+            self.count += 1
+
+    def result(self) -> sitk.Image:
+        """
+        The mean image in the data type of the first image. Integer means are rounded down
+        """
+        if self.count == 0:
+            raise ValueError('No images have been added to the average')
+
+        with self._lock:
+            mean = self._summed / self.count
+
+        if np.issubdtype(self._dtype, np.integer):
+            np.floor(mean, out=mean)
+
+        avg_img = sitk.GetImageFromArray(mean.astype(self._dtype))
+        avg_img.SetDirection(self._direction)
+
+        return avg_img
+
+
+def average(img_paths: List[Path], prefetch: int = 2) -> sitk.Image:
     """
     Make a mean itensity volume given a list of volume paths
 
+    Parameters
+    ----------
+    img_paths
+        The images to average
+    prefetch
+        Number of images to read ahead in background threads while adding the current one
+
     Returns
     -------
     Mean volume
 
     """
     img_paths = list(map(str, img_paths))
+    averager = ImageAverager()
 
-    # sum all images together
-    first = LoadImage(img_paths[0])
+    with ThreadPoolExecutor(max_workers=max(1, prefetch)) as pool:
+        reads = deque()
 
-    # Get the direction from the first image.
-    direction_cos = first.direction
-
-    summed = sitk.GetArrayFromImage(sitk.ReadImage(img_paths[0]))
-
-    for image in img_paths[1:]:  # Ommit the first as that is in 'summed'
-        np_array = sitk.GetArrayFromImage(sitk.ReadImage(image))
-        try:
-            summed += np_array
-        except ValueError as e:
-            print(("Numpy can't average this volume {0}".format(image)))
+        for path in img_paths:
+            reads.append(pool.submit(sitk.ReadImage, path))
+            if len(reads) > prefetch:
+                averager.add(reads.popleft().result())
 
-    # Now make average
-    summed //= len(img_paths)
-    avg_img = sitk.GetImageFromArray(summed)
-    avg_img.SetDirection(direction_cos)
+        while reads:
+            averager.add(reads.popleft().result())
 
-    return avg_img
+    return averager.result()
 
 #
 # def rebuid_subsamlped_output(array, shape, chunk_size):
@@ -11,18 +11,23 @@ import os
 import sys
 import subprocess
 from pathlib import Path
-from typing import Union, Dict, List
+from typing import Union, Dict, List, Tuple, Callable
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from functools import partial
 import shutil
 import SimpleITK as sitk
 import numpy as np
 from lama.registration_pipeline.validate_config import LamaConfig
+from lama.elastix.spatial_jacobian import ElastixTransform, UnsupportedTransformError, spatial_jacobian, write_image
+from lama.elastix.folding import parse_elastix_params
 
 ELX_TFORM_NAME = 'TransformParameters.0.txt'
 ELX_TFORM_NAME_RESOLUTION = 'TransformParameters.0.R{}.txt'  # resoltion number goes in '{}'
 TRANSFORMIX_LOG = 'transformix.log'
+DEFORMATION_BYTES_PER_VOXEL = 16  # Approximate memory used per voxel for the jacobians of one specimen
 
 
-def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Union[None, np.array]:
+def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Union[None, List[Tuple[str, str, np.ndarray]]]:
     """
     Generate jacobian determinants and optionaly defromation vectors
 
@@ -49,9 +54,12 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
 
     affine_192_to_10 = [ "affine", "deformable_192_to_10"]
 
+    The (specimen, deformation scale) pairs are processed in parallel. See plan_deformations for the number run at once,
+    which can be set with the config 'parallel_deformations' option.
+
     Returns
     -------
-    jacobian array if there are any negative values
+    (specimen_id, deformation_id, jacobian array) for each specimen with negative jacobians. See qc.folding.folding_report
     """
 
     if isinstance(config, (str, Path)):
@@ -67,6 +75,9 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
     write_vectors = config['write_deformation_vectors']
     write_raw_jacobians = config ['write_raw_jacobians']
     write_log_jacobians = config['write_log_jacobians']
+    jacmat_dir = config.mkdir('jacmat') if config['write_jacobian_matrices'] else None
+
+    jobs = []  # (deformation_id, specimen_id, function to run)
 
     for deformation_id, stage_info in config['generate_deformation_fields'].items():
         reg_stage_dirs: List[Path] = []
@@ -100,13 +111,125 @@ def make_deformations_at_different_scales(config: Union[LamaConfig, dict]) -> Un
         log_jacobians_scale_dir = log_jacobians_dir / deformation_id
         log_jacobians_scale_dir.mkdir()
 
-        neg_jac_arr = _generate_deformation_fields(reg_stage_dirs, resolutions, deformation_scale_dir, jacobians_scale_dir,
-                                                   log_jacobians_scale_dir, write_vectors, write_raw_jacobians, write_log_jacobians,
-                                                   threads=config['threads'], filetype=config['filetype'])
-        return neg_jac_arr
+        specimen_ids = sorted(x.name for x in reg_stage_dirs[0].iterdir() if x.is_dir())
+
+        for specimen_id in specimen_ids:
+            if not jobs:
+                first_tform = reg_stage_dirs[-1] / specimen_id / ELX_TFORM_NAME
+            job = partial(_generate_deformation_fields, specimen_id, reg_stage_dirs, resolutions, deformation_scale_dir,
+                          jacobians_scale_dir, log_jacobians_scale_dir, write_vectors, write_raw_jacobians,
+                          write_log_jacobians, filetype=config['filetype'],
+                          jacmat=jacmat_dir / deformation_id if jacmat_dir else False,
+                          method=config['jacobian_method'])
+            jobs.append((deformation_id, specimen_id, job))
+
+    if not jobs:
+        return []
+
+    # Estimate the memory needed by each job from the output grid of one of the transforms
+    bytes_per_voxel = (DEFORMATION_BYTES_PER_VOXEL + (24 if write_vectors else 0)
+                       + (72 if config['write_jacobian_matrices'] else 0))
+    n_workers, threads_per_job = plan_deformations(len(jobs), config['threads'], config['parallel_deformations'],
+                                                   _output_voxels(first_tform) * bytes_per_voxel)
+
+    return generate_deformations(jobs, n_workers, threads_per_job)
+
+
+def plan_deformations(n_jobs: int, threads: int, parallel: int = 0, mem_per_job: float = 0) -> Tuple[int, int]:
+    """
+    Decide how many specimens to process at once and how many threads each gets (used by transformix)
+
+    Parameters
+    ----------
+    n_jobs
+        Number of (specimen, deformation scale) pairs
+    threads
+        The total number of threads to use. If None, the number of cpus
+    parallel
+        Number of jobs to run at once. If 0, chosen from the threads, the cpus and the available memory
+    mem_per_job
+        Estimated memory use of each job in bytes. 0 if unknown
+
+    Returns
+    -------
+    number of jobs to run at once, threads per job
+    """
+    cpus = os.cpu_count() or 1
+    if not threads:
+        threads = cpus
+
+    if parallel < 1:
+        parallel = min(threads, cpus)
+        if mem_per_job:
+            parallel = min(parallel, max(1, int(common.available_memory() // mem_per_job)))
+
+    parallel = max(1, min(parallel, n_jobs))
+    threads_per_job = max(1, threads // parallel)
 
+    logging.info(f'Generating deformations for {parallel} specimens at once')
+    return parallel, threads_per_job
+
+
+def generate_deformations(jobs: List[Tuple[str, str, Callable]],
+                          n_workers: int,
+                          threads_per_job: int) -> List[Tuple[str, str, np.ndarray]]:
+    """
+    Run the deformation jobs, n_workers at a time. Threads are used as the work is done either by transformix
+    subprocesses or numpy, which both release the GIL.
+
+    Parameters
+    ----------
+    jobs
+        (deformation_id, specimen_id, func). func(threads=n) generates the deformations of one specimen at one scale
+        and returns the jacobian array if it has folding
+    n_workers
+        Number of jobs to run at once
+    threads_per_job
+        passed to each job
 
-def _generate_deformation_fields(registration_dirs: List,
+    Returns
+    -------
+    (specimen_id, deformation_id, jacobian array) for each specimen with negative jacobians, in the order of the jobs
+    """
+    logging.info('### Generating deformation files ###')
+
+    results = {}
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = {pool.submit(func, threads=threads_per_job): (deformation_id, specimen_id)
+                   for deformation_id, specimen_id, func in jobs}
+        try:
+            for future in as_completed(futures):
+                results[futures[future]] = future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()  # Only stops those not started. Running ones are waited for
+            raise
+
+    neg_jacs = []
+    for deformation_id, specimen_id, _ in jobs:
+        jac_arr = results[(deformation_id, specimen_id)]
+        if jac_arr is not None:
+            neg_jacs.append((specimen_id, deformation_id, jac_arr))
+    return neg_jacs
+
+
+def _output_voxels(tform_file: Path) -> int:
+    """
+    Number of voxels in the output grid of an elastix transform parameter file. 0 if it can't be read
+    """
+    try:
+        with open(tform_file, 'r') as fh:
+            for line in fh:
+                if line.startswith('(Size '):
+                    return int(np.prod(parse_elastix_params([line])['Size']))
+    except OSError:
+        pass
+    return 0
+
+
+def _generate_deformation_fields(specimen_id: str,
+                                 registration_dirs: List,
                                  resolutions: List,
                                  deformation_dir: Path,
                                  jacobian_dir: Path,
@@ -116,64 +239,60 @@ def _generate_deformation_fields(registration_dirs: List,
                                  write_log_jacobians: bool,
                                  threads=None,
                                  filetype='nrrd',
-                                 jacmat=False):
-    """
-    Run transformix on the specified registration stage to generate deformation fields and spatial jacobians
+                                 jacmat: Union[bool, Path] = False,
+                                 method: str = 'native') -> Union[None, np.ndarray]:
     """
-    logging.info('### Generating deformation files ###')
-
-    specimen_list = [x for x in registration_dirs[0].iterdir() if (registration_dirs[0] / x).is_dir()]
-
-    # if len(specimen_list) < 1:
-    #     logging.warn('Can't find any )
-
-    for specimen_path in specimen_list:
-        specimen_id = specimen_path.name
-        temp_transform_files_dir = deformation_dir / specimen_id
-        temp_transform_files_dir.mkdir(exist_ok=True)
+    Generate the deformation field and spatial jacobian of one specimen from the specified registration stages.
+    See _get_deformations for jacmat and method
 
-        transform_params = []
-        # Get the transform parameters for the subsequent registrations
+    Returns
+    -------
+    the jacobian array if there are any values <= 0
+    """
+    # Each specimen gets its own folder for the transform files and any transformix output
+    temp_transform_files_dir = deformation_dir / specimen_id
+    temp_transform_files_dir.mkdir(exist_ok=True)
 
-        if len(resolutions) == 0:  # Use the whole stages by using the joint transform file
+    transform_params = []
+    # Get the transform parameters for the subsequent registrations
 
-            for reg_dir in registration_dirs:
-                single_reg_dir = reg_dir / specimen_id
-                elastix_tform_file = single_reg_dir / ELX_TFORM_NAME  # Transform file in the registration directory
+    if len(resolutions) == 0:  # Use the whole stages by using the joint transform file
 
-                if not os.path.isfile(elastix_tform_file):
-                    raise FileNotFoundError(f"Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
+        for reg_dir in registration_dirs:
+            single_reg_dir = reg_dir / specimen_id
+            elastix_tform_file = single_reg_dir / ELX_TFORM_NAME  # Transform file in the registration directory
 
-                # Create a new path to copy the transform file to. Then it's in the same forlder as the jacobians etc
-                temp_transform_file = temp_transform_files_dir / f'{reg_dir.name}_{specimen_id}_{elastix_tform_file.name}'
+            if not os.path.isfile(elastix_tform_file):
+                raise FileNotFoundError(f"Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
 
-                shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+            # Create a new path to copy the transform file to. Then it's in the same forlder as the jacobians etc
+            temp_transform_file = temp_transform_files_dir / f'{reg_dir.name}_{specimen_id}_{elastix_tform_file.name}'
 
-        else:
-            # The resolutdeformation_dirion paramter files are numbered from 0 but the config counts from 1
-            for i in resolutions:
-                i -= 1
-                single_reg_dir = registration_dirs[0] / specimen_id
-                elastix_tform_file = single_reg_dir / ELX_TFORM_NAME_RESOLUTION.format(i)
+            shutil.copy(elastix_tform_file, temp_transform_file)
+            transform_params.append(temp_transform_file)
+        _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
 
-                if not os.path.isfile(elastix_tform_file):
-                    raise FileNotFoundError(f"### Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
+    else:
+        # The resolution paramter files are numbered from 0 but the config counts from 1
+        for i in resolutions:
+            i -= 1
+            single_reg_dir = registration_dirs[0] / specimen_id
+            elastix_tform_file = single_reg_dir / ELX_TFORM_NAME_RESOLUTION.format(i)
 
-                temp_transform_file = temp_transform_files_dir / (registration_dirs[0].name + '_' + elastix_tform_file.name)
+            if not os.path.isfile(elastix_tform_file):
+                raise FileNotFoundError(f"### Error. Cannot find elastix transform parameter file: {elastix_tform_file}")
 
-                shutil.copy(elastix_tform_file, temp_transform_file)
-                transform_params.append(temp_transform_file)
+            temp_transform_file = temp_transform_files_dir / (registration_dirs[0].name + '_' + elastix_tform_file.name)
 
-            _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
+            shutil.copy(elastix_tform_file, temp_transform_file)
+            transform_params.append(temp_transform_file)
 
-        # Copy the tp files into the temp directory and then modify to add initail transform
+        _chain_tforms(transform_params)  # Add the InitialtransformParamtere line
 
-        # pass in the last tp file [-1] as the other tp files are internally referenced withinn this file
-        neg_jac_array = _get_deformations(transform_params[-1], deformation_dir, jacobian_dir, log_jacobians_dir, filetype, specimen_id,
-                                          threads, jacmat, write_vectors, write_raw_jacobians, write_log_jacobians)
-        return neg_jac_array
+    # pass in the last tp file [-1] as the other tp files are internally referenced withinn this file
+    return _get_deformations(transform_params[-1], deformation_dir, jacobian_dir, log_jacobians_dir, filetype,
+                             specimen_id, threads, jacmat, write_vectors, write_raw_jacobians, write_log_jacobians,
+                             method, work_dir=temp_transform_files_dir)
 
 
 def _chain_tforms(tforms: List):
@@ -209,20 +328,109 @@ def _get_deformations(tform: Path,
                       filetype: str,
                       specimen_id: str,
                       threads: int,
-                      make_jacmat: bool,
+                      make_jacmat: Union[bool, Path],
                       write_vectors: bool = False,
                       write_raw_jacobians: bool = False,
-                      write_log_jacobians: bool = True) -> Union[None, np.array]:
+                      write_log_jacobians: bool = True,
+                      method: str = 'native',
+                      work_dir: Path = None) -> Union[None, np.array]:
     """
     Generate spatial jacobians and optionally deformation files.
 
+    Parameters
+    ----------
+    make_jacmat
+        Folder to write the full jacobian matrices to, or False
+    method
+        'native': compute from the transform parameters in-process (see spatial_jacobian). Falls back to transformix
+            for transforms it does not support
+        'transformix': run transformix and read its output back
+    work_dir
+        Where transformix writes its output before it is moved. Should be different for each job run at once.
+        Defaults to deformation_dir
+
     Returns
     -------
     the jacobian array if there are any values < 0
     """
+    new_jac = jacobian_dir / (specimen_id + '.' + filetype)
+    new_def = deformation_dir / (specimen_id + '.' + filetype)
+
+    tform_chain = None
+    if method == 'native':
+        try:
+            tform_chain = ElastixTransform(tform)
+        except UnsupportedTransformError as e:
+            logging.info(f'{e}. Using transformix for {specimen_id}')
+
+    if tform_chain:
+        result = spatial_jacobian(tform_chain, jacmat=bool(make_jacmat), deformation=write_vectors)
+        jac_arr = result.det
+        log_jac = result.log_det
 
+        if write_vectors:
+            write_image(result.deformation, tform_chain, new_def)
+
+        if make_jacmat:
+            make_jacmat.mkdir(exist_ok=True)
+            write_image(result.jacmat, tform_chain, make_jacmat / (specimen_id + '.' + filetype))
+    else:
+        _run_transformix(tform, work_dir or deformation_dir, new_jac, new_def, filetype, threads, make_jacmat,
+                         write_vectors)
+        jac_img = sitk.ReadImage(str(new_jac))
+        jac_arr = sitk.GetArrayFromImage(jac_img)
+        log_jac = None
+
+    # test if there has been any folding in the jacobians
+    jac_min = jac_arr.min()
+    jac_max = jac_arr.max()
+    logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, jac_min, jac_max))
+
+    # The raw jacobians are kept if there is folding or no log jacobians are written
+    keep_raw = write_raw_jacobians or jac_min <= 0 or not write_log_jacobians
+    if tform_chain and keep_raw:
+        write_image(jac_arr, tform_chain, new_jac)
+
+    if jac_min <= 0:
+        logging.warning(
+            "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
+                specimen_id))
+        # Highlight the regions folding
+        jac_arr[jac_arr > 0] = 0
+        log_jac_path = log_jacobians_dir / ('ERROR_NEGATIVE_JACOBIANS_' + specimen_id + '.' + filetype)
+        common.write_array(jac_arr, log_jac_path)
+
+    elif write_log_jacobians:
+        # Spit out the log transformed jacobians
+        if log_jac is None:
+            log_jac = np.log(jac_arr)
+        log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
+
+        if not keep_raw:
+            new_jac.unlink(missing_ok=True)
+
+        common.write_array(log_jac, log_jac_path)
+
+    logging.info('Finished generating deformation fields')
+
+    if jac_min <=0:
+        return jac_arr
+
+
+def _run_transformix(tform: Path,
+                     work_dir: Path,
+                     new_jac: Path,
+                     new_def: Path,
+                     filetype: str,
+                     threads: int,
+                     make_jacmat: Union[bool, Path],
+                     write_vectors: bool):
+    """
+    Generate the spatial jacobian, and optionally the deformation field and full jacobian matrices, with transformix
+    and move them to their final locations
+    """
     cmd = ['transformix',
-           '-out', str(deformation_dir),
+           '-out', str(work_dir),
            '-tp', str(tform),
            '-jac', 'all'
            ]
@@ -242,64 +450,26 @@ def _get_deformations(tform: Path,
         logging.exception(e)
         # raise subprocess.CalledProcessError(f'### Transformix failed ###\nError message: {e}\nelastix command:{cmd}')
         raise ValueError
-    else:
-        deformation_out = deformation_dir / f'deformationField.{filetype}'
-        jacobian_out = deformation_dir / f'spatialJacobian.{filetype}'
-
-        # rename and move output
-        if write_vectors:
-            new_def = deformation_dir / (specimen_id + '.' + filetype)
-            shutil.move(deformation_out, new_def)
-
-        new_jac = jacobian_dir / (specimen_id + '.' + filetype)
-
-        try:
-            shutil.move(jacobian_out, new_jac)
-        except IOError:
-            #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
-            # deformation fields. So try with itk
-            def_img = sitk.ReadImage(new_def)
-            jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
-            sitk.WriteImage(jac_img, new_jac)
-
-        # if we have full jacobian matrix, rename and remove that
-        if make_jacmat:
-            make_jacmat.mkdir()
-            jacmat_file = deformation_dir / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
-            jacmat_new = make_jacmat / (specimen_id + '.' + filetype)           # New informative name
-            shutil.move(jacmat_file, jacmat_new)
-
-        # test if there has been any folding in the jacobians
-        jac_img = sitk.ReadImage(str(new_jac))
-        jac_arr = sitk.GetArrayFromImage(jac_img)
-        jac_min = jac_arr.min()
-        jac_max = jac_arr.max()
-        logging.info("{} spatial jacobian, min:{}, max:{}".format(specimen_id, jac_min, jac_max))
-
-        if jac_min <= 0:
-            logging.warning(
-                "The jacobian determinant for {} has negative values. You may need to add a penalty term to the later registration stages".format(
-                    specimen_id))
-            # Highlight the regions folding
-            jac_arr[jac_arr > 0] = 0
-            log_jac_path = log_jacobians_dir / ('ERROR_NEGATIVE_JACOBIANS_' + specimen_id + '.' + filetype)
-            common.write_array(jac_arr, log_jac_path)
-
-        elif write_log_jacobians:
-            # Spit out the log transformed jacobians
-            log_jac = np.log(jac_arr)
-            log_jac_path = log_jacobians_dir / ( 'log_jac_' + specimen_id + '.' + filetype)
-
-            if not write_raw_jacobians:
-                new_jac.unlink()
-
-            common.write_array(log_jac, log_jac_path)
-
-
-    logging.info('Finished generating deformation fields')
-
-    if jac_min <=0:
-        return jac_arr
 
+    deformation_out = work_dir / f'deformationField.{filetype}'
+    jacobian_out = work_dir / f'spatialJacobian.{filetype}'
 
+    # rename and move output
+    if write_vectors:
+        shutil.move(deformation_out, new_def)
 
+    try:
+        shutil.move(jacobian_out, new_jac)
+    except IOError:
+        #  Bit of a hack. If trasforms conatain subtransforms from pairwise, elastix is unable to generate
+        # deformation fields. So try with itk
+        def_img = sitk.ReadImage(str(new_def))
+        jac_img = sitk.DisplacementFieldJacobianDeterminant(def_img)
+        sitk.WriteImage(jac_img, str(new_jac))
+
+    # if we have full jacobian matrix, rename and remove that
+    if make_jacmat:
+        make_jacmat.mkdir(exist_ok=True)
+        jacmat_file = work_dir / f'fullSpatialJacobian.{filetype}'  # The name given by elastix
+        jacmat_new = make_jacmat / new_jac.name           # New informative name
+        shutil.move(jacmat_file, jacmat_new)
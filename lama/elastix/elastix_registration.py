@@ -4,16 +4,28 @@ import subprocess
 import os
 import shutil
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
+from typing import List, Callable, Tuple, Iterable
 import yaml
 import SimpleITK as sitk
+import numpy as np
 
 from lama.elastix.folding import unfold_bsplines
+from lama.elastix.pairwise_scheduler import PairwiseScheduler
 from lama import common
 from lama.elastix import ELX_TRANSFORM_NAME, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR
 
 RESOLUTION_TP_PREFIX = 'TransformParameters.0.R'
 FULL_STAGE_TP_FILENAME = 'TransformParameters.0.txt'
+ELX_STDOUT_LOG = 'elastix_stdout.log'
+
+# Elastix multithreading scales poorly beyond a few threads, so when there are more threads available
+# run several registrations at once with about this many threads each
+THREADS_PER_REGISTRATION = 4
+# Rough peak memory use of an elastix process as a multiple of the combined fixed and moving image sizes in float32.
+# Covers the image pyramids, the internal images and the metric gradients
+ELASTIX_MEMORY_FACTOR = 12
 
 
 class ElastixRegistration(object):
@@ -51,6 +63,20 @@ class ElastixRegistration(object):
         self.threads = threads
         self.rename_output = True  # Bodge for pairwise reg, or we end up filling all the disks
 
+        # Number of elastix processes to run at once. 0: decide from the threads, cpus and available memory
+        self.parallel_registrations = 0
+        # If False, carry on with the other specimens if a registration fails
+        self.fail_fast = True
+
+        # Optional common.ImageAverager. If set, each registered image is added to it as soon as it is made, so the
+        # stage average is ready when the last registration finishes
+        self.averager = None
+
+        # Optional lama.checkpoints.Checkpoints and {specimen name: its input hashes and parameters}. Specimens
+        # already registered with the same inputs and parameters are skipped
+        self.checkpoints = None
+        self.specimen_parts = {}
+
 
     def make_average(self, out_path):
         """
@@ -60,7 +86,10 @@ class ElastixRegistration(object):
         vols = common.get_file_paths(self.stagedir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR])
         #logging.info("making average from following volumes\n {}".format('\n'.join(vols)))
 
-        average = common.average(vols)
+        if self.averager is not None and self.averager.count == len(vols):
+            average = self.averager.result()
+        else:
+            average = common.average(vols)
 
         sitk.WriteImage(average, out_path, True)
 
@@ -74,8 +103,14 @@ class TargetBasedRegistration(ElastixRegistration):
     def set_target(self, target):
         self.fixed = target
 
-    def run(self):
+    def run(self) -> List[Path]:
+        """
+        Register the moving images to the target
 
+        Returns
+        -------
+        The moving images whose registration failed. Only non-empty if fail_fast is False
+        """
         if self.movdir.is_file():
             moving_imgs = [self.movdir]
         else:
@@ -84,59 +119,109 @@ class TargetBasedRegistration(ElastixRegistration):
         if len(moving_imgs) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for mov in moving_imgs:
-            mov_basename = mov.stem
-            outdir = self.stagedir / mov_basename
-            outdir.mkdir(parents=True)
+        n_procs, threads = plan_registrations(len(moving_imgs), self.threads, self.parallel_registrations,
+                                              [self.fixed], moving_imgs)
 
-            cmd = {'mov': str(mov),
-                   'fixed': str(self.fixed),
-                   'outdir': str(outdir),
-                   'elxparam_file': str(self.elxparam_file),
-                   'threads': self.threads,
-                   'fixed': str(self.fixed)}
-            if self.fixed_mask is not None:
-                cmd['fixed_mask'] = str(self.fixed_mask)
+        def register(mov):
+            self._register_specimen(mov, threads, log_stdout=n_procs > 1)
 
-            run_elastix(cmd)
+        failed = run_registrations(register, moving_imgs, n_procs, self.fail_fast, self.stagedir)
 
-            # Rename the registered output.
-            if self.rename_output:
-                elx_outfile = outdir / f'result.0.{self.filetype}'
-                new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+        # Remove any partial outputs of failed registrations so they are not used by the next stage or the average
+        for mov in failed:
+            outdir = self.stagedir / mov.stem
+            if outdir.is_dir():
+                for img in common.get_file_paths(outdir):
+                    os.remove(img)
 
-                try:
-                    shutil.move(elx_outfile, new_out_name)
-                except IOError:
-                    logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
-                    raise
-
-                move_intemediate_volumes(outdir)
-
-            # add registration metadata
-            reg_metadata_path = outdir / common.INDV_REG_METADATA
-            fixed_vol_relative = relpath(self.fixed, outdir)
-            reg_metadata = {'fixed_vol': fixed_vol_relative}
+        return failed
 
-            with open(reg_metadata_path, 'w') as fh:
-                fh.write(yaml.dump(reg_metadata, default_flow_style=False))
-
-            if self.fix_folding:
-                # Remove any folds folds in the Bsplines, overwtite inplace
-                tform_param_file = outdir / ELX_TRANSFORM_NAME
-                unfold_bsplines(tform_param_file, tform_param_file)
+    def _register_specimen(self, mov: Path, threads: int, log_stdout: bool = False):
+        """
+        Register a single moving image to the target and post-process the output
 
-                # Retransform the moving image with corrected tform file
-                cmd = [
-                    'transformix',
-                    '-in', str(mov),
-                    '-out', str(outdir),
-                    '-tp', tform_param_file
-                ]
-                subprocess.call(cmd)
-                unfolded_moving_img = outdir / 'result.nrrd'
-                new_out_name.unlink()
-                shutil.move(unfolded_moving_img, new_out_name)
+        Parameters
+        ----------
+        mov
+            The moving image
+        threads
+            Number of threads for this elastix process
+        log_stdout
+            Write the elastix stdout to a log file in the specimen output folder rather than capturing it
+        """
+        mov_basename = mov.stem
+        outdir = self.stagedir / mov_basename
+        new_out_name = outdir / f'{mov_basename}.{self.filetype}'
+
+        parts = self.specimen_parts.get(mov_basename)
+        if self.checkpoints and parts is not None:
+            if self.checkpoints.is_done(outdir, parts, [new_out_name] if self.rename_output else []):
+                logging.info(f'{mov_basename} already registered. Skipping')
+                if self.averager is not None and self.rename_output:
+                    self.averager.add(new_out_name)
+                return
+            if outdir.is_dir():  # Partial output from an interrupted run
+                shutil.rmtree(outdir)
+
+        outdir.mkdir(parents=True)
+
+        cmd = {'mov': str(mov),
+               'fixed': str(self.fixed),
+               'outdir': str(outdir),
+               'elxparam_file': str(self.elxparam_file),
+               'threads': threads,
+               'fixed': str(self.fixed)}
+        if self.fixed_mask is not None:
+            cmd['fixed_mask'] = str(self.fixed_mask)
+        if log_stdout:
+            cmd['log_file'] = str(outdir / ELX_STDOUT_LOG)
+
+        run_elastix(cmd)
+
+        # Rename the registered output.
+        if self.rename_output:
+            elx_outfile = outdir / f'result.0.{self.filetype}'
+
+            try:
+                shutil.move(elx_outfile, new_out_name)
+            except IOError:
+                logging.error('Cannot find elastix output. Ensure the following is not set: (WriteResultImage  "false")')
+                raise
+
+            move_intemediate_volumes(outdir)
+
+        # add registration metadata
+        reg_metadata_path = outdir / common.INDV_REG_METADATA
+        fixed_vol_relative = relpath(self.fixed, outdir)
+        reg_metadata = {'fixed_vol': fixed_vol_relative}
+
+        with open(reg_metadata_path, 'w') as fh:
+            fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        if self.fix_folding:
+            # Remove any folds folds in the Bsplines, overwtite inplace
+            tform_param_file = outdir / ELX_TRANSFORM_NAME
+            unfold_bsplines(tform_param_file, tform_param_file)
+
+            # Retransform the moving image with corrected tform file
+            cmd = [
+                'transformix',
+                '-in', str(mov),
+                '-out', str(outdir),
+                '-tp', tform_param_file
+            ]
+            if threads:
+                cmd.extend(['-threads', str(threads)])
+            subprocess.call(cmd)
+            unfolded_moving_img = outdir / 'result.nrrd'
+            new_out_name.unlink()
+            shutil.move(unfolded_moving_img, new_out_name)
+
+        if self.averager is not None and self.rename_output:
+            self.averager.add(new_out_name)
+
+        if self.checkpoints and parts is not None:
+            self.checkpoints.mark_done(outdir, parts)
 
 
 class PairwiseBasedRegistration(ElastixRegistration):
@@ -145,8 +230,14 @@ class PairwiseBasedRegistration(ElastixRegistration):
         super(PairwiseBasedRegistration, self).__init__(*args)
         self.inputs_and_mean_tp = {}
 
-    def run(self):
+    def run(self) -> List[str]:
+        """
+        Register each pair of inputs and make the mean transform of each input
 
+        Returns
+        -------
+        The names of the pairs whose registration failed. Only non-empty if fail_fast is False
+        """
         # If inputs_vols is a file get the specified root and paths from it
         if isdir(self.movdir):
             movlist = common.get_file_paths(self.movdir)
@@ -156,25 +247,46 @@ class PairwiseBasedRegistration(ElastixRegistration):
         if len(movlist) < 1:
             raise common.LamaDataException("No volumes in {}".format(self.movdir))
 
-        for fixed in movlist:  # Todo: change variable name fixed to moving
+        vols = {splitext(basename(x))[0]: x for x in movlist}
+        n_pairs = len(vols) * (len(vols) - 1)
+
+        n_procs, threads = plan_registrations(n_pairs, self.threads, self.parallel_registrations, movlist, movlist)
+
+        for fixed_basename in vols:
+            common.mkdir_force(join(self.stagedir, fixed_basename))
+
+        def register(moving_basename, fixed_basename):
+            fixed = vols[fixed_basename]
+            outdir = join(self.stagedir, fixed_basename, moving_basename)
+            common.mkdir_force(outdir)
+
+            args = {'mov': vols[moving_basename],
+                    'fixed': fixed,
+                    'outdir': outdir,
+                    'elxparam_file': self.elxparam_file,
+                    'threads': threads,
+                    'fixed': fixed}
+            if n_procs > 1:
+                args['log_file'] = join(outdir, ELX_STDOUT_LOG)
+            run_elastix(args)
+
+            # add registration metadata
+            reg_metadata_path = join(outdir, common.INDV_REG_METADATA)
+            fixed_vol_relative = relpath(fixed, outdir)
+            reg_metadata = {'fixed_vol': fixed_vol_relative}
+            with open(reg_metadata_path, 'w') as fh:
+                fh.write(yaml.dump(reg_metadata, default_flow_style=False))
+
+        def mean_transform(fixed_basename):
+            fixed = vols[fixed_basename]
+            fixed_dir = join(self.stagedir, fixed_basename)
             tp_file_paths = defaultdict(list)
             full_tp_file_paths = []
-            fixed_basename = splitext(basename(fixed))[0]
-            fixed_dir = self.paths.make(join(self.stagedir, fixed_basename), 'f')
 
-            for moving in movlist:
-                if basename(fixed) == basename(moving):
+            for moving_basename in vols:
+                if moving_basename == fixed_basename:
                     continue
-                moving_basename = splitext(basename(moving))[0]
                 outdir = join(fixed_dir, moving_basename)
-                common.mkdir_force(outdir)
-
-                run_elastix({'mov': moving,
-                             'fixed': fixed,
-                             'outdir': outdir,
-                             'elxparam_file': self.elxparam_file,
-                             'threads': self.threads,
-                             'fixed': fixed})
                 # Get the resolution tforms
                 tforms = list(sorted([x for x in os.listdir(outdir) if x .startswith(RESOLUTION_TP_PREFIX)]))
                 # get the full tform that spans all resolutions
@@ -185,18 +297,20 @@ class PairwiseBasedRegistration(ElastixRegistration):
                 for i, tform in enumerate(tforms):
                     tp_file_paths[i].append(join(outdir, tform))
 
-                # add registration metadata
-                reg_metadata_path = join(outdir, common.INDV_REG_METADATA)
-                fixed_vol_relative = relpath(fixed, outdir)
-                reg_metadata = {'fixed_vol': fixed_vol_relative}
-                with open(reg_metadata_path, 'w') as fh:
-                    fh.write(yaml.dump(reg_metadata, default_flow_style=False))
-
             for i, files_ in tp_file_paths.items():
                 mean_tfom_name = "{}{}.txt".format(RESOLUTION_TP_PREFIX, i)
                 self.generate_mean_tranform(files_, fixed, fixed_dir, mean_tfom_name, self.filetype)
             self.generate_mean_tranform(full_tp_file_paths, fixed, fixed_dir, FULL_STAGE_TP_FILENAME, self.filetype)
 
+        scheduler = PairwiseScheduler(list(vols), n_procs, fail_fast=self.fail_fast)
+        failed = scheduler.run(register, mean_transform)
+
+        if failed:
+            with open(join(self.stagedir, 'failed_registrations.txt'), 'w') as fh:
+                fh.write('\n'.join(failed))
+
+        return failed
+
     @staticmethod
     def generate_mean_tranform(tp_files, fixed_vol, out_dir, tp_out_name, filetype):
         """
@@ -264,6 +378,15 @@ def run_elastix(args):
     if args.get('fixed_mask'):
         cmd.extend(['-fMask', args['fixed_mask']])
 
+    if args.get('log_file'):
+        # Stream the output to a file so parallel registrations can be followed individually
+        with open(args['log_file'], 'w') as log_fh:
+            returncode = subprocess.call(cmd, stdout=log_fh, stderr=subprocess.STDOUT)
+        if returncode != 0:
+            logging.error('registration falied:\n\ncommand: {}\n\n see {}'.format(cmd, args['log_file']))
+            raise subprocess.CalledProcessError(returncode, cmd)
+        return
+
     try:
         a = subprocess.check_output(cmd)
     except Exception as e:  # can't seem to log CalledProcessError
@@ -271,6 +394,125 @@ def run_elastix(args):
         raise
 
 
+def image_voxels(path: Path) -> int:
+    """
+    Number of voxels in an image. Only the header is read
+    """
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(str(path))
+    reader.ReadImageInformation()
+    return int(np.prod(reader.GetSize()))
+
+
+def plan_registrations(n_jobs: int,
+                       threads: int,
+                       parallel: int = 0,
+                       fixed_imgs: Iterable[Path] = (),
+                       moving_imgs: Iterable[Path] = ()) -> Tuple[int, int]:
+    """
+    Decide how many elastix processes to run at once and how many threads each should get.
+
+    Parameters
+    ----------
+    n_jobs
+        Number of registrations to do
+    threads
+        The total number of threads to use (the config 'threads' option). If None, the number of cpus
+    parallel
+        Number of processes to run at once. If 0 this is chosen from the threads, the cpus and the memory needed by
+        each registration (estimated from the largest fixed and moving images)
+    fixed_imgs, moving_imgs
+        Used to estimate the memory use of each registration
+
+    Returns
+    -------
+    number of processes, threads per process
+    """
+    cpus = os.cpu_count() or 1
+    if not threads:
+        threads = cpus
+
+    if parallel < 1:
+        parallel = max(1, min(threads, cpus) // THREADS_PER_REGISTRATION)
+
+        try:
+            img_voxels = max(image_voxels(p) for p in fixed_imgs) + max(image_voxels(p) for p in moving_imgs)
+        except (ValueError, RuntimeError):  # No images given or unreadable header
+            pass
+        else:
+            mem_per_job = img_voxels * 4 * ELASTIX_MEMORY_FACTOR
+            parallel = min(parallel, max(1, int(common.available_memory() // mem_per_job)))
+
+    parallel = max(1, min(parallel, n_jobs))
+    threads_per_job = max(1, threads // parallel)
+
+    logging.info(f'Running {parallel} registrations at once with {threads_per_job} threads each')
+    return parallel, threads_per_job
+
+
+def run_registrations(func: Callable, items: List, n_procs: int, fail_fast: bool = True, log_dir: Path = None):
+    """
+    Call func on each item, n_procs at a time. Threads are used as the work is done by the elastix/transformix
+    subprocesses.
+
+    Parameters
+    ----------
+    func
+        Does a registration and its post-processing for an item
+    items
+        Eg. the moving images
+    n_procs
+        Number of items to run at once
+    fail_fast
+        True: stop starting new registrations after the first failure and raise its error.
+        False: log failures and carry on. A list of the failures is written to log_dir/failed_registrations.txt and
+        the failed items are returned
+    log_dir
+        Where to write the failure list
+
+    Returns
+    -------
+    Items that failed
+    """
+    failed = []
+
+    if n_procs == 1:
+        for item in items:
+            try:
+                func(item)
+            except Exception:
+                if fail_fast:
+                    raise
+                logging.exception(f'registration of {item} failed. Continuing with the others')
+                failed.append(item)
+
+    else:
+        with ThreadPoolExecutor(max_workers=n_procs) as pool:
+            futures = {pool.submit(func, item): item for item in items}
+
+            for future in as_completed(futures):
+                item = futures[future]
+                try:
+                    future.result()
+                except Exception:
+                    if fail_fast:
+                        for f in futures:
+                            f.cancel()  # Only stops those not started. Running ones are waited for
+                        raise
+                    logging.exception(f'registration of {item} failed. Continuing with the others')
+                    failed.append(item)
+                else:
+                    logging.info(f'finished registration of {item}')
+
+    if failed:
+        logging.warning(f'{len(failed)} registrations failed: {", ".join(str(x) for x in failed)}')
+        if log_dir:
+            with open(Path(log_dir) / 'failed_registrations.txt', 'w') as fh:
+                fh.write('\n'.join(str(x) for x in failed))
+
+    return failed
+
+
 def move_intemediate_volumes(reg_outdir: Path):
     """
     If using elastix multi-resolution registration and outputting image each resolution, put the intermediate files
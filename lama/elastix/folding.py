@@ -4,6 +4,7 @@ This module corrects overafolding and ensures injectivity of the transform
 """
 import numpy as np 
 from pathlib import Path
+import shlex
 from typing import Union
 
 
@@ -32,6 +33,8 @@ class BSplineParse():
         ----------
         coefs: np.ndarray
             m*n array. m number of control points, n = num axes
+        parameters: dict
+            The other entries of the file. {name: list of values}. Numbers are converted to float
 
         Returns
         -------
@@ -73,6 +76,7 @@ class BSplineParse():
 
             self.coefs = tform_params
             self.elastix_params = other_data
+            self.parameters = parse_elastix_params(other_data)
 
     def control_point_coords(self):
 
@@ -88,6 +92,33 @@ class BSplineParse():
                 grid_spacing = [int(x) for x in line.strip().split(' ')[1:]]
 
 
+def parse_elastix_params(lines) -> dict:
+    """
+    Parse lines such as '(GridSpacing 70.0 70.0 70.0)' or '(Transform "BSplineTransform")'
+
+    Returns
+    -------
+    {name: [values]}. Quotes are removed from strings and numbers converted to float
+    """
+    params = {}
+    for line in lines:
+        line = line.strip()
+        if not line.startswith('('):
+            continue  # Comments and blank lines
+        entries = shlex.split(line.strip('()'), posix=False)  # Keeps quoted paths with spaces together
+        if not entries:
+            continue
+        values = []
+        for v in entries[1:]:
+            v = v.strip('"')
+            try:
+                values.append(float(v))
+            except ValueError:
+                values.append(v)
+        params[entries[0]] = values
+    return params
+
+
 def condition_1(coefs):
     """
     numpy array of tform coefs of shape n_coefs * dims
@@ -2,17 +2,23 @@ from pathlib import Path
 import tempfile
 import os
 import subprocess
+import time
 from collections import defaultdict
-from multiprocessing import Pool
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime
 from os.path import join, abspath, isfile
-from typing import Union, List, Dict
+from typing import Union, List, Dict, Tuple
 
 from logzero import logger as logging
+import pandas as pd
+import psutil
 import yaml
 
 from lama import common
 from lama.common import cfg_load
 from lama.registration_pipeline.validate_config import LamaConfig
+from lama.elastix.elastix_registration import (THREADS_PER_REGISTRATION, ELASTIX_MEMORY_FACTOR, ELX_STDOUT_LOG,
+                                               image_voxels)
 
 from lama.elastix import (ELX_TRANSFORM_NAME, ELX_PARAM_PREFIX, PROPAGATE_LABEL_TRANFORM,
                           PROPAGATE_IMAGE_TRANSFORM, PROPAGATE_CONFIG, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR)
@@ -26,6 +32,11 @@ LABEL_REPLACEMENTS = {
     'WriteResultImageAfterEachResolution': 'false'
 }
 
+INVERSION_REPORT = 'inversion_jobs.csv'  # Wall time and peak memory of each inversion, written to inverted_transforms
+RSS_POLL_INTERVAL = 0.5  # seconds between memory samples of a running elastix inversion
+# Deformable inversions take much longer than rigid/affine ones of the same size. Used to start the largest jobs first
+DEFORMABLE_COST = 10
+
 IMAGE_REPLACEMENTS = {
     'FinalBSplineInterpolationOrder': '3',
     'FixedInternalImagePixelType': 'float',
@@ -58,8 +69,6 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
     if isinstance(config, (Path, str)):
         config = LamaConfig(config)
 
-    threads = str(config['threads'])
-
     if new_log:
         common.init_logging(config / 'invert_transforms.log')
 
@@ -120,21 +129,20 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
                 'image_transform_file': PROPAGATE_IMAGE_TRANSFORM,
                 'label_transform_file': PROPAGATE_LABEL_TRANFORM,
                 'clobber': clobber,
-                'threads': threads
+                'specimen': vol_id,
+                'stage': reg_stage_dir.name
             }
 
             jobs.append(job)
 
-    # By putting each inverison job (a single job per registration stage) we can speed things up a bit
-    # If we can get multithreded inversion in elastix we can remove this python multithreading
-    pool = Pool(8)
-    try:
-        pool.map(_invert_transform_parameters, jobs)
+    n_workers, threads_per_job, mem_budget = plan_inversions(jobs, config['threads'])
+
+    records = run_inversion_jobs(jobs, n_workers, threads_per_job, mem_budget)
+    pd.DataFrame.from_records(records).to_csv(inv_outdir / INVERSION_REPORT, index=False)
 
-    except KeyboardInterrupt:
-        print('terminating inversion')
-        pool.terminate()
-        pool.join()
+    failed = [f"{r['specimen']} ({r['stage']})" for r in records if r['status'] != 'complete']
+    if failed:
+        logging.warning(f'{len(failed)} transform inversions failed: {", ".join(failed)}')
 
     # TODO: Should we replace the need for this invert.yaml?
     reg_dir = Path(os.path.relpath(reg_stage_dir, inv_outdir))
@@ -146,11 +154,151 @@ def batch_invert_transform_parameters(config: Union[Path, LamaConfig],
         yf.write(yaml.dump(dict(stages_to_invert), default_flow_style=False))
 
 
-def _invert_transform_parameters(args: Dict):
+def plan_inversions(jobs: List[Dict], threads: int = None) -> Tuple[int, int, float]:
+    """
+    Work out the cost and memory use of each inversion job, and how many to run at once.
+
+    Each job gets 'cost' (used to start the largest first) and 'mem' (estimated peak memory in bytes) entries, estimated
+    from the size of its stage's fixed image and whether the stage is deformable.
+
+    Parameters
+    ----------
+    jobs
+        The job dicts made by batch_invert_transform_parameters
+    threads
+        The total number of threads to use (the config 'threads' option). If None, the number of cpus
+
+    Returns
+    -------
+    number of jobs to run at once, threads for each elastix process, memory budget for the running jobs (bytes)
+    """
+    cpus = os.cpu_count() or 1
+    if not threads:
+        threads = cpus
+
+    voxels = {}
+    for job in jobs:
+        fixed = job['fixed_volume']
+        if fixed not in voxels:
+            try:
+                voxels[fixed] = image_voxels(fixed)
+            except RuntimeError:  # Unreadable header. Treat as small
+                voxels[fixed] = 0
+
+        with open(job['transform_file'], 'r') as fh:
+            deformable = 'BSplineTransform' in fh.read()
+
+        # The fixed image is also the moving image in an inversion
+        job['mem'] = voxels[fixed] * 2 * 4 * ELASTIX_MEMORY_FACTOR
+        job['cost'] = voxels[fixed] * (DEFORMABLE_COST if deformable else 1)
+
+    mem_budget = common.available_memory()
+
+    n_workers = max(1, min(threads, cpus) // THREADS_PER_REGISTRATION)
+    if jobs:
+        # Don't start more workers than could ever run at once with the smallest jobs
+        smallest = min(job['mem'] for job in jobs)
+        if smallest:
+            n_workers = min(n_workers, max(1, int(mem_budget // smallest)))
+        n_workers = min(n_workers, len(jobs))
+
+    threads_per_job = max(1, threads // n_workers)
+
+    logging.info(f'Running up to {n_workers} transform inversions at once with {threads_per_job} threads each')
+    return n_workers, threads_per_job, mem_budget
+
+
+def run_inversion_jobs(jobs: List[Dict], n_workers: int, threads_per_job: int, mem_budget: float) -> List[Dict]:
+    """
+    Run the inversion jobs, the most costly first. A job is started when one of the n_workers is free and its estimated
+    memory fits in what the running jobs leave of mem_budget (a job is always started if none are running). If the
+    next job does not fit, smaller ones that do are started instead.
+
+    Threads are used as the work is done by elastix subprocesses.
+
+    Parameters
+    ----------
+    jobs
+        The job dicts with 'cost' and 'mem' entries (see plan_inversions)
+
+    Returns
+    -------
+    A record of each job: specimen, stage, status, threads, estimated memory, start time, wall time and the peak
+    memory of the elastix process
+    """
+    pending = sorted(jobs, key=lambda j: j['cost'], reverse=True)
+    running = {}
+    mem_used = 0
+    records = []
+
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        try:
+            while pending or running:
+                i = 0
+                while i < len(pending) and len(running) < n_workers:
+                    job = pending[i]
+                    if running and mem_used + job['mem'] > mem_budget:
+                        i += 1
+                        continue
+                    job['threads'] = str(threads_per_job)
+                    running[pool.submit(_timed_inversion, job)] = job
+                    mem_used += job['mem']
+                    del pending[i]
+
+                done, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in done:
+                    job = running.pop(future)
+                    mem_used -= job['mem']
+                    records.append(future.result())
+
+        except BaseException:
+            for future in running:
+                future.cancel()  # Only stops those not started. Running ones are waited for
+            raise
+
+    return records
+
+
+def _timed_inversion(job: Dict) -> Dict:
+    """
+    Run an inversion job and record how long it took and its peak memory use
+    """
+    usage = {}
+    start = datetime.now()
+    t0 = time.perf_counter()
+
+    try:
+        status = 'complete' if _invert_transform_parameters(job, usage) else 'failed'
+    except Exception:
+        logging.exception(f"Inversion of {job['specimen']} ({job['stage']}) failed")
+        status = 'failed'
+
+    return {'specimen': job['specimen'],
+            'stage': job['stage'],
+            'status': status,
+            'threads': job['threads'],
+            'estimated_mem_mb': round(job['mem'] / 2 ** 20, 1),
+            'start_time': start.strftime('%Y-%m-%d %H:%M:%S'),
+            'wall_time_s': round(time.perf_counter() - t0, 2),
+            'peak_rss_mb': round(usage.get('peak_rss', 0) / 2 ** 20, 1)}
+
+
+def _invert_transform_parameters(args: Dict, usage: Dict = None) -> bool:
     """
     Generate a single inverted elastix transform parameter file. This can then be used to invert labels, masks etc.
     If any of the step fail, return as subsequent steps will also fail. The logging of failures is handled
     within each function
+
+    Parameters
+    ----------
+    args
+        The job
+    usage
+        If given, the peak memory use of the elastix process is added as 'peak_rss'
+
+    Returns
+    -------
+    False if any of the steps failed
     """
 
     # If we have both the image and label inverted transforms, don't do anything if noclobber is True
@@ -162,7 +310,7 @@ def _invert_transform_parameters(args: Dict):
 
     if not clobber and isfile(label_transform_param_path) and isfile(image_transform_param_path):
         logging.info('skipping {} as noclobber is True and inverted parameter files exist')
-        return
+        return True
 
     # Modify the elastix registration input parameter file to enable inversion (Change metric and don't write image results)
     inversion_params = abspath(join(args['specimen_stage_inversion_dir'], args['param_file_output_name'])) # The elastix registration parameters used for inversion
@@ -173,23 +321,24 @@ def _invert_transform_parameters(args: Dict):
     forward_tform_file = abspath(args['transform_file'])
     invert_param_dir = args['specimen_stage_inversion_dir']
 
-    if not invert_elastix_transform_parameters(fixed_vol, forward_tform_file, inversion_params, invert_param_dir, threads):
-        return
+    if not invert_elastix_transform_parameters(fixed_vol, forward_tform_file, inversion_params, invert_param_dir, threads,
+                                               usage):
+        return False
 
     # Get the resulting TransformParameters file, and create a transform file suitable for inverting normal volumes
     image_inverted_tform = abspath(join(args['specimen_stage_inversion_dir'], 'TransformParameters.0.txt'))
 
     if not _modify_inverted_tform_file(image_inverted_tform, image_transform_param_path):
-        return
+        return False
 
     # Get the resulting TransformParameters file, and create a transform file suitable for inverting label volumes
 
     # replace the parameter in the image file with label-specific parameters and save in new file. No need to
     # generate one from scratch
     if not make_elastix_inversion_parameter_file(image_transform_param_path, label_transform_param_path, args['label_replacements']):
-        return
+        return False
 
-    _modify_inverted_tform_file(label_transform_param_path)
+    return _modify_inverted_tform_file(label_transform_param_path)
 
 
 def get_reg_dirs(config: LamaConfig) -> List[Path]:
@@ -254,33 +403,77 @@ def make_elastix_inversion_parameter_file(elx_param_file: Path, newfile_name: st
     return True
 
 
-def invert_elastix_transform_parameters(fixed: Path, tform_file: Path, param: Path, outdir: Path, threads: str):
+def invert_elastix_transform_parameters(fixed: Path, tform_file: Path, param: Path, outdir: Path, threads: str,
+                                        usage: Dict = None):
     """
     Invert the transform and get a new transform file
+
+    Parameters
+    ----------
+    usage
+        If given, the peak memory use of the elastix process is added as 'peak_rss'
     """
     if not common.test_installation('elastix'):
         raise OSError('elastix not installed')
 
     cmd = ['elastix',
-           '-t0', tform_file,
-           '-p', param,
-           '-f', fixed,
-           '-m', fixed,
-           '-out', outdir,
+           '-t0', str(tform_file),
+           '-p', str(param),
+           '-f', str(fixed),
+           '-m', str(fixed),
+           '-out', str(outdir),
            '-threads', threads   # 11/09/18. This was set to 1. Can iversions take advantage of multithreading?
            ]
 
+    log_file = Path(outdir) / ELX_STDOUT_LOG
 
     try:
-        subprocess.check_output(cmd)
-    except (Exception, subprocess.CalledProcessError) as e:
-        msg = f'Inverting transform file failed. cmd: {cmd}\n{str(e)}:'
+        returncode, peak_rss = _run_monitored(cmd, log_file)
+    except OSError as e:
+        returncode, peak_rss = str(e), 0
+
+    if usage is not None:
+        usage['peak_rss'] = peak_rss
+
+    if returncode != 0:
+        msg = f'Inverting transform file failed. cmd: {cmd}\nexit status: {returncode}. See {log_file}'
         logging.error(msg)
-        logging.exception(msg)
         return False
     return True
 
 
+def _run_monitored(cmd: List[str], log_file: Path) -> Tuple[int, int]:
+    """
+    Run a command, sampling its memory use while it runs
+
+    Returns
+    -------
+    The return code and the peak resident memory in bytes
+    """
+    with open(log_file, 'w') as log:
+        proc = subprocess.Popen(cmd, stdout=log, stderr=subprocess.STDOUT)
+
+        try:
+            ps_proc = psutil.Process(proc.pid)
+        except psutil.Error:  # Already finished
+            ps_proc = None
+
+        peak_rss = 0
+        while True:
+            if ps_proc:
+                try:
+                    peak_rss = max(peak_rss, ps_proc.memory_info().rss)
+                except psutil.Error:
+                    pass
+            try:
+                returncode = proc.wait(timeout=RSS_POLL_INTERVAL)
+            except subprocess.TimeoutExpired:
+                continue
+            break
+
+    return returncode, peak_rss
+
+
 def _modify_inverted_tform_file(elx_tform_file: Path, newfile_name: str=None):
     """
     Remove "NoInitialTransform" from the output transform parameter file
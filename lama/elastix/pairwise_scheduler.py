@@ -0,0 +1,252 @@
+"""
+Schedules the n x (n - 1) registrations of a pairwise population average, and the mean transform for each specimen
+once all of its registrations are done.
+
+Used by PairwiseBasedRegistration (one machine) and by parallel_average_pairwise (several machines sharing a status
+folder).
+
+Jobs
+----
+Each pair is a (member, group) tuple. The group is the specimen whose output folder the registration is written to,
+and which gets a mean transform made from all its registrations. The pairs are ordered by group so the registrations
+running at the same time share an image, which then stays in the page cache. Each worker process starts at a
+different group so workers on different machines do not all try to claim the same pairs.
+
+Claims
+------
+If a status folder is given, a pair is claimed by creating status/started/<member index>-<group index> exclusively.
+The indices are the positions of the ids in sorted order, as specimen ids may contain underscores and a name such as
+a_b_c could be either (a_b, c) or (a, b_c). Finished and failed pairs get a file in status/finished and status/failed,
+holding the pair name. Mean transforms are claimed and recorded in the same way in status/mean_started and
+status/mean_finished, named by the group's specimen id.
+
+Up to n_procs jobs are run at once from a thread pool (the work is done in elastix/transformix subprocesses). The
+scheduler waits on the completion of these jobs rather than polling. Only when all the remaining work has been claimed
+by other machines does it check the status folder, with an increasing interval.
+"""
+
+from pathlib import Path
+from typing import List, Callable, Tuple, Iterator, Set
+from concurrent.futures import ThreadPoolExecutor, wait, FIRST_COMPLETED
+import os
+import socket
+import time
+import traceback
+import zlib
+
+from logzero import logger as logging
+
+# Interval range (seconds) for checking on registrations running on other machines
+MIN_WAIT = 1
+MAX_WAIT = 60
+
+
+class PairwiseScheduler:
+    def __init__(self,
+                 specimen_ids: List[str],
+                 n_procs: int = 1,
+                 status_dir: Path = None,
+                 fail_fast: bool = True):
+        """
+        Parameters
+        ----------
+        specimen_ids
+            All the specimens. Each is registered to every other one
+        n_procs
+            Number of jobs to run at once
+        status_dir
+            Folder shared with the other workers. If None, this is the only worker
+        fail_fast
+            True: stop starting new jobs after a failure and raise its error
+            False: carry on. The groups with failed registrations do not get a mean transform
+        """
+        self.ids = list(specimen_ids)
+        self.n_procs = max(1, n_procs)
+        self.status_dir = Path(status_dir) if status_dir else None
+        self.fail_fast = fail_fast
+
+        self.groups = {g: [m for m in self.ids if m != g] for g in self.ids}
+
+        # Pairs are keyed by the indices of their ids so the keys are unambiguous (see module docstring)
+        self._index = {id_: i for i, id_ in enumerate(sorted(self.ids))}
+        self._pair_names = {self._key(m, g): self.pair_name(m, g) for g, members in self.groups.items()
+                            for m in members}
+
+        if self.status_dir:
+            for sub_dir in ('started', 'finished', 'failed', 'mean_started', 'mean_finished'):
+                (self.status_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+
+        # Local record, used when there is no status folder
+        self._finished: Set[str] = set()
+        self._failed: Set[str] = set()
+        self._means_finished: Set[str] = set()
+        self._means_claimed: Set[str] = set()
+
+    @staticmethod
+    def pair_name(member: str, group: str) -> str:
+        """
+        The readable name of a pair. Used for its output folder within the group's folder and in logs. Not unique if
+        the ids contain underscores, so not used for the claims
+        """
+        return f'{member}_{group}'
+
+    def _key(self, member: str, group: str) -> str:
+        return f'{self._index[member]}-{self._index[group]}'
+
+    def _order(self) -> Iterator[Tuple[str, str]]:
+        """
+        The pairs grouped by group, starting at a different group for each worker
+        """
+        if self.status_dir and self.ids:
+            offset = zlib.crc32(f'{socket.gethostname()}{os.getpid()}'.encode()) % len(self.ids)
+        else:
+            offset = 0
+
+        group_order = self.ids[offset:] + self.ids[:offset]
+        for group in group_order:
+            for member in self.groups[group]:
+                yield member, group
+
+    def _claim(self, sub_dir: str, name: str) -> bool:
+        if not self.status_dir:
+            return True
+        try:
+            open(self.status_dir / sub_dir / name, 'x').close()
+        except FileExistsError:
+            return False
+        return True
+
+    def _record(self, sub_dir: str, name: str, text: str = ''):
+        if self.status_dir:
+            with open(self.status_dir / sub_dir / name, 'w') as fh:
+                fh.write(text)
+
+    def _listing(self, sub_dir: str, local: Set[str]) -> Set[str]:
+        if not self.status_dir:
+            return set(local)
+        return set(os.listdir(self.status_dir / sub_dir)) | local
+
+    def _ready_groups(self, finished: Set[str]) -> List[str]:
+        """
+        Groups with all registrations finished that don't have a mean transform yet
+        """
+        ready = []
+        for group, members in self.groups.items():
+            if group in self._means_claimed:
+                continue
+            keys = {self._key(m, group) for m in members}
+            if keys <= finished:
+                ready.append(group)
+        return ready
+
+    def _all_done(self, finished: Set[str], failed: Set[str], means_finished: Set[str]) -> bool:
+        for group, members in self.groups.items():
+            keys = {self._key(m, group) for m in members}
+            if keys & failed:
+                if not keys <= finished | failed:
+                    return False
+                continue  # No mean transform for a group with failures
+            if not keys <= finished or group not in means_finished:
+                return False
+        return True
+
+    def run(self, register: Callable[[str, str], None], group_done: Callable[[str], None]) -> List[str]:
+        """
+        Run all the registrations and the mean transforms
+
+        Parameters
+        ----------
+        register
+            register(member, group) does a registration
+        group_done
+            group_done(group) is called once all the registrations of a group have finished
+
+        Returns
+        -------
+        Names of the failed registrations (only if fail_fast is False)
+        """
+        pairs = self._order()
+        pairs_left = True
+        in_flight = {}
+        wait_time = MIN_WAIT
+
+        def run_pair(member, group):
+            key = self._key(member, group)
+            try:
+                register(member, group)
+            except Exception:
+                self._record('failed', key, f'{self.pair_name(member, group)}\n{traceback.format_exc()}')
+                raise
+            self._record('finished', key, self.pair_name(member, group))
+
+        def run_mean(group):
+            group_done(group)
+            self._record('mean_finished', group)
+
+        with ThreadPoolExecutor(max_workers=self.n_procs) as pool:
+            try:
+                while True:
+                    finished = self._listing('finished', self._finished)
+                    failed = self._listing('failed', self._failed)
+
+                    if failed and self.fail_fast:
+                        raise RuntimeError(f'Exiting as a failure has been detected: {self._names(failed)}')
+
+                    # Start mean transforms first as the next stage waits on them
+                    for group in self._ready_groups(finished):
+                        if len(in_flight) >= self.n_procs:
+                            break
+                        self._means_claimed.add(group)
+                        if self._claim('mean_started', group):
+                            in_flight[pool.submit(run_mean, group)] = ('mean', group)
+
+                    while pairs_left and len(in_flight) < self.n_procs:
+                        try:
+                            member, group = next(pairs)
+                        except StopIteration:
+                            pairs_left = False
+                            break
+                        key = self._key(member, group)
+                        if key in finished or not self._claim('started', key):
+                            continue
+                        in_flight[pool.submit(run_pair, member, group)] = ('pair', key)
+
+                    if not in_flight:
+                        means_finished = self._listing('mean_finished', self._means_finished)
+                        if self._all_done(finished, failed, means_finished):
+                            break
+                        # The remaining work is running on other machines
+                        time.sleep(wait_time)
+                        wait_time = min(wait_time * 2, MAX_WAIT)
+                        continue
+
+                    wait_time = MIN_WAIT
+                    done, _ = wait(in_flight, return_when=FIRST_COMPLETED)
+
+                    for future in done:
+                        kind, name = in_flight.pop(future)
+                        try:
+                            future.result()
+                        except Exception:
+                            if kind == 'mean' or self.fail_fast:
+                                raise
+                            logging.exception(f'registration {self._pair_names.get(name, name)} failed. '
+                                              f'Continuing with the others')
+                            self._failed.add(name)
+                        else:
+                            if kind == 'pair':
+                                self._finished.add(name)
+                            else:
+                                self._means_finished.add(name)
+            except BaseException:
+                for future in in_flight:
+                    future.cancel()  # Running jobs are waited for when the pool shuts down
+                raise
+
+        failed = sorted(self._pair_names.get(key, key) for key in self._listing('failed', self._failed))
+        if failed:
+            logging.warning(f'{len(failed)} pairwise registrations failed: {", ".join(failed)}')
+        return failed
+
+    def _names(self, keys: Set[str]) -> str:
+        return ', '.join(sorted(self._pair_names.get(key, key) for key in keys))
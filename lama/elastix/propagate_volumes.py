@@ -36,25 +36,47 @@ Inversion can fail if the registration resolutions are set incorrectly.
 For example, if the non-linear step has 6 resolutions and a a final BSpline grid spacing of 8, the largest grid size
 will be 256. It seems that if this is larger than the input image dimensions, the inversion will fail.
 
+Propagation method
+------------------
+'native' (the default) composes the chain of transforms once into a displacement field for each specimen, which is
+cached in the 'propagation_fields' folder next to the propagation config. Any number of images (label maps, masks,
+heatmaps) are then resampled against that field with SimpleITK: label maps with nearest neighbour and intensity
+images with cubic B-spline interpolation. Transform chains that spatial_jacobian.ElastixTransform can't evaluate fall
+back to transformix, as does method='transformix'.
+
 """
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
+import hashlib
 import os
 import subprocess
 from os.path import join
 import shutil
+import tempfile
 
 from logzero import logger as logging
+import SimpleITK as sitk
 import yaml
 
 from lama import common
 from lama.common import cfg_load
 from lama.elastix import (PROPAGATE_LABEL_TRANFORM, PROPAGATE_IMAGE_TRANSFORM, ELX_PARAM_PREFIX, TRANSFORMIX_OUT,
                           ELX_TRANSFORM_NAME, ELX_INVERTED_POINTS_NAME, PROPAGATE_CONFIG)
+from lama.elastix.spatial_jacobian import ElastixTransform, UnsupportedTransformError, spatial_jacobian
+
+FIELD_CACHE_DIR = 'propagation_fields'
+
+# Transform parameter file entries that define the mapping. The interpolation and output pixel type entries, which
+# differ between the label and image propagation transforms, do not change the displacement field
+FIELD_PARAMS = ('Transform', 'NumberOfParameters', 'TransformParameters', 'HowToCombineTransforms', 'Size', 'Index',
+                'Spacing', 'Origin', 'Direction', 'CenterOfRotationPoint', 'GridSize', 'GridIndex', 'GridSpacing',
+                'GridOrigin', 'GridDirection', 'BSplineTransformSplineOrder', 'UseCyclicTransform')
 
 
 class Propagate(object):
-    def __init__(self, config_path: Path, invertable, outdir, threads=None, noclobber=False):
+    INTERPOLATOR = sitk.sitkNearestNeighbor  # Used by the native method
+
+    def __init__(self, config_path: Path, invertable, outdir, threads=None, noclobber=False, method='native'):
         """
         Inverts a series of volumes. A yaml config file specifies the order of inverted transform parameters
         to use. This config file should be in the root of the directory containing these inverted tform dirs.
@@ -76,14 +98,22 @@ class Propagate(object):
         invertable: str
             dir or path. If dir, invert all objects within the subdirectories.
                 If path to object (eg. labelmap) invert that instead
+                Can also be a list of paths, named after the input files in the specimen folder, or a dict of
+                {path: outdir} where each image is written to its own outdir, named as a single image would be.
+                With the native method these are all resampled against the same displacement field
         noclobber: bool
             if True do not overwrite already inverted labels
+        method: str
+            'native': resample against a cached displacement field of the composed transforms
+            'transformix': run transformix on the chained transform files
 
         """
 
         self.noclobber = noclobber
+        self.method = method
 
-        common.test_installation('transformix')
+        if method == 'transformix':
+            common.test_installation('transformix')
 
         self.config = cfg_load(config_path)
 
@@ -119,7 +149,14 @@ class Propagate(object):
             tform_root = self.config_dir
             init_tform = chain_tforms(tform_root, prop_out_dir, self.PROPAGATION_TFORM_NAME, self.config)
 
-            propagated = self._propagate(self.invertables, init_tform, prop_out_dir, self.threads)
+            if self.method == 'native':
+                try:
+                    propagated = self._propagate_native(init_tform, prop_out_dir)
+                except UnsupportedTransformError as e:
+                    logging.info(f'{e}. Using transformix')
+                    propagated = self._propagate_transformix(init_tform, prop_out_dir)
+            else:
+                propagated = self._propagate_transformix(init_tform, prop_out_dir)
 
             if not propagated: # If inversion failed or there is nocobber, will get None
                 continue
@@ -129,6 +166,66 @@ class Propagate(object):
     def _propagate(self):
         raise NotImplementedError
 
+    def _outputs(self, prop_out_dir: Path) -> List[Tuple[Path, Path]]:
+        """
+        (image, propagated image path) for each of the invertables of a specimen
+        """
+        id_ = prop_out_dir.name
+
+        if isinstance(self.invertables, dict):
+            outputs = []
+            for path, outdir in self.invertables.items():
+                (Path(outdir) / id_).mkdir(parents=True, exist_ok=True)
+                outputs.append((path, Path(outdir) / id_ / f'{id_}.nrrd'))
+            return outputs
+
+        if isinstance(self.invertables, (str, Path)):
+            return [(self.invertables, prop_out_dir / f'{id_}.nrrd')]
+
+        return [(path, prop_out_dir / f'{Path(path).stem}.nrrd') for path in self.invertables]
+
+    def _propagate_native(self, tform: Path, prop_out_dir: Path) -> List[Path]:
+        """
+        Resample the invertables against the displacement field of the chained transforms
+
+        Parameters
+        ----------
+        tform
+            The first transform file of the chain made by chain_tforms
+        prop_out_dir
+            The specimen folder
+
+        Raises
+        ------
+        UnsupportedTransformError
+            If the transforms can't be evaluated natively
+        """
+        field = displacement_field(tform, self.config_dir / FIELD_CACHE_DIR, prop_out_dir.name)
+
+        outputs = self._outputs(prop_out_dir)
+        for path, new_output_name in outputs:
+            img = resample(sitk.ReadImage(str(path)), field, self.INTERPOLATOR, self.threads)
+            sitk.WriteImage(img, str(new_output_name), True)
+
+        return [x[1] for x in outputs]
+
+    def _propagate_transformix(self, tform: Path, prop_out_dir: Path) -> List[Path]:
+        """
+        Run transformix on the chained transforms for each of the invertables
+        """
+        if isinstance(self.invertables, (str, Path)):  # Named by _propagate
+            return [self._propagate(self.invertables, tform, prop_out_dir, self.threads)]
+
+        results = []
+        for path, new_output_name in self._outputs(prop_out_dir):
+            outdir = new_output_name.parent
+            propagated = self._propagate(path, tform, outdir, self.threads)
+            if propagated and Path(propagated) != new_output_name:
+                shutil.move(str(propagated), str(new_output_name))
+                propagated = new_output_name
+            results.append(propagated)
+        return results
+
     def _transform_dirs(self) -> List[Path]:
         """
         When implemented, this method returns a list of directories each containing transform parameter file for a
@@ -213,6 +310,8 @@ class PropagateHeatmap(PropagateLabelMap):
     """
     This class behaves the same as InvertLabelap but uses a different transform parameter file
     """
+    INTERPOLATOR = sitk.sitkBSpline
+
     def __init__(self, *args, **kwargs):
         super(PropagateHeatmap, self).__init__(*args, **kwargs)
         self.invert_transform_name = PROPAGATE_IMAGE_TRANSFORM
@@ -221,7 +320,8 @@ class PropagateHeatmap(PropagateLabelMap):
 class PropagateMeshes(Propagate):
 
     def __init__(self, config_path, invertable, outdir, threads=None):
-        super(PropagateMeshes, self).__init__(config_path, invertable, outdir, threads)
+        # Points are transformed by transformix. The displacement field is only used to resample images
+        super(PropagateMeshes, self).__init__(config_path, invertable, outdir, threads, method='transformix')
         self.invert_transform_name = ELX_TRANSFORM_NAME
 
     def _transform_dirs(self):
@@ -383,6 +483,111 @@ class PropagateSingleVol(Propagate):
             return new_img_path
 
 
+def displacement_field(tform: Path, cache_dir: Path, name: str) -> sitk.Image:
+    """
+    The displacement field of a chain of elastix transforms on its output grid. It is computed once and cached, keyed
+    by the transform parameters, so later propagations for the same specimen just read it
+
+    Parameters
+    ----------
+    tform
+        The first transform parameter file of the chain
+    cache_dir
+        Where to keep the fields
+    name
+        The specimen id. Used to name the cached field
+
+    Returns
+    -------
+    Vector image of (x, y, z) float32 displacements T(x) - x
+
+    Raises
+    ------
+    UnsupportedTransformError
+        If the transforms can't be evaluated natively
+    """
+    elx_tform = ElastixTransform(tform)  # Raises UnsupportedTransformError before any work is done
+
+    cache_dir.mkdir(exist_ok=True)
+    field_file = cache_dir / f'{name}_{_field_key(tform)}.nrrd'
+
+    if field_file.is_file():
+        return sitk.ReadImage(str(field_file))
+
+    logging.info(f'Making the propagation displacement field for {name}')
+    deformation = spatial_jacobian(elx_tform, deformation=True).deformation
+
+    field = sitk.GetImageFromArray(deformation, isVector=True)
+    field.SetSpacing(elx_tform.spacing.tolist())
+    field.SetOrigin(elx_tform.origin.tolist())
+    field.SetDirection(elx_tform.direction.ravel().tolist())
+
+    # Replace any out of date field for the specimen. Write to a temporary file first so other propagations never
+    # read a partial field
+    for old in cache_dir.glob(f'{name}_*.nrrd'):
+        old.unlink()
+    fd, tmp = tempfile.mkstemp(dir=cache_dir, suffix='.nrrd')
+    os.close(fd)
+    sitk.WriteImage(field, tmp, False)
+    os.replace(tmp, field_file)
+
+    return field
+
+
+def resample(img: sitk.Image, field: sitk.Image, interpolator=sitk.sitkNearestNeighbor, threads=None) -> sitk.Image:
+    """
+    Resample an image onto the grid of a displacement field, keeping its pixel type, as transformix would
+
+    Parameters
+    ----------
+    img
+        The image to propagate
+    field
+        from displacement_field
+    interpolator
+        sitk.sitkNearestNeighbor for label maps and masks, sitk.sitkBSpline for intensity images
+    threads
+        If None, use all available cpus
+    """
+    # DisplacementFieldTransform takes the field's buffer, so give it a copy
+    transform = sitk.DisplacementFieldTransform(sitk.Cast(field, sitk.sitkVectorFloat64))
+
+    resampler = sitk.ResampleImageFilter()
+    resampler.SetReferenceImage(field)
+    resampler.SetTransform(transform)
+    resampler.SetInterpolator(interpolator)
+    resampler.SetDefaultPixelValue(0)
+    resampler.SetOutputPixelType(img.GetPixelID())
+    if threads:
+        resampler.SetNumberOfThreads(int(threads))
+
+    return resampler.Execute(img)
+
+
+def _field_key(tform: Path) -> str:
+    """
+    A hash of the parameters of a chain of transforms that define its displacement field
+    """
+    sha = hashlib.sha1()
+    tform = Path(tform)
+
+    while True:
+        initial = 'NoInitialTransform'
+        with open(tform, 'r') as fh:
+            for line in fh:
+                name = line.strip().strip('(').split(' ')[0]
+                if name in FIELD_PARAMS:
+                    sha.update(line.strip().encode())
+                elif name == 'InitialTransformParametersFileName':
+                    initial = line.split(' ', 1)[1].strip().strip(')').strip('"')
+
+        if initial == 'NoInitialTransform':
+            return sha.hexdigest()[:16]
+
+        initial = Path(initial)
+        tform = initial if initial.is_file() else tform.parent / initial
+
+
 def chain_tforms(root_dir: Path, new_tform_dir, tform_name, config):
 
     label_replacements = {
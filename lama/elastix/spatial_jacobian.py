@@ -0,0 +1,444 @@
+"""
+Spatial jacobians computed directly from elastix transform parameter files.
+
+This gives the same output as 'transformix -jac all' (and optionally '-jacmat all' and '-def all') without writing
+full-size images to disk and reading them back. The transform parameter file is read with folding.BSplineParse and the
+analytic derivatives of the transform are evaluated on the output image grid, a slab of z-slices at a time.
+
+Supported transforms are the cubic B-spline and the affine, similarity, Euler and translation transforms, chained
+through InitialTransformParametersFileName and combined by composition (the elastix default). Anything else raises
+UnsupportedTransformError, so the caller can fall back to transformix.
+
+The transforms map points of the fixed (output) image grid, x, into the moving image. For a chain, T(x) = T_n(...T_1(x))
+where T_1 is the first initial transform, and the spatial jacobian is the product of the jacobians of each transform at
+the point it is applied to.
+
+A B-spline evaluated directly on the image grid has separable basis functions, so its displacements and derivatives are
+computed by contracting the coefficient grid with small 1D weight matrices along each axis. A B-spline evaluated at
+points moved by an earlier transform gathers the 4x4x4 supporting coefficients of each point instead.
+"""
+
+from pathlib import Path
+from collections import namedtuple
+from typing import Union, Tuple
+
+import numpy as np
+import SimpleITK as sitk
+
+from lama.elastix.folding import BSplineParse
+
+SLAB_VOXELS = 2 ** 20  # Approximate number of voxels evaluated at once
+GATHER_POINTS = 2 ** 15  # Points per B-spline evaluation off the control point grid
+BSPLINE_TRANSFORMS = ('BSplineTransform', 'RecursiveBSplineTransform')
+LINEAR_TRANSFORMS = ('TranslationTransform', 'EulerTransform', 'SimilarityTransform', 'AffineTransform')
+
+# det and log_det: (z, y, x) float32 arrays
+# jacmat: (z, y, x, 9) float32 row-major jacobian matrices, as 'transformix -jacmat all'. None if not requested
+# deformation: (z, y, x, 3) float32 displacement vectors T(x) - x, as 'transformix -def all'. None if not requested
+SpatialJacobian = namedtuple('SpatialJacobian', 'det log_det jacmat deformation')
+
+
+class UnsupportedTransformError(Exception):
+    """
+    Raised when a transform parameter file can't be evaluated here. Callers catch this to fall back to transformix
+    """
+    pass
+
+
+class ElastixTransform:
+    def __init__(self, tform_file: Union[Path, str]):
+        """
+        A transform read from an elastix TransformParameters file, along with its chain of initial transforms
+
+        Parameters
+        ----------
+        tform_file
+            path to the elastix TransformParameters file
+
+        Raises
+        ------
+        UnsupportedTransformError
+            if the file, or one of its initial transforms, can't be evaluated here
+        """
+        tform_file = Path(tform_file)
+        bs = BSplineParse(tform_file)
+        p = bs.parameters
+
+        self.transform_type = p['Transform'][0]
+
+        if p.get('HowToCombineTransforms', ['Compose'])[0] != 'Compose':
+            raise UnsupportedTransformError(f'{tform_file}: only composed transforms are supported')
+
+        if int(p.get('FixedImageDimension', [3])[0]) != 3:
+            raise UnsupportedTransformError(f'{tform_file}: only 3D transforms are supported')
+
+        # The output image grid
+        self.size = np.array(p['Size'], dtype=int)
+        self.spacing = np.array(p['Spacing'], dtype=float)
+        self.origin = np.array(p['Origin'], dtype=float)
+        self.direction = _direction(p.get('Direction'))
+
+        coefs = np.asarray(bs.coefs, dtype=float)
+        if coefs.ndim == 2:  # B-spline coefficients as (control points, xyz). Back to the order in the file
+            coefs = coefs.T
+        coefs = coefs.ravel()
+
+        if self.transform_type in BSPLINE_TRANSFORMS:
+            self.linear = None
+            self._init_bspline(tform_file, p, coefs)
+        elif self.transform_type in LINEAR_TRANSFORMS:
+            self.linear = _linear_transform(self.transform_type, coefs, p)
+        else:
+            raise UnsupportedTransformError(f'{tform_file}: {self.transform_type} is not supported')
+
+        initial = p.get('InitialTransformParametersFileName', ['NoInitialTransform'])[0]
+
+        if initial == 'NoInitialTransform':
+            self.initial = None
+        else:
+            initial = Path(initial)
+            if not initial.is_file():  # Relative to the transform file
+                initial = tform_file.parent / initial
+            self.initial = ElastixTransform(initial)
+
+    def _init_bspline(self, tform_file: Path, p: dict, coefs: np.ndarray):
+        if int(p.get('BSplineTransformSplineOrder', [3])[0]) != 3:
+            raise UnsupportedTransformError(f'{tform_file}: only cubic B-splines are supported')
+
+        if p.get('UseCyclicTransform', ['false'])[0] == 'true':
+            raise UnsupportedTransformError(f'{tform_file}: cyclic B-splines are not supported')
+
+        self.grid_size = np.array(p['GridSize'], dtype=int)
+        self.grid_index = np.array(p.get('GridIndex', [0, 0, 0]), dtype=float)
+        grid_spacing = np.array(p['GridSpacing'], dtype=float)
+        self.grid_origin = np.array(p['GridOrigin'], dtype=float)
+        grid_direction = _direction(p.get('GridDirection'))
+
+        # Physical point to continuous control point index
+        self.point_to_index = np.linalg.inv(grid_direction @ np.diag(grid_spacing))
+
+        # The coefficients are all the x displacements, then all the y, then all the z. Control points are x-fastest
+        gx, gy, gz = self.grid_size
+        self.coef_grid = coefs.reshape(3, gz, gy, gx).transpose(1, 2, 3, 0)  # (z, y, x, xyz component)
+        self.coef_flat = self.coef_grid.reshape(-1, 3)
+
+    @property
+    def shape(self) -> Tuple[int, int, int]:
+        """
+        Shape of the output image array (z, y, x)
+        """
+        return tuple(self.size[::-1])
+
+    def same_grid(self, other: 'ElastixTransform') -> bool:
+        return (np.array_equal(self.size, other.size) and np.allclose(self.spacing, other.spacing)
+                and np.allclose(self.origin, other.origin) and np.allclose(self.direction, other.direction))
+
+    def grid_points(self, z0: int, z1: int) -> np.ndarray:
+        """
+        Physical coordinates (n, xyz) of the output grid voxels of slices z0 to z1, in array order
+        """
+        nx, ny, _ = self.size
+        z, y, x = np.meshgrid(np.arange(z0, z1), np.arange(ny), np.arange(nx), indexing='ij')
+        idx = np.stack([x.ravel(), y.ravel(), z.ravel()], axis=1).astype(float)
+        return self.origin + idx @ (self.direction @ np.diag(self.spacing)).T
+
+    def map_points(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply the chain of transforms to points
+
+        Parameters
+        ----------
+        points
+            (n, xyz) physical coordinates
+
+        Returns
+        -------
+        The transformed points (n, xyz) and the spatial jacobian matrices (n, 3, 3)
+        """
+        jac_initial = None
+        if self.initial:
+            points, jac_initial = self.initial.map_points(points)
+
+        mapped, jac = self._apply(points)
+
+        if jac_initial is not None:
+            jac = jac @ jac_initial
+        return mapped, jac
+
+    def _apply(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply this transform only, not the initial transforms
+        """
+        if self.linear is not None:
+            matrix, translation = self.linear
+            return points @ matrix.T + translation, np.broadcast_to(matrix, (len(points), 3, 3))
+        return self._bspline_at_points(points)
+
+    def map_grid(self, z0: int, z1: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        Apply the chain of transforms to the output grid voxels of slices z0 to z1
+
+        Returns
+        -------
+        The transformed points (n, xyz) and the spatial jacobian matrices (n, 3, 3)
+        """
+        if self.initial:
+            if self.initial.same_grid(self):
+                # Eg. B-spline stages chained on the same fixed image
+                points, jac_initial = self.initial.map_grid(z0, z1)
+            else:
+                points, jac_initial = self.initial.map_points(self.grid_points(z0, z1))
+            mapped, jac = self._apply(points)
+            return mapped, jac @ jac_initial
+
+        points = self.grid_points(z0, z1)
+
+        if self.linear is not None:
+            return self._apply(points)
+
+        scale = self.point_to_index @ self.direction @ np.diag(self.spacing)
+        if not np.allclose(scale, np.diag(np.diag(scale))):
+            # The image and control point grids are not aligned so the weights are not separable
+            return self.map_points(points)
+
+        displacement, jac = self._bspline_on_grid(np.diag(scale), z0, z1)
+        return points + displacement, jac
+
+    def _bspline_at_points(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        displacement = np.empty(points.shape)
+        dindex = np.empty(points.shape + (3,))  # d displacement[i] / d cindex[j]
+
+        # The gathered coefficients take 64 x 3 values per point, so limit the number of points done at once
+        for c0 in range(0, len(points), GATHER_POINTS):
+            c1 = c0 + GATHER_POINTS
+            displacement[c0: c1], dindex[c0: c1] = self._gather_bspline(points[c0: c1])
+
+        jac = np.eye(3) + dindex @ self.point_to_index
+        return points + displacement, jac
+
+    def _gather_bspline(self, points: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+        cindex = (points - self.grid_origin) @ self.point_to_index.T - self.grid_index
+        start, w, dw, inside = _bspline_weights(cindex, self.grid_size)
+        inside = np.all(inside, axis=1)
+        start = np.where(inside[:, None], start, 0)
+
+        # Flat indices of the 4 x 4 x 4 (z, y, x) supporting control points of each point
+        gx, gy, _ = self.grid_size
+        support = np.arange(4)
+        idx = (((start[:, 2, None, None, None] + support[:, None, None]) * gy
+                + start[:, 1, None, None, None] + support[None, :, None]) * gx
+               + start[:, 0, None, None, None] + support[None, None, :])
+        n = len(points)
+        coefs = np.take(self.coef_flat, idx.reshape(n, 64), axis=0)  # (n, 64, xyz component)
+
+        # Contract along x, then y, then z as batched matrix products with the weights and their derivatives.
+        # The last three axes of z are x, y and z: 0 where the weight was used and 1 where its derivative was
+        coefs = coefs.reshape(n, 16, 4, 3).transpose(0, 1, 3, 2).reshape(n, 48, 4)
+        x = np.matmul(coefs, np.stack([w[:, 0], dw[:, 0]], axis=-1)).reshape(n, 4, 4, 3, 2)
+        x = x.transpose(0, 1, 3, 4, 2).reshape(n, 24, 4)
+        y = np.matmul(x, np.stack([w[:, 1], dw[:, 1]], axis=-1)).reshape(n, 4, 3, 2, 2)
+        y = y.transpose(0, 2, 3, 4, 1).reshape(n, 12, 4)
+        z = np.matmul(y, np.stack([w[:, 2], dw[:, 2]], axis=-1)).reshape(n, 3, 2, 2, 2)
+
+        displacement = z[:, :, 0, 0, 0]
+        dindex = np.stack([z[:, :, 1, 0, 0], z[:, :, 0, 1, 0], z[:, :, 0, 0, 1]], axis=-1)
+
+        # No displacement outside the region supported by the control points
+        displacement[~inside] = 0
+        dindex[~inside] = 0
+        return displacement, dindex
+
+    def _bspline_on_grid(self, scale: np.ndarray, z0: int, z1: int) -> Tuple[np.ndarray, np.ndarray]:
+        """
+        The B-spline displacements and jacobians on an output grid aligned with the control point grid
+
+        Parameters
+        ----------
+        scale
+            control point index units per output voxel along each axis
+        """
+        offset = self.point_to_index @ (self.origin - self.grid_origin) - self.grid_index
+
+        nx, ny, _ = self.size
+        wx, dwx = _axis_weights(offset[0] + scale[0] * np.arange(nx), self.grid_size[0])
+        wy, dwy = _axis_weights(offset[1] + scale[1] * np.arange(ny), self.grid_size[1])
+        wz, dwz = _axis_weights(offset[2] + scale[2] * np.arange(z0, z1), self.grid_size[2])
+
+        # Only the control point planes supporting this slab are needed
+        used = np.nonzero(np.any(wz != 0, axis=0))[0]
+        if len(used) == 0:
+            n = (z1 - z0) * ny * nx
+            return np.zeros((n, 3)), np.broadcast_to(np.eye(3), (n, 3, 3)).copy()
+        g0, g1 = used[0], used[-1] + 1
+        coefs = self.coef_grid[g0: g1]
+        wz, dwz = wz[:, g0: g1], dwz[:, g0: g1]
+
+        # Contract along x, then y, then z. c is the displacement component
+        x0 = np.einsum('zyxc,ix->zyic', coefs, wx, optimize=True)
+        x1 = np.einsum('zyxc,ix->zyic', coefs, dwx, optimize=True)
+        y00 = np.einsum('zyic,jy->zjic', x0, wy, optimize=True)
+        y01 = np.einsum('zyic,jy->zjic', x0, dwy, optimize=True)
+        y10 = np.einsum('zyic,jy->zjic', x1, wy, optimize=True)
+
+        displacement = np.einsum('zjic,kz->kjic', y00, wz, optimize=True).reshape(-1, 3)
+        dindex = np.stack([np.einsum('zjic,kz->kjic', y10, wz, optimize=True),
+                           np.einsum('zjic,kz->kjic', y01, wz, optimize=True),
+                           np.einsum('zjic,kz->kjic', y00, dwz, optimize=True)], axis=-1).reshape(-1, 3, 3)
+
+        jac = np.eye(3) + dindex @ self.point_to_index
+        return displacement, jac
+
+
+def spatial_jacobian(tform_file: Union[Path, str, ElastixTransform],
+                     jacmat: bool = False,
+                     deformation: bool = False,
+                     slab_voxels: int = SLAB_VOXELS) -> SpatialJacobian:
+    """
+    Compute the spatial jacobian determinants of an elastix transform on its output image grid
+
+    Parameters
+    ----------
+    tform_file
+        The elastix TransformParameters file. Initial transforms are included
+    jacmat
+        Also return the full jacobian matrices
+    deformation
+        Also return the deformation field
+    slab_voxels
+        Approximate number of voxels to evaluate at once. Limits the memory used
+
+    Returns
+    -------
+    SpatialJacobian. log_det is nan/-inf where the determinant is <= 0
+
+    Raises
+    ------
+    UnsupportedTransformError
+        If the transform is not supported (see module docstring)
+    """
+    if isinstance(tform_file, ElastixTransform):
+        tform = tform_file
+    else:
+        tform = ElastixTransform(tform_file)
+
+    shape = tform.shape
+    det = np.empty(shape, dtype=np.float32)
+    jacmat_arr = np.empty(shape + (9,), dtype=np.float32) if jacmat else None
+    def_arr = np.empty(shape + (3,), dtype=np.float32) if deformation else None
+
+    slab = max(1, slab_voxels // (shape[1] * shape[2]))
+
+    for z0 in range(0, shape[0], slab):
+        z1 = min(z0 + slab, shape[0])
+        mapped, jac = tform.map_grid(z0, z1)
+
+        det[z0: z1] = np.linalg.det(jac).reshape((z1 - z0,) + shape[1:])
+        if jacmat:
+            jacmat_arr[z0: z1] = jac.reshape((z1 - z0,) + shape[1:] + (9,))
+        if deformation:
+            def_arr[z0: z1] = (mapped - tform.grid_points(z0, z1)).reshape((z1 - z0,) + shape[1:] + (3,))
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        log_det = np.log(det)
+
+    return SpatialJacobian(det, log_det, jacmat_arr, def_arr)
+
+
+def write_image(array: np.ndarray, tform: ElastixTransform, path: Union[Path, str], compressed=True):
+    """
+    Write an array from spatial_jacobian with the geometry of the transform's output grid, as transformix would.
+    Arrays with a 4th dimension are written as vector images
+    """
+    img = sitk.GetImageFromArray(array, isVector=array.ndim == 4)
+    img.SetSpacing(tform.spacing.tolist())
+    img.SetOrigin(tform.origin.tolist())
+    img.SetDirection(tform.direction.ravel().tolist())
+    sitk.WriteImage(img, str(path), compressed)
+
+
+def _direction(values) -> np.ndarray:
+    """
+    elastix writes direction cosines column by column
+    """
+    if values is None:
+        return np.eye(3)
+    return np.array(values, dtype=float).reshape(3, 3).T
+
+
+def _bspline_weights(cindex: np.ndarray, grid_size) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Cubic B-spline weights for continuous control point indices
+
+    Returns
+    -------
+    start
+        index of the first of the 4 supporting control points
+    w, dw
+        the 4 weights and their derivatives. Shape of cindex + (4,)
+    inside
+        Whether the support of the index is within the control point grid
+    """
+    base = np.floor(cindex)
+    f = (cindex - base)[..., None]
+    w = np.concatenate([(1 - f) ** 3 / 6,
+                        (3 * f ** 3 - 6 * f ** 2 + 4) / 6,
+                        (-3 * f ** 3 + 3 * f ** 2 + 3 * f + 1) / 6,
+                        f ** 3 / 6], axis=-1)
+    dw = np.concatenate([-(1 - f) ** 2 / 2,
+                         (3 * f ** 2 - 4 * f) / 2,
+                         (-3 * f ** 2 + 2 * f + 1) / 2,
+                         f ** 2 / 2], axis=-1)
+    inside = (cindex >= 1) & (cindex < np.asarray(grid_size) - 2)
+    return base.astype(int) - 1, w, dw, inside
+
+
+def _axis_weights(cindex: np.ndarray, grid_size: int) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The B-spline weights and derivatives along one axis as (n, grid_size) matrices.
+    Rows for indices outside the control point grid are 0
+    """
+    start, w, dw, inside = _bspline_weights(cindex, grid_size)
+    rows = np.arange(len(cindex))[inside, None]
+    cols = start[inside, None] + np.arange(4)
+
+    weights = np.zeros((len(cindex), grid_size))
+    derivatives = np.zeros((len(cindex), grid_size))
+    weights[rows, cols] = w[inside]
+    derivatives[rows, cols] = dw[inside]
+    return weights, derivatives
+
+
+def _linear_transform(transform_type: str, coefs: np.ndarray, p: dict) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    The matrix A and translation t of a linear transform, such that T(x) = Ax + t
+    """
+    center = np.array(p.get('CenterOfRotationPoint', [0, 0, 0]), dtype=float)
+
+    if transform_type == 'TranslationTransform':
+        return np.eye(3), coefs[:3]
+
+    if transform_type == 'EulerTransform':
+        rx, ry, rz = coefs[:3]
+        translation = coefs[3:6]
+        rot_x = np.array([[1, 0, 0], [0, np.cos(rx), -np.sin(rx)], [0, np.sin(rx), np.cos(rx)]])
+        rot_y = np.array([[np.cos(ry), 0, np.sin(ry)], [0, 1, 0], [-np.sin(ry), 0, np.cos(ry)]])
+        rot_z = np.array([[np.cos(rz), -np.sin(rz), 0], [np.sin(rz), np.cos(rz), 0], [0, 0, 1]])
+        if p.get('ComputeZYX', ['false'])[0] == 'true':
+            matrix = rot_z @ rot_y @ rot_x
+        else:
+            matrix = rot_z @ rot_x @ rot_y
+
+    elif transform_type == 'SimilarityTransform':
+        x, y, z = coefs[:3]  # Versor
+        translation = coefs[3:6]
+        s = coefs[6]
+        w = np.sqrt(max(0.0, 1 - (x * x + y * y + z * z)))
+        matrix = s * np.array([[1 - 2 * (y * y + z * z), 2 * (x * y - z * w), 2 * (x * z + y * w)],
+                               [2 * (x * y + z * w), 1 - 2 * (x * x + z * z), 2 * (y * z - x * w)],
+                               [2 * (x * z - y * w), 2 * (y * z + x * w), 1 - 2 * (x * x + y * y)]])
+    else:  # AffineTransform
+        matrix = coefs[:9].reshape(3, 3)
+        translation = coefs[9:12]
+
+    # T(x) = A(x - c) + c + t
+    return matrix, translation + center - matrix @ center
@@ -1,8 +1,25 @@
+import threading
+from typing import Tuple
+
 import numpy as np
 import SimpleITK as sitk
-import numpy as np
 from scipy import ndimage
+from scipy import fft as sp_fft
+
+# Kernels are truncated at this many standard deviations (as in ndimage.gaussian_filter)
+GAUSSIAN_TRUNCATE = 4.0
 
+# When method='auto', use FFT convolution for kernels at least this wide (in voxels). Narrower kernels use the
+# separable spatial filter
+FFT_MIN_KERNEL_WIDTH = 41
+
+
+def fwhm_to_sigma(fwhm: float, voxel_size: float) -> float:
+    """
+    Convert a full width at half maximum in um to a Gaussian standard deviation in voxels
+    """
+    fwhm_in_voxels = fwhm / voxel_size
+    return fwhm_in_voxels / np.sqrt(8. * np.log(2))  # sigma for this FWHM
 
 
 def blur(img: np.ndarray, fwhm: float, voxel_size: float) -> np.ndarray:
@@ -13,9 +30,166 @@ def blur(img: np.ndarray, fwhm: float, voxel_size: float) -> np.ndarray:
     ----------
 
     """
-    fwhm_in_voxels = fwhm / voxel_size
-
-    sd = fwhm_in_voxels / np.sqrt(8. * np.log(2))  # sigma for this FWHM
-    blurred = ndimage.filters.gaussian_filter(img, sd, mode='constant', cval=0.0)
+    sd = fwhm_to_sigma(fwhm, voxel_size)
+    blurred = ndimage.gaussian_filter(img, sd, mode='constant', cval=0.0)
 
     return blurred
+
+
+class MaskedGaussianBlur:
+    """
+    Gaussian blur a series of volumes and return only the voxels within a mask.
+
+    For float input, gives the same values as blur(img, fwhm, voxel_size)[mask != 0] to float32 precision, but
+        - works in float32 and always returns float32. For integer input this differs from blur(), which returns the
+          input dtype with the blurred values truncated towards zero
+        - only computes over the bounding box of the mask, padded by the kernel radius. The padding means voxels in
+          the mask see the same neighbourhood as when blurring the full volume
+        - uses separable spatial convolution for small kernels and FFT convolution for large ones
+        - reuses its scratch buffers between calls. These are per-thread so one instance can be shared by
+          loader threads
+    """
+    def __init__(self, mask: np.ndarray, fwhm: float, voxel_size: float, method: str = 'auto'):
+        """
+        Parameters
+        ----------
+        mask
+            3D mask. All the volumes to be blurred must be this shape
+        fwhm
+            Full width at half maximum of the blur in um
+        voxel_size
+            Voxel size in um
+        method
+            'spatial', 'fft' or 'auto' (choose by kernel width)
+        """
+        if method not in ('auto', 'spatial', 'fft'):
+            raise ValueError(f"blur method must be 'auto', 'spatial' or 'fft', not {method}")
+
+        self.shape = mask.shape
+        self.sigma = fwhm_to_sigma(fwhm, voxel_size)
+        self.radius = int(GAUSSIAN_TRUNCATE * self.sigma + 0.5)
+
+        if method == 'auto':
+            method = 'fft' if 2 * self.radius + 1 >= FFT_MIN_KERNEL_WIDTH else 'spatial'
+        self.method = method
+
+        mask = mask != 0
+        self.n_voxels = int(np.count_nonzero(mask))
+
+        # The padded bounding box of the mask, and the position of the mask within it
+        self.crop, inner = self._padded_bbox(mask, self.radius)
+        self.inner = inner
+        self.crop_mask = mask[self.crop][inner]
+
+        self._local = threading.local()
+        self._kernel_fft = None
+
+        if self.method == 'fft':
+            crop_shape = tuple(s.stop - s.start for s in self.crop)
+            # Zero pad by the kernel radius so the circular convolution does not wrap
+            self.fft_shape = tuple(sp_fft.next_fast_len(n + 2 * self.radius, real=True) for n in crop_shape)
+            self._kernel_fft = self._gaussian_kernel_fft()
+
+    @staticmethod
+    def _padded_bbox(mask: np.ndarray, radius: int) -> Tuple[Tuple[slice, ...], Tuple[slice, ...]]:
+        """
+        Returns
+        -------
+        crop
+            slices of the mask bounding box padded by radius (clipped to the volume)
+        inner
+            slices of the bounding box within the crop
+        """
+        crop = []
+        inner = []
+
+        for axis in range(mask.ndim):
+            other_axes = tuple(a for a in range(mask.ndim) if a != axis)
+            present = np.flatnonzero(mask.any(axis=other_axes))
+
+            if present.size == 0:  # Empty mask
+                lo, hi = 0, 0
+            else:
+                lo, hi = present[0], present[-1] + 1
+
+            start = max(lo - radius, 0)
+            stop = min(hi + radius, mask.shape[axis])
+            crop.append(slice(start, stop))
+            inner.append(slice(lo - start, hi - start))
+
+        return tuple(crop), tuple(inner)
+
+    def _gaussian_kernel_fft(self) -> np.ndarray:
+        """
+        The spectrum of the separable 3D kernel, as the outer product of the 1D kernel spectra
+        """
+        x = np.arange(-self.radius, self.radius + 1)
+        kernel_1d = np.exp(-0.5 * (x / self.sigma) ** 2)
+        kernel_1d /= kernel_1d.sum()
+
+        kernel_fft = None
+        last_axis = len(self.fft_shape) - 1
+
+        for axis, n in enumerate(self.fft_shape):
+            padded = np.zeros(n, dtype=np.float32)
+            padded[:kernel_1d.size] = kernel_1d
+
+            k = sp_fft.rfft(padded) if axis == last_axis else sp_fft.fft(padded)
+
+            view_shape = [1] * len(self.fft_shape)
+            view_shape[axis] = k.size
+            k = k.reshape(view_shape)
+
+            kernel_fft = k if kernel_fft is None else kernel_fft * k
+
+        return kernel_fft.astype(np.complex64)
+
+    def _scratch(self) -> np.ndarray:
+        """
+        The float32 buffer for the cropped volume, one per thread
+        """
+        buf = getattr(self._local, 'buf', None)
+
+        if buf is None:
+            buf = np.empty(tuple(s.stop - s.start for s in self.crop), dtype=np.float32)
+            self._local.buf = buf
+
+        return buf
+
+    def __call__(self, img: np.ndarray, out: np.ndarray = None) -> np.ndarray:
+        """
+        Parameters
+        ----------
+        img
+            3D volume, same shape as the mask
+        out
+            1D array to write the blurred, masked voxels into. If None a new float32 array is made
+
+        Returns
+        -------
+        1D array of the blurred voxels within the mask, in the same order as img[mask]
+        """
+        if img.shape != self.shape:
+            raise ValueError(f'volume shape {img.shape} does not match the mask shape {self.shape}')
+
+        if out is None:
+            out = np.empty(self.n_voxels, dtype=np.float32)
+
+        buf = self._scratch()
+        np.copyto(buf, img[self.crop], casting='unsafe')
+
+        if self.method == 'fft':
+            spectrum = sp_fft.rfftn(buf, s=self.fft_shape)
+            spectrum *= self._kernel_fft
+            blurred = sp_fft.irfftn(spectrum, s=self.fft_shape)
+            # The output for crop voxel i is at i + radius in the linear convolution
+            r = self.radius
+            blurred = blurred[tuple(slice(s.start + r, s.stop + r) for s in self.inner)]
+        else:
+            ndimage.gaussian_filter(buf, self.sigma, output=buf, mode='constant', cval=0.0,
+                                    truncate=GAUSSIAN_TRUNCATE)
+            blurred = buf[self.inner]
+
+        out[...] = blurred[self.crop_mask]
+
+        return out
@@ -9,16 +9,18 @@ Get organ volumes from a bunch or inverted label maps
 import os
 from os.path import split
 from pathlib import Path
-from typing import List
+from typing import List, Tuple
+from concurrent.futures import ThreadPoolExecutor
 
-import addict
+import numpy as np
 import SimpleITK as sitk
 import pandas as pd
 
 from lama.common import get_file_paths, get_images_ignore_elx_itermediates
 
 
-def label_sizes(label_dir: Path, outpath: Path, mask_dir=None):
+def label_sizes(label_dir: Path, outpath: Path, mask_dir=None, normalise_to_labels: bool = False,
+                threads: int = None):
     """
     Given a directory of labelmaps and whole embryo masks, generate a csv file containing organ volumes normalised to
     mask size
@@ -31,16 +33,24 @@ def label_sizes(label_dir: Path, outpath: Path, mask_dir=None):
         directory containing (inverted) masks - can be in subdirectories
     outpath: str
         path to save generated csv
+    normalise_to_labels
+        If no mask_dir, normalise to the number of labelled voxels instead. This is the same as using a mask of the
+        nonzero label region, but is computed from the same counts so the masks are not read
+    threads
+        Number of label maps to read and count at once. If None, the number of cpus
 
     """
-    label_df = _get_label_sizes(get_images_ignore_elx_itermediates(label_dir))
+    label_df, labelled = _label_counts(get_images_ignore_elx_itermediates(label_dir), threads)
 
     if mask_dir:
 
-        mask_df = _get_label_sizes(get_file_paths(mask_dir))
+        mask_df = _get_label_sizes(get_file_paths(mask_dir), threads)
 
         label_df = label_df.divide(mask_df[1], axis=0)
 
+    elif normalise_to_labels:
+        label_df = label_df.divide(labelled, axis=0)
+
     try:
         label_df.to_csv(outpath)
     except PermissionError:
@@ -48,7 +58,7 @@ def label_sizes(label_dir: Path, outpath: Path, mask_dir=None):
         label_df.to_csv(outpath)
 
 
-def _get_label_sizes(paths: List[Path]) ->pd.DataFrame:
+def _get_label_sizes(paths: List[Path], threads: int = None) -> pd.DataFrame:
     """
     Get the organ volumes for a bunch of of specimens and output a csv
 
@@ -56,6 +66,8 @@ def _get_label_sizes(paths: List[Path]) ->pd.DataFrame:
     ----------
     paths: list
         paths to labelmap volumes
+    threads
+        Number of label maps to read and count at once. If None, the number of cpus
 
     Returns
     -------
@@ -63,27 +75,56 @@ def _get_label_sizes(paths: List[Path]) ->pd.DataFrame:
         columns: label (organ)
         rows: specimen ids
     """
+    return _label_counts(paths, threads)[0]
+
+
+def _label_counts(paths: List[Path], threads: int = None) -> Tuple[pd.DataFrame, pd.Series]:
+    """
+    Voxel counts of each label, from a single np.bincount over each label map. The label maps are read and counted in
+    a thread pool (reading and bincount are in C)
+
+    Returns
+    -------
+    The label counts as from _get_label_sizes. Labels above the largest label of a specimen are NaN.
+    The number of labelled (nonzero) voxels of each specimen
+    """
+    paths = list(paths)
+    if not paths:
+        return pd.DataFrame(), pd.Series(dtype=float)
 
-    label_volumes = addict.Dict()
-    n = 1
+    # Get the name of the volume from its folder
+    volnames = [os.path.split(split(label_path)[0])[1] for label_path in paths]
 
-    for label_path in paths:
+    with ThreadPoolExecutor(max_workers=threads or os.cpu_count() or 1) as pool:
+        counts = list(pool.map(_count_labels, paths))
 
-        n += 1
-        # Get the name of the volume
-        volname = os.path.split(split(label_path)[0])[1]
-        labelmap = sitk.ReadImage(str(label_path))
-        arr = sitk.GetArrayFromImage(labelmap)
-        max_label = int(arr.max())
+    n_labels = max(len(c) for c in counts) - 1
+    if n_labels < 1:
+        return pd.DataFrame(index=volnames), pd.Series(0, index=volnames)
 
-        lsf = sitk.LabelStatisticsImageFilter()
-        labelmap = sitk.Cast(labelmap, sitk.sitkUInt16)
-        lsf.Execute(labelmap, labelmap)
-        # max_label = lsf.GetMaximum()
-        for i in range(1, max_label + 1):
-            voxel_count = lsf.GetCount(i)
-            label_volumes[volname][i] = voxel_count
-    return pd.DataFrame(label_volumes.to_dict()).T
+    # Specimen x label count matrix. Label 0 is the background
+    matrix = np.full((len(counts), n_labels), np.nan)
+    for row, c in zip(matrix, counts):
+        row[: len(c) - 1] = c[1:]
+
+    labelled = pd.Series([c[1:].sum() for c in counts], index=volnames)
+
+    label_df = pd.DataFrame(matrix, index=volnames, columns=range(1, n_labels + 1))
+    if not np.isnan(matrix).any():
+        label_df = label_df.astype(np.int64)
+
+    return label_df, labelled
+
+
+def _count_labels(label_path: Path) -> np.ndarray:
+    """
+    Voxel counts of labels 0 to the largest label in a label map
+    """
+    labelmap = sitk.ReadImage(str(label_path))
+    arr = sitk.GetArrayViewFromImage(labelmap)
+    # As LabelStatisticsImageFilter on the map cast to UInt16
+    arr = arr.astype(np.uint16, copy=False)
+    return np.bincount(arr.ravel())
 
 
 if __name__ == '__main__':
@@ -97,4 +138,4 @@ if __name__ == '__main__':
                         help='Path to save results csv to', type=str,required=True)
     args = parser.parse_args()
 
-    label_sizes(args.label_dir, args.mask_dir, args.out_path)
+    label_sizes(args.label_dir, args.out_path, args.mask_dir)
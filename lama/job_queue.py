@@ -0,0 +1,366 @@
+"""
+A job queue shared by several machines through a common (usually NFS) directory. Used by lama_job_runner.
+
+Each job is an entry in a list (eg. a relative path to a specimen input). The queue state lives in a directory:
+
+    <queue_dir>/
+        jobs.json           the job list. Written once when the queue is made
+        claims/<idx>.<n>    the claim for attempt n of job idx
+        done/<idx>.json     the final status of job idx
+
+Claims
+------
+A claim file is created with O_CREAT | O_EXCL, which is atomic (also on NFS v3+), so only one worker can take each
+attempt of a job. No lock on the whole queue is needed.
+
+The claim file's modification time is its heartbeat. While a job runs, a background thread touches the claim every
+heartbeat_interval seconds. If a claim has not been touched for lease_timeout seconds the worker is assumed to have
+died, and the job can be claimed again by creating the claim for the next attempt. As each attempt has its own file,
+taking over a stale claim does not involve deleting anything and is race free.
+
+Times are compared using file modification times written by the file server, so clock differences between hosts do
+not matter.
+
+Retries
+-------
+A job that fails or stops heartbeating is retried until it has been attempted max_attempts times, after which it is
+recorded as failed.
+
+Per-host concurrency
+--------------------
+The number of workers on a host can be limited by using host_slot(), which takes one of n local (not NFS) locks. These
+are released by the OS if the worker dies.
+"""
+
+from pathlib import Path
+from typing import List, Union, Optional, Iterator
+from contextlib import contextmanager
+from datetime import datetime
+import hashlib
+import json
+import os
+import socket
+import tempfile
+import threading
+
+from filelock import FileLock, Timeout
+from logzero import logger as logging
+import pandas as pd
+
+HEARTBEAT_INTERVAL = 60  # seconds
+LEASE_TIMEOUT = 600  # seconds without a heartbeat after which a job is requeued
+MAX_ATTEMPTS = 2
+
+TIME_FORMAT = '%Y-%m-%d %H:%M:%S'
+
+
+class Job:
+    """
+    A claimed attempt of a job
+    """
+    def __init__(self, idx: int, job: str, attempt: int, claim_file: Path):
+        self.idx = idx
+        self.job = job
+        self.attempt = attempt
+        self.claim_file = claim_file
+
+    def __repr__(self):
+        return f'Job({self.idx}, {self.job}, attempt {self.attempt})'
+
+
+class JobQueue:
+    def __init__(self,
+                 queue_dir: Path,
+                 lease_timeout: float = LEASE_TIMEOUT,
+                 heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                 max_attempts: int = MAX_ATTEMPTS):
+        """
+        Parameters
+        ----------
+        queue_dir
+            The queue directory. Made with JobQueue.create
+        lease_timeout
+            Seconds without a heartbeat after which a running job is considered dead and requeued
+        heartbeat_interval
+            Seconds between heartbeats of a running job. Should be well below lease_timeout
+        max_attempts
+            Number of times a job is tried before it is recorded as failed
+        """
+        self.queue_dir = Path(queue_dir)
+        self.claims_dir = self.queue_dir / 'claims'
+        self.done_dir = self.queue_dir / 'done'
+        self.lease_timeout = lease_timeout
+        self.heartbeat_interval = heartbeat_interval
+        self.max_attempts = max_attempts
+        self.host = socket.gethostname()
+
+        jobs_file = self.queue_dir / 'jobs.json'
+        if not jobs_file.is_file():
+            raise FileNotFoundError(f'{jobs_file} not found. Make the job queue first')
+
+        with open(jobs_file, 'r') as fh:
+            self.jobs: List[str] = json.load(fh)
+
+    @classmethod
+    def create(cls, queue_dir: Path, jobs: List[str], done: Optional[dict] = None, **kwargs) -> 'JobQueue':
+        """
+        Make a new queue, replacing any existing one in queue_dir
+
+        Parameters
+        ----------
+        queue_dir
+        jobs
+            The job list
+        done
+            Optional {job index: status} for jobs that have already been run
+        kwargs
+            passed to JobQueue()
+        """
+        queue_dir = Path(queue_dir)
+
+        for sub_dir in ('claims', 'done'):
+            (queue_dir / sub_dir).mkdir(parents=True, exist_ok=True)
+            for f in (queue_dir / sub_dir).iterdir():
+                f.unlink()
+
+        _write_atomic(queue_dir / 'jobs.json', json.dumps(list(jobs), indent=1))
+
+        queue = cls(queue_dir, **kwargs)
+
+        for idx, status in (done or {}).items():
+            queue._write_done(idx, {'status': status, 'host': '_', 'start_time': '_', 'end_time': '_',
+                                    'attempts': 0})
+
+        return queue
+
+    def _now(self) -> float:
+        """
+        The current time according to the file server
+        """
+        clock = self.queue_dir / f'.clock_{self.host}'
+        clock.touch()
+        return clock.stat().st_mtime
+
+    def _claims(self) -> dict:
+        """
+        Returns
+        -------
+        {job index: highest attempt claimed}
+        """
+        claims = {}
+        for f in os.listdir(self.claims_dir):
+            try:
+                idx, attempt = map(int, f.split('.'))
+            except ValueError:
+                continue
+            claims[idx] = max(attempt, claims.get(idx, 0))
+        return claims
+
+    def _done(self) -> dict:
+        done = {}
+        for f in self.done_dir.glob('*.json'):
+            try:
+                with open(f, 'r') as fh:
+                    done[int(f.stem)] = json.load(fh)
+            except (ValueError, OSError):  # Being written
+                continue
+        return done
+
+    def _claim_file(self, idx: int, attempt: int) -> Path:
+        return self.claims_dir / f'{idx}.{attempt}'
+
+    def _is_stale(self, claim_file: Path, now: float) -> bool:
+        try:
+            return now - claim_file.stat().st_mtime > self.lease_timeout
+        except FileNotFoundError:
+            return False
+
+    def _write_done(self, idx: int, record: dict):
+        _write_atomic(self.done_dir / f'{idx}.json', json.dumps(record))
+
+    def _read_claim(self, claim_file: Path) -> dict:
+        try:
+            with open(claim_file, 'r') as fh:
+                return json.load(fh)
+        except (ValueError, OSError):
+            return {}
+
+    def claim(self) -> Optional[Job]:
+        """
+        Claim the next job to run. That is the first job that has not been claimed, or whose last claim has
+        gone stale.
+
+        Returns
+        -------
+        The claimed job or None if there are no jobs available at the moment (see finished())
+        """
+        claims = self._claims()
+        done = self._done()
+        now = self._now()
+
+        for idx, job in enumerate(self.jobs):
+            if idx in done:
+                continue
+
+            attempt = claims.get(idx, 0)
+
+            if attempt > 0:
+                last_claim = self._claim_file(idx, attempt)
+                if not self._is_stale(last_claim, now):
+                    continue  # Running
+
+                if attempt >= self.max_attempts:
+                    info = self._read_claim(last_claim)
+                    logging.warning(f'{job} has been tried {attempt} times. Marking as failed')
+                    self._write_done(idx, {'status': 'failed', 'host': info.get('host', '_'),
+                                           'start_time': info.get('start_time', '_'),
+                                           'end_time': datetime.now().strftime(TIME_FORMAT),
+                                           'attempts': attempt})
+                    continue
+
+                logging.info(f'Requeuing {job}. Attempt {attempt} failed or stopped responding')
+
+            claim_file = self._claim_file(idx, attempt + 1)
+            try:
+                fd = os.open(claim_file, os.O_CREAT | os.O_EXCL | os.O_WRONLY)
+            except FileExistsError:
+                continue  # Another worker got there first
+
+            with os.fdopen(fd, 'w') as fh:
+                json.dump({'host': self.host, 'pid': os.getpid(),
+                           'start_time': datetime.now().strftime(TIME_FORMAT)}, fh)
+
+            return Job(idx, job, attempt + 1, claim_file)
+
+        return None
+
+    def finished(self) -> bool:
+        """
+        True if all jobs have a final status
+        """
+        return len(self._done()) == len(self.jobs)
+
+    def finish(self, job: Job, status: str):
+        """
+        Record the result of a job.
+
+        If the job failed and has attempts left, it is released straight away so another worker can retry it.
+        """
+        claims = self._claims()
+        if claims.get(job.idx, 0) > job.attempt:
+            logging.warning(f'{job} was presumed dead and requeued. Not recording its status')
+            return
+
+        if status == 'failed' and job.attempt < self.max_attempts:
+            # Make the claim stale so it is picked up by the next claim()
+            os.utime(job.claim_file, (0, 0))
+            return
+
+        info = self._read_claim(job.claim_file)
+        self._write_done(job.idx, {'status': status, 'host': self.host, 'start_time': info.get('start_time', '_'),
+                                   'end_time': datetime.now().strftime(TIME_FORMAT), 'attempts': job.attempt})
+
+    def release(self, job: Job):
+        """
+        Give up a job without using up an attempt. Eg. when the worker is stopped by the user
+        """
+        try:
+            job.claim_file.unlink()
+        except FileNotFoundError:
+            pass
+
+    @contextmanager
+    def heartbeat(self, job: Job) -> Iterator[None]:
+        """
+        Keep the claim on a job alive while running the body of the with block
+        """
+        stop = threading.Event()
+
+        def beat():
+            while not stop.wait(self.heartbeat_interval):
+                try:
+                    os.utime(job.claim_file, None)
+                except OSError as e:  # Eg. an NFS hiccup. Try again at the next beat
+                    logging.warning(f'heartbeat failed for {job}: {e}')
+
+        thread = threading.Thread(target=beat, daemon=True)
+        thread.start()
+        try:
+            yield
+        finally:
+            stop.set()
+            thread.join()
+
+    def status(self) -> pd.DataFrame:
+        """
+        The state of each job in the format of the old lama_jobs.csv, with an extra attempts column.
+        """
+        claims = self._claims()
+        done = self._done()
+        now = self._now()
+
+        records = []
+        for idx, job in enumerate(self.jobs):
+            if idx in done:
+                d = done[idx]
+                records.append([job, d['status'], d['host'], d['start_time'], d['end_time'], d['attempts']])
+                continue
+
+            attempt = claims.get(idx, 0)
+            if attempt == 0:
+                records.append([job, 'to_run', '_', '_', '_', 0])
+                continue
+
+            claim_file = self._claim_file(idx, attempt)
+            info = self._read_claim(claim_file)
+            status = 'to_run' if self._is_stale(claim_file, now) else 'running'
+            records.append([job, status, info.get('host', '_'), info.get('start_time', '_'), '_', attempt])
+
+        return pd.DataFrame.from_records(records,
+                                         columns=['job', 'status', 'host', 'start_time', 'end_time', 'attempts'])
+
+    def export_csv(self, csv_path: Path):
+        """
+        Write the status() table. Only a view of the queue. Edits to the csv are not read back
+        """
+        _write_atomic(csv_path, self.status().to_csv())
+
+
+@contextmanager
+def host_slot(queue_dir: Path, max_per_host: Union[int, None]) -> Iterator[bool]:
+    """
+    Take one of max_per_host slots for this host. Yields False if none are free.
+
+    The slots are local OS locks so are released if the process dies
+    """
+    if not max_per_host:
+        yield True
+        return
+
+    key = hashlib.sha1(str(Path(queue_dir).resolve()).encode()).hexdigest()[:12]
+    tmp = Path(tempfile.gettempdir())
+
+    for i in range(max_per_host):
+        lock = FileLock(str(tmp / f'lama_job_queue_{key}_{i}.lock'))
+        try:
+            lock.acquire(timeout=0)
+        except Timeout:
+            continue
+        try:
+            yield True
+        finally:
+            lock.release()
+        return
+
+    yield False
+
+
+def _write_atomic(path: Path, text: str):
+    """
+    Write to a temporary file and rename so readers never see a partial file
+    """
+    path = Path(path)
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'w') as fh:
+        fh.write(text)
+    os.replace(tmp, path)
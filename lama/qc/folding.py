@@ -1,40 +1,79 @@
 import numpy as np
 import pandas as pd
 from lama import common
-from typing import Union
+from typing import Union, List, Tuple
 from pathlib import Path
+from logzero import logger as logging
 
 
-def folding_report(jac_array, label_map: np.ndarray, label_info: Union[pd.DataFrame, str, Path] = None, outdir=None):
+def folding_report(neg_jacs: List[Tuple[str, str, np.ndarray]],
+                   label_map: np.ndarray = None,
+                   label_info: Union[pd.DataFrame, str, Path] = None,
+                   outdir=None):
     """
-    Write out csv detailing the presence of folding per organ
+    Write out csv detailing the presence of folding per organ for each specimen with folding
+
+    Parameters
+    ----------
+    neg_jacs
+        (specimen_id, deformation_id, jacobian determinant array) for each specimen with negative jacobians.
+        As returned by deformations.make_deformations_at_different_scales
+    label_map
+        Labels in the space of the jacobians (the fixed image). If None, each specimen gets one row for the whole volume
+    label_info
+        Adds the label names to the report
+    outdir
+        Where to write the report. If None, the report is returned
     """
-    if jac_array is None:
+    if not neg_jacs:
         return
-    labels = np.unique(label_map)
 
-    if not isinstance(label_info, pd.DataFrame):
-        label_info = pd.read_csv(label_info, index_col=0)
+    if label_info is not None and not isinstance(label_info, pd.DataFrame):
+        label_info = pd.read_csv(label_info, index_col=0) if label_info else None
 
-    result = []
-    for label in labels:
-        # print(label)
-        if label == 0:
+    tables = []
+    for specimen_id, deformation_id, jac_array in neg_jacs:
+        if label_map is None:
+            labels = np.ones(jac_array.shape, dtype=np.uint8)
+        elif label_map.shape != jac_array.shape:
+            logging.warning(f'Label map shape {label_map.shape} does not match the jacobians of {specimen_id} '
+                            f'{jac_array.shape}. Not included in the folding report')
             continue
-        jac_label = jac_array[label_map == label]
-        label_size = jac_label.size
-        num_neg_vox = jac_label[jac_label < 0].size
-        total_folding = np.sum(jac_label[jac_label < 0])
-        result.append([label, label_size, num_neg_vox, total_folding])
+        else:
+            labels = label_map
+
+        df = _label_folding(jac_array, labels)
+        df.insert(0, 'deformation_id', deformation_id)
+        df.insert(0, 'specimen', specimen_id)
+        tables.append(df)
 
-    df = pd.DataFrame.from_records(result)
-    df.columns = ['label', 'label_size', 'num_neg_voxels', 'summed_folding']
-    df.set_index('label', drop=True, inplace=True)
+    if not tables:
+        return
+
+    df = pd.concat(tables)
 
     if label_info is not None:
-        df = df.merge(label_info[['label_name']], left_index=True, right_index=True)
+        df = df.merge(label_info[['label_name']], left_on='label', right_index=True, how='left')
 
     if outdir:
-        df.to_csv(outdir / common.FOLDING_FILE_NAME)
+        df.to_csv(Path(outdir) / common.FOLDING_FILE_NAME, index=False)
     else:
-        return df
\ No newline at end of file
+        return df
+
+
+def _label_folding(jac_array: np.ndarray, label_map: np.ndarray) -> pd.DataFrame:
+    """
+    Size, number of negative voxels and summed negative jacobians of each non-zero label
+    """
+    labels, inverse = np.unique(label_map, return_inverse=True)
+    inverse = inverse.ravel()
+    jacs = jac_array.ravel()
+    neg = jacs < 0
+
+    label_size = np.bincount(inverse, minlength=len(labels))
+    num_neg_vox = np.bincount(inverse[neg], minlength=len(labels))
+    total_folding = np.bincount(inverse[neg], weights=jacs[neg], minlength=len(labels))
+
+    df = pd.DataFrame({'label': labels, 'label_size': label_size, 'num_neg_voxels': num_neg_vox,
+                       'summed_folding': total_folding})
+    return df[df.label != 0]
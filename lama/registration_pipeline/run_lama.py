@@ -33,6 +33,14 @@ Config file
     pad_dims: true # Pads all the volumes so all are the same dimensions. Finds the largest dimension from each volume
     pad_dims: [300, 255, 225]  # this specifies the dimensions tyo pad to
     threads: 10  # number of cpu cores to use
+    parallel_registrations: 0  # number of elastix processes to run at once, sharing the threads. 0 chooses automatically
+    registration_fail_fast: true  # false: carry on with the other specimens if a registration fails
+    resume: true  # on a rerun, skip stages, specimens and later steps already done with the same inputs and parameters.
+                  # The output folders are kept rather than cleared. false: clear them and redo everything (the
+                  # behaviour before resume was added)
+    jacobian_method: native  # native: compute the jacobians from the transform parameters. transformix: use transformix
+    parallel_deformations: 0  # number of specimens to generate jacobians for at once. 0 chooses automatically
+    propagation_method: native  # native: resample labels against a cached displacement field. transformix: use transformix
     filetype: nrrd  # the output file format - nrrd, nii, tiff
     compress_averages: true  # compress the averages to save disk space
     generate_new_target_each_stage: true  # true for creating an average. false for phenotype detection
@@ -111,6 +119,8 @@ import sys
 from pathlib import Path
 import signal
 import shutil
+import hashlib
+from typing import Tuple
 
 from lama.elastix.propagate_volumes import PropagateLabelMap, PropagateMeshes
 from lama.elastix.invert_transforms import batch_invert_transform_parameters
@@ -118,6 +128,7 @@ from lama.elastix.reverse_registration import reverse_registration
 from lama.img_processing.organ_vol_calculation import label_sizes
 from lama.img_processing import glcm3d
 from lama.registration_pipeline.validate_config import LamaConfig, LamaConfigError
+from lama.checkpoints import Checkpoints, CHECKPOINT_DIR
 from lama.elastix.deformations import make_deformations_at_different_scales
 from lama.qc.metric_charts import make_charts
 from lama.elastix.elastix_registration import TargetBasedRegistration, PairwiseBasedRegistration
@@ -125,7 +136,7 @@ from lama.staging import staging_metric_maker
 from lama.qc.qc_images import make_qc_images
 from lama.qc.folding import folding_report
 from lama.stats.standard_stats.data_loaders import DEFAULT_FWHM, DEFAULT_VOXEL_SIZE
-from lama.elastix import PROPAGATE_CONFIG, REG_DIR_ORDER_CFG
+from lama.elastix import PROPAGATE_CONFIG, REG_DIR_ORDER_CFG, RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR
 from lama.monitor_memory import MonitorMemory
 from lama.common import cfg_load
 from lama.segmentation_plugins import plugin_interface
@@ -162,10 +173,14 @@ def run(configfile: Path):
         except Exception as e:
             raise(LamaConfigError(e))
 
-        config.mkdir('output_dir')
-        qc_dir = config.mkdir('qc_dir')
-        config.mkdir('average_folder')
-        config.mkdir('root_reg_dir')
+        # If resuming, keep the output from previous runs. Work is only redone if its inputs or parameters changed
+        resume = config['resume']
+        config.mkdir('output_dir', clobber=not resume)
+        qc_dir = config.mkdir('qc_dir', clobber=not resume)
+        config.mkdir('average_folder', clobber=not resume)
+        config.mkdir('root_reg_dir', clobber=not resume)
+
+        checkpoints = Checkpoints(config['output_dir'] / CHECKPOINT_DIR, enabled=resume)
 
         # TODO find the histogram batch code
         # if not config['no_qc']:
@@ -194,13 +209,34 @@ def run(configfile: Path):
         first_stage_only = config['skip_forward_registration']
         # If we only want the reverse label propagation we just need the initial rigid registration to act as the
         # Fixed image for the moving populaiton average
-        final_registration_dir = run_registration_schedule(config, first_stage_only=first_stage_only)
+        final_registration_dir = run_registration_schedule(config, first_stage_only=first_stage_only,
+                                                           checkpoints=checkpoints)
 
-        if not first_stage_only:
-            neg_jac = make_deformations_at_different_scales(config)
-            folding_report(neg_jac, config['output_dir'], config['label_info'], outdir=config['output_dir'])
+        # All the later steps depend on the registrations
+        reg_key = checkpoints.key({stage['stage_id']: checkpoints.keys.get(stage['stage_id'])
+                                   for stage in config['registration_stage_params']})
 
-            create_glcms(config, final_registration_dir)
+        if not first_stage_only:
+            deformation_parts = {'registration': reg_key,
+                                 'generate_deformation_fields': config['generate_deformation_fields'],
+                                 'write_deformation_vectors': config['write_deformation_vectors'],
+                                 'write_raw_jacobians': config['write_raw_jacobians'],
+                                 'write_log_jacobians': config['write_log_jacobians'],
+                                 'write_jacobian_matrices': config['write_jacobian_matrices'],
+                                 'label_map': checkpoints.file_hash(config['label_map']),
+                                 'label_info': checkpoints.file_hash(config['label_info'])}
+
+            if not checkpoints.step('deformations', deformation_parts):
+                neg_jacs = make_deformations_at_different_scales(config)
+                if neg_jacs:
+                    label_map = common.read_array(config['label_map']) if config['label_map'] else None
+                    folding_report(neg_jacs, label_map, config['label_info'], outdir=config['output_dir'])
+                checkpoints.mark_done('deformations', deformation_parts)
+
+            glcm_parts = {'registration': reg_key, 'glcm': config['glcm']}
+            if not checkpoints.step('glcms', glcm_parts):
+                create_glcms(config, final_registration_dir)
+                checkpoints.mark_done('glcms', glcm_parts)
 
         # Write out the names of the registration dirs in the order they were run
         with open(config['root_reg_dir'] / REG_DIR_ORDER_CFG, 'w') as fh:
@@ -212,35 +248,69 @@ def run(configfile: Path):
         if config['skip_transform_inversion']:
             logging.info('Skipping inversion of transforms')
         else:
-            logging.info('inverting transforms')
+            inversion_parts = {'registration': reg_key,
+                               'label_propagation': config['label_propagation'],
+                               'fixed_volume': checkpoints.file_hash(config['fixed_volume'])}
+
+            # Needed by the propagation, so redo the inversion if they have been deleted
+            inversion_outputs = [config['inverted_transforms'] / PROPAGATE_CONFIG]
+
+            if not checkpoints.step('inversion', inversion_parts, inversion_outputs):
+                logging.info('inverting transforms')
+
+                if config['label_propagation'] == 'reverse_registration':
+                    reverse_registration(config)
+                else:  # invert_transform method is the default
+                    batch_invert_transform_parameters(config)
 
-            if config['label_propagation'] == 'reverse_registration':
-                reverse_registration(config)
-            else:  # invert_transform method is the default
-                batch_invert_transform_parameters(config)
+                checkpoints.mark_done('inversion', inversion_parts)
 
-            logging.info('propagating volumes')
-            invert_volumes(config)
+            propagation_parts = {'inversion': checkpoints.keys['inversion'],
+                                 'stats_mask': checkpoints.file_hash(config['stats_mask']),
+                                 'label_map': checkpoints.file_hash(config['label_map']),
+                                 'propagation_method': config['propagation_method']}
+
+            if not checkpoints.step('propagation', propagation_parts):
+                logging.info('propagating volumes')
+                invert_volumes(config)
+                checkpoints.mark_done('propagation', propagation_parts)
 
             # Now that labels have been inverted, should we delete the transorm files?
-            if config['delete_inverted_transforms']:
+            if config['delete_inverted_transforms'] and config['inverted_transforms'].is_dir():
                 shutil.rmtree(config['output_dir'] / 'inverted_transforms')
 
             if config['label_map']:
 
-                generate_organ_volumes(config)
+                organ_vol_parts = {'propagation': checkpoints.keys['propagation'],
+                                   'seg_plugin_dir': config['seg_plugin_dir']}
+
+                if not checkpoints.step('organ_volumes', organ_vol_parts, [config['organ_vol_result_csv']]):
+                    generate_organ_volumes(config)
+
+                    if config['seg_plugin_dir']:
+                        plugin_interface.secondary_segmentation(config)
 
-                if config['seg_plugin_dir']:
-                    plugin_interface.secondary_segmentation(config)
+                    checkpoints.mark_done('organ_volumes', organ_vol_parts)
 
-        if not generate_staging_data(config):
-            logging.warning('No staging data generated')
+        staging_parts = {'registration': reg_key,
+                         'propagation': checkpoints.keys.get('propagation'),
+                         'staging': config['staging']}
+
+        if not checkpoints.step('staging', staging_parts):
+            if generate_staging_data(config):
+                checkpoints.mark_done('staging', staging_parts)
+            else:
+                logging.warning('No staging data generated')
 
         if not no_qc:
+            qc_parts = {'steps': checkpoints.key(checkpoints.keys),
+                        'fixed_volume': checkpoints.file_hash(config['fixed_volume'])}
 
-            rev_reg = True if config['label_propagation'] == 'reverse_registration' else False
-            make_qc_images(config.config_dir, config['fixed_volume'], qc_dir, mask=None,
-                           reverse_reg_propagation=rev_reg)
+            if not checkpoints.step('qc', qc_parts):
+                rev_reg = True if config['label_propagation'] == 'reverse_registration' else False
+                make_qc_images(config.config_dir, config['fixed_volume'], qc_dir, mask=None,
+                               reverse_reg_propagation=rev_reg)
+                checkpoints.mark_done('qc', qc_parts)
 
         mem_monitor.stop()
 
@@ -311,11 +381,14 @@ def invert_volumes(config: LamaConfig):
 
     if config['stats_mask']:
         mask_inversion_dir = config.mkdir('inverted_stats_masks')
-        PropagateLabelMap(invert_config, config['stats_mask'], mask_inversion_dir, threads=config['threads']).run()
+        PropagateLabelMap(invert_config, config['stats_mask'], mask_inversion_dir, threads=config['threads'],
+                          method=config['propagation_method']).run()
 
+    # With the native method the displacement field made for the stats mask is reused for the labels
     if config['label_map']:
         labels_inverion_dir = config.mkdir('inverted_labels')
-        PropagateLabelMap(invert_config, config['label_map'], labels_inverion_dir, threads=config['threads']).run()
+        PropagateLabelMap(invert_config, config['label_map'], labels_inverion_dir, threads=config['threads'],
+                          method=config['propagation_method']).run()
 
 
 def generate_organ_volumes(config: LamaConfig):
@@ -325,7 +398,7 @@ def generate_organ_volumes(config: LamaConfig):
     out_path = config['organ_vol_result_csv']
 
     # Generate the organ volume csv
-    label_sizes(inverted_label_dir, out_path)
+    label_sizes(inverted_label_dir, out_path, threads=config['threads'])
 
 
 # def invert_isosurfaces(self):
@@ -353,7 +426,7 @@ def generate_organ_volumes(config: LamaConfig):
 #         im.run()
 
 
-def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Path:
+def run_registration_schedule(config: LamaConfig, first_stage_only=False, checkpoints: Checkpoints = None) -> Path:
     """
     Run the registrations specified in the config file
 
@@ -361,6 +434,8 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
     ----------
     config: Parsed and validated lama config
     first_stage_only: If True, just do the initial rigid stage
+    checkpoints: If given, stages (and specimens within target-based stages) that are already done with the same
+        inputs and parameters are skipped
 
     Returns
     -------
@@ -422,18 +497,12 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
         stage_id = reg_stage['stage_id']
         stage_dir = config.stage_dirs[stage_id]
 
-        common.mkdir_force(stage_dir)
-
         logging.info("### Current registration step: {} ###".format(stage_id))
 
         # Make the elastix parameter file for this stage
         elxparam = elastix_stage_parameters[stage_id]
         elxparam_path = join(stage_dir, ELX_PARAM_PREFIX + stage_id + '.txt')
 
-        with open(elxparam_path, 'w') as fh:
-            if elxparam:  # Not sure why I put this here
-                fh.write(elxparam)
-
         # if i < 2:  # TODO: shall we keep the fixed mask throughout? I think we should in next release
         #     fixed_mask = config['fixed_mask']
 
@@ -443,35 +512,83 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
         else:
             fixed_mask = None
 
-        # Do the registrations
-        registrator = reg_method(elxparam_path,
-                                 moving_vols_dir,
-                                 stage_dir,
-                                 config['filetype'],
-                                 config['threads'],
-                                 fixed_mask
-                                 )
+        uses_target = (not config['pairwise_registration']) or (config['pairwise_registration'] and euler_stage)
+        fix_folding = config['fix_folding'] if tform_type == 'BSplineTransform' else False
 
-        if (not config['pairwise_registration']) or (config['pairwise_registration'] and euler_stage):
-            registrator.set_target(fixed_vol)
+        if regenerate_target:
+            average_path = join(config['average_folder'], '{0}.{1}'.format(stage_id, config['filetype']))
 
-        if reg_stage['elastix_parameters']['Transform'] == 'BSplineTransform':
-            if config['fix_folding']:
-                logging.info(f'Folding correction for stage {stage_id} set')
-            registrator.fix_folding = config['fix_folding']  # Curently only works for TargetBasedRegistration
+        stage_parts = specimen_parts = None
+        if checkpoints:
+            stage_parts, specimen_parts = _stage_checkpoint_parts(checkpoints, moving_vols_dir,
+                                                                  fixed_vol if uses_target else None, fixed_mask,
+                                                                  elxparam, reg_method.__name__, fix_folding,
+                                                                  config['filetype'])
+            checkpoints.keys[stage_id] = checkpoints.key(stage_parts)
 
-        registrator.run()  # Do the registrations for a single stage
+            if checkpoints.is_done(Path(stage_dir), stage_parts, [average_path] if regenerate_target else []):
+                logging.info(f'Stage {stage_id} already completed with the same inputs and parameters. Skipping')
+                stage_parts = None  # Don't write the manifest again
 
-        # Make average from the stage outputs
-        if regenerate_target:
-            average_path = join(config['average_folder'], '{0}.{1}'.format(stage_id, config['filetype']))
-            registrator.make_average(average_path)
+        if not checkpoints or stage_parts is not None:
+
+            if checkpoints and reg_method == TargetBasedRegistration:
+                # Keep specimens already registered in this stage
+                Path(stage_dir).mkdir(parents=True, exist_ok=True)
+            else:
+                common.mkdir_force(stage_dir)
+
+            with open(elxparam_path, 'w') as fh:
+                if elxparam:  # Not sure why I put this here
+                    fh.write(elxparam)
+
+            # Do the registrations
+            registrator = reg_method(elxparam_path,
+                                     moving_vols_dir,
+                                     stage_dir,
+                                     config['filetype'],
+                                     config['threads'],
+                                     fixed_mask
+                                     )
+
+            registrator.parallel_registrations = config['parallel_registrations']
+            registrator.fail_fast = config['registration_fail_fast']
 
-        if not config['no_qc']:
+            if regenerate_target:
+                # Build the stage average as the registrations finish
+                registrator.averager = common.ImageAverager()
+
+            if checkpoints:
+                registrator.checkpoints = checkpoints
+                registrator.specimen_parts = specimen_parts
+
+            if uses_target:
+                registrator.set_target(fixed_vol)
 
-            stage_metrics_dir = qc_metric_dir / stage_id
-            common.mkdir_force(stage_metrics_dir)
-            make_charts(stage_dir, stage_metrics_dir)
+            if reg_stage['elastix_parameters']['Transform'] == 'BSplineTransform':
+                if config['fix_folding']:
+                    logging.info(f'Folding correction for stage {stage_id} set')
+                registrator.fix_folding = config['fix_folding']  # Curently only works for TargetBasedRegistration
+
+            failed = registrator.run()  # Do the registrations for a single stage
+
+            # Make average from the stage outputs
+            if regenerate_target:
+                registrator.make_average(average_path)
+
+            if not config['no_qc']:
+
+                stage_metrics_dir = qc_metric_dir / stage_id
+                common.mkdir_force(stage_metrics_dir)
+                make_charts(stage_dir, stage_metrics_dir)
+
+            if checkpoints:
+                if failed:
+                    # Leave the stage incomplete so a resumed run retries the failed specimens
+                    logging.warning(f'Stage {stage_id}: {len(failed)} registrations failed. Not marking the stage as '
+                                    f'done')
+                else:
+                    checkpoints.mark_done(Path(stage_dir), stage_parts)
 
         # Setup the fixed and moving for the next stage, if there is one
         if i + 1 < len(config['registration_stage_params']):
@@ -490,6 +607,43 @@ def run_registration_schedule(config: LamaConfig, first_stage_only=False) -> Pat
     return stage_dir
 
 
+def _stage_checkpoint_parts(checkpoints: Checkpoints,
+                            moving_vols_dir,
+                            fixed_vol,
+                            fixed_mask,
+                            elxparam: str,
+                            reg_method: str,
+                            fix_folding: bool,
+                            filetype: str) -> Tuple[dict, dict]:
+    """
+    The input hashes and parameters that determine the output of a registration stage, and of each specimen in it
+
+    Returns
+    -------
+    stage parts, {specimen name: specimen parts}
+    """
+    moving_vols_dir = Path(moving_vols_dir)
+    if moving_vols_dir.is_file():
+        moving_imgs = [moving_vols_dir]
+    else:
+        moving_imgs = common.get_file_paths(moving_vols_dir, ignore_folders=[RESOLUTION_IMGS_DIR, IMG_PYRAMID_DIR])
+
+    shared = {'elastix_parameters': hashlib.sha1((elxparam or '').encode()).hexdigest(),
+              'method': reg_method,
+              'fix_folding': fix_folding,
+              'filetype': filetype,
+              'fixed': checkpoints.file_hash(fixed_vol),
+              'fixed_mask': checkpoints.file_hash(fixed_mask)}
+
+    specimen_parts = {}
+    for mov in moving_imgs:
+        specimen_parts[Path(mov).stem] = dict(shared, input=checkpoints.file_hash(mov))
+
+    stage_parts = dict(shared, inputs={name: parts['input'] for name, parts in specimen_parts.items()})
+
+    return stage_parts, specimen_parts
+
+
 def create_glcms(config: LamaConfig, final_reg_dir):
     """
     Create grey level co-occurence matrices. This is done in the main registration pipeline as we don't
@@ -108,12 +108,20 @@ class LamaConfig:
             'registration_stage_params': ('dict', 'required'),
             'no_qc': ('bool', False),
             'threads': ('int', 4),
+            'parallel_registrations': ('int', 0),  # 0: choose from threads, cpus and memory
+            'registration_fail_fast': ('bool', True),
+            # Skip work already done by a previous run with the same inputs and parameters. The output folders are kept
+            # rather than cleared as they were before this option. false restores that
+            'resume': ('bool', True),
             'filetype': ('func', self.validate_filetype),
             'voxel_size': ('float', 14.0),
             'generate_new_target_each_stage': ('bool', False),
             'skip_transform_inversion': ('bool', False),
             'pairwise_registration': ('bool', False),
             'generate_deformation_fields': ('dict', None),
+            'jacobian_method': (['native', 'transformix'], 'native'),
+            'parallel_deformations': ('int', 0),  # 0: choose from threads, cpus and memory
+            'write_jacobian_matrices': (bool, False),
             'staging': ('func', self.validate_staging),
             'data_type': (['uint8', 'int8', 'int16', 'uint16', 'float32'], 'uint8'),
             'glcm': ('bool', False),
@@ -122,6 +130,7 @@ class LamaConfig:
             'fix_folding': (bool, False),
             # 'inverse_transform_method': (['invert_transform', 'reverse_registration'], 'invert_transform')
             'label_propagation': (['invert_transform', 'reverse_registration'], 'reverse_registration'),
+            'propagation_method': (['native', 'transformix'], 'native'),
             'skip_forward_registration': (bool, False),
             'seg_plugin_dir': (Path, None),
 
@@ -2,9 +2,11 @@
 
 """
 This module takes a directory containing one or more subdirectories each containing a mutant line or baseline inputs
-It will try to make a lock on the input file and remove a line/specimen to process after which it will release the lock
+It will claim a line/specimen from a job queue shared with the other runners and process it.
 This is to enable multiple machines to process the data concurrently.
 
+The job queue (see lama.job_queue) is kept in the lama_jobs folder in the root directory. lama_jobs.csv is an exported
+view of the queue that is updated as jobs start and finish.
 """
 import sys
 import os
@@ -21,7 +23,7 @@ if lama_docker_dir.is_dir():
 
 import shutil
 import socket
-from datetime import datetime
+import time
 
 from filelock import SoftFileLock, Timeout
 from logzero import logger as logging
@@ -33,9 +35,11 @@ from inspect import currentframe
 from lama.registration_pipeline import run_lama
 from lama.registration_pipeline.validate_config import LamaConfigError
 from lama.common import cfg_load
+from lama.job_queue import JobQueue, host_slot, LEASE_TIMEOUT, HEARTBEAT_INTERVAL, MAX_ATTEMPTS
 
 
 JOBFILE_NAME = 'lama_jobs.csv'
+JOB_QUEUE_DIR = 'lama_jobs'
 
 
 def linenum():
@@ -73,16 +77,29 @@ def make_jobs_file(jobs_file: Path, root_dir: Path):
             rel_path_to_specimen_input = str(vol_path.relative_to(root_dir))
             jobs_entries.append([rel_path_to_specimen_input, 'to_run', '_', '_', '_'])
 
-    jobs_df = pd.DataFrame.from_records(jobs_entries, columns=['job', 'status', 'host', 'start_time', 'end_time'])
-
-    jobs_df.to_csv(jobs_file)
+    queue = JobQueue.create(jobs_file.parent / JOB_QUEUE_DIR, [j[0] for j in jobs_entries])
+    queue.export_csv(jobs_file)
     return True
 
 
+def queue_from_jobs_file(jobs_file: Path, queue_dir: Path, **kwargs) -> JobQueue:
+    """
+    Make a job queue from a lama_jobs.csv made by an older version of lama_job_runner.
+    Jobs with a status of complete are not rerun
+    """
+    df_jobs = pd.read_csv(jobs_file, index_col=0)
+    done = {i: 'complete' for i, status in enumerate(df_jobs['status']) if status == 'complete'}
+    return JobQueue.create(queue_dir, list(df_jobs['job']), done, **kwargs)
+
+
 def lama_job_runner(config_path: Path,
                     root_directory: Path,
                     make_job_file: bool=False,
-                    log_level=None):
+                    log_level=None,
+                    lease_timeout: float = LEASE_TIMEOUT,
+                    heartbeat_interval: float = HEARTBEAT_INTERVAL,
+                    max_attempts: int = MAX_ATTEMPTS,
+                    jobs_per_host: int = None):
 
     """
 
@@ -94,17 +111,27 @@ def lama_job_runner(config_path: Path,
         path to root directory. The folder names from job_file.dir will be appending to this path to resolve project directories
     make_job_file
         if true, just make the job_file that other instances can consume
+    lease_timeout
+        Seconds without a heartbeat from a running job after which it is assumed dead and requeued
+    heartbeat_interval
+        Seconds between heartbeats of a running job
+    max_attempts
+        Number of times a job is tried before it is recorded as failed
+    jobs_per_host
+        Maximum number of job runners that can run at once on this machine. None for no limit
 
     Notes
     -----
-    This function uses a SoftFileLock for locking the job_file csv to prevent multiple instances of this code from
-    processing the same line or specimen. A SoftFileLock works by creating a lock file, and the presence of this file
-    prevents other instances from accessing it. We don't use FileLock (atlhough this is more robust) as it's not
-    supported on nfs file systems. The advantage of SoftFileLock is you can create a lock file manually if
-    you want to edit a job file manually while job_runner is running (make sure to delete after editing).
-
-    If this script terminates unexpectedly while it has a lock on the file, it will not be released and the file
-    remains. Therefore before running this script, ensure no previous lock file is hanging around.
+    Jobs are claimed from a lama.job_queue.JobQueue in root_directory/lama_jobs. Each job claim is its own atomically
+    created file, so there is no lock on the whole job list and runners on different machines do not wait on each
+    other. A running job keeps its claim alive with heartbeats. If a runner dies, its job is requeued once the claim
+    has gone lease_timeout seconds without a heartbeat.
+
+    Once there are no jobs left to claim, the runner waits until the running jobs have finished in case any of them
+    need to be requeued.
+
+    lama_jobs.csv is exported from the queue when jobs start or finish. Editing it has no effect.
+    A lama_jobs.csv made by an older version of the job runner is converted into a queue on first use.
     """
     if log_level:
         logzero.loglevel(log_level)
@@ -115,11 +142,13 @@ def lama_job_runner(config_path: Path,
     root_directory = root_directory.resolve()
 
     job_file = root_directory / JOBFILE_NAME
+    queue_dir = root_directory / JOB_QUEUE_DIR
     lock_file = job_file.with_suffix('.lock')
+    # Only used when making the queue
     lock = SoftFileLock(lock_file)
-    # init_file = root_directory / 'init'
 
-    HN = socket.gethostname()
+    queue_kwargs = dict(lease_timeout=lease_timeout, heartbeat_interval=heartbeat_interval,
+                        max_attempts=max_attempts)
 
     if make_job_file:
 
@@ -141,106 +170,96 @@ def lama_job_runner(config_path: Path,
             logging.error(f"Make sure lock file: {lock_file} is not present on running first instance")
             sys.exit()
 
-    config_name = config_path.name
-
-    while True:
-
-        try:
-            # Create a lock then read jobs and add status to job file to ensure job is run once only.
-            with lock.acquire(timeout=60):
-
-                df_jobs = pd.read_csv(job_file, index_col=0)
+    try:
+        with lock.acquire(timeout=60):
+            if not (queue_dir / 'jobs.json').is_file():
+                logging.info(f'Making a job queue from {job_file}')
+                queue_from_jobs_file(job_file, queue_dir, **queue_kwargs)
+    except Timeout:
+        sys.exit('Timed out' + socket.gethostname())
 
-                # Get an unfinished job
-                jobs_to_do = df_jobs[df_jobs['status'] == 'to_run']
+    queue = JobQueue(queue_dir, **queue_kwargs)
 
-                if len(jobs_to_do) < 1:
-                    logging.info("No more jobs left on jobs list")
-                    logging.info("checking for hung jobs")
-                    fin_jobs = df_jobs[df_jobs['status'] == 'complete']
-                    running_jobs = df_jobs[df_jobs['status'] == 'running']
-                    fin_indx = fin_jobs.index[-1]
-                    fin_t = fin_jobs.at[fin_indx, 'start_time']
-                    fin_time = datetime.strptime(fin_t, '%Y-%m-%d %H:%M:%S')
-                    run_t = running_jobs['start_time']
-                    run_times = [datetime.strptime(t, '%Y-%m-%d %H:%M:%S') < fin_time for t in run_t]
-                    hung_jobs = running_jobs[run_times]
-                    if len(hung_jobs) < 1:
-                        logging.info("Hung jobs found - rerunning")
-                        jobs_to_do = hung_jobs
-                    else:
-                        break
+    config_name = config_path.name
 
-                indx = jobs_to_do.index[0]
+    with host_slot(queue_dir, jobs_per_host) as got_slot:
 
-                vol = root_directory / (jobs_to_do.at[indx, 'job'])
+        if not got_slot:
+            logging.info(f'{jobs_per_host} job runners are already running on {socket.gethostname()}')
+            return True
 
-                df_jobs.at[indx, 'status'] = 'running'
+        while True:
 
-                df_jobs.at[indx, 'start_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
+            job = queue.claim()
 
-                df_jobs.at[indx, 'host'] = socket.gethostname()
+            if job is None:
+                if queue.finished():
+                    logging.info("No more jobs left on jobs list")
+                    break
+                # Jobs are running elsewhere. Wait in case one of them dies and needs requeuing
+                time.sleep(heartbeat_interval)
+                continue
 
-                df_jobs.to_csv(job_file)
+            queue.export_csv(job_file)
 
-                # Make a project dir drectory for specimen
-                # vol.parent should be the line name
-                # vol.stem is the specimen name minus the extension
-                spec_root_dir = root_directory / 'output' / vol.parent.name / vol.stem
-                spec_input_dir = spec_root_dir / 'inputs'
-                spec_input_dir.mkdir(exist_ok=True, parents=True)
-                spec_out_dir = spec_root_dir / 'output'
-                spec_out_dir.mkdir(exist_ok=True, parents=True)
-                shutil.copy(vol, spec_input_dir)
+            vol = root_directory / job.job
 
-                # Copy the config into the project directory
-                dest_config_path = spec_root_dir / config_name
+            # Make a project dir drectory for specimen
+            # vol.parent should be the line name
+            # vol.stem is the specimen name minus the extension
+            spec_root_dir = root_directory / 'output' / vol.parent.name / vol.stem
+            spec_input_dir = spec_root_dir / 'inputs'
+            spec_input_dir.mkdir(exist_ok=True, parents=True)
+            spec_out_dir = spec_root_dir / 'output'
+            spec_out_dir.mkdir(exist_ok=True, parents=True)
+            shutil.copy(vol, spec_input_dir)
 
-                if dest_config_path.is_file():
-                    os.remove(dest_config_path)
+            # Copy the config into the project directory
+            dest_config_path = spec_root_dir / config_name
 
-                shutil.copy(config_path, dest_config_path)
+            if dest_config_path.is_file():
+                os.remove(dest_config_path)
 
-                # rename the target_folder now we've moved the config
-                c = cfg_load(dest_config_path)
+            shutil.copy(config_path, dest_config_path)
 
-                target_folder = config_path.parent / c.get('target_folder')
-                # Can't seem to get this to work with pathlib
-                target_folder_relpath = os.path.relpath(target_folder, str(dest_config_path.parent))
-                c['target_folder'] = target_folder_relpath
+            # rename the target_folder now we've moved the config
+            c = cfg_load(dest_config_path)
 
-                with open(dest_config_path, 'w') as fh:
-                    fh.write(toml.dumps(c))
+            target_folder = config_path.parent / c.get('target_folder')
+            # Can't seem to get this to work with pathlib
+            target_folder_relpath = os.path.relpath(target_folder, str(dest_config_path.parent))
+            c['target_folder'] = target_folder_relpath
 
-        except Timeout:
-            sys.exit('Timed out' + socket.gethostname())
+            with open(dest_config_path, 'w') as fh:
+                fh.write(toml.dumps(c))
 
-        try:
-            logging.info(f'trying {vol.name}')
-            run_lama.run(dest_config_path)
+            try:
+                logging.info(f'trying {vol.name} (attempt {job.attempt})')
+                with queue.heartbeat(job):
+                    run_lama.run(dest_config_path)
 
-        except LamaConfigError as lce:
-            status = 'config_error'
-            logging.exception(f'There is a problem with the config\n{lce}')
-            sys.exit()
+            except LamaConfigError as lce:
+                logging.exception(f'There is a problem with the config\n{lce}')
+                queue.finish(job, 'config_error')
+                queue.export_csv(job_file)
+                sys.exit()
 
-        except Exception as e:
-            if e.__class__.__name__ == 'KeyboardInterrupt':
+            except KeyboardInterrupt:
                 logging.info('terminating')
+                queue.release(job)
+                queue.export_csv(job_file)
                 sys.exit('Exiting')
 
-            status = 'failed'
-            logging.exception(e)
+            except Exception as e:
+                logging.exception(e)
+                queue.finish(job, 'failed')
+
+            else:
+                queue.finish(job, 'complete')
 
-        else:
-            status = 'complete'
+            queue.export_csv(job_file)
 
-        finally:
-            with lock:
-                df_jobs = pd.read_csv(job_file, index_col=0)
-                df_jobs.at[indx, 'status'] = status
-                df_jobs.at[indx, 'end_time'] = datetime.now().strftime('%Y-%m-%d %H:%M:%S')
-                df_jobs.to_csv(job_file)
+    queue.export_csv(job_file)
     logging.info('Exiting job_runner')
     return True
 
@@ -256,10 +275,20 @@ def main():
                         required=True)
     parser.add_argument('-m', '--make_job_file', dest='make_job_file', help='Run with this option forst to crate a job file',
                     action='store_true', default=False)
+    parser.add_argument('--lease_timeout', dest='lease_timeout', type=float, default=LEASE_TIMEOUT,
+                        help='Seconds without a heartbeat after which a running job is requeued')
+    parser.add_argument('--heartbeat_interval', dest='heartbeat_interval', type=float, default=HEARTBEAT_INTERVAL,
+                        help='Seconds between heartbeats of a running job')
+    parser.add_argument('--max_attempts', dest='max_attempts', type=int, default=MAX_ATTEMPTS,
+                        help='Number of times to try a job before recording it as failed')
+    parser.add_argument('--jobs_per_host', dest='jobs_per_host', type=int, default=None,
+                        help='Maximum number of job runners to run at once on this machine')
     args = parser.parse_args()
 
     try:
-        lama_job_runner(Path(args.config), Path(args.root_dir), args.make_job_file)
+        lama_job_runner(Path(args.config), Path(args.root_dir), args.make_job_file,
+                        lease_timeout=args.lease_timeout, heartbeat_interval=args.heartbeat_interval,
+                        max_attempts=args.max_attempts, jobs_per_host=args.jobs_per_host)
     except pd.errors.EmptyDataError as e:
         logging.exception(f'pandas read failure {e}')
 
@@ -32,7 +32,9 @@ allowed_cfg_keys = [
     'voxel_size',
     'two_way',
     'rad_dir',
-    'spec_fdr'
+    'spec_fdr',
+    'stats_runner',
+    'null_dir'
 ]
 
 
@@ -42,12 +44,15 @@ def main():
     parser = argparse.ArgumentParser("Permutation-based stats")
     parser.add_argument('-c', '--config', dest='cfg_path', help='wildtype registration directory', required=True,
                         type=str)
+    parser.add_argument('-n', '--num_perms', dest='num_perms', help='Number of permutations. Overrides n_permutations '
+                        'in the config. Rerun with a larger number to add permutations to an existing null',
+                        required=False, default=None, type=int)
 
     args = parser.parse_args()
-    run(args.cfg_path)
+    run(args.cfg_path, args.num_perms)
 
 
-def run(cfg_path):
+def run(cfg_path, num_perms: int = None):
 
     def p(path):
         if path is None:
@@ -79,7 +84,7 @@ def run(cfg_path):
 
     # Optional parameters
 
-    n_perm = int(cfg.get('n_permutations', 1000))
+    n_perm = num_perms if num_perms else int(cfg.get('n_permutations', 1000))
     label_meta = p(cfg.get('label_metadata'))
     label_map = p(cfg.get('label_map'))
     wev_norm = bool(cfg.get('norm_to_whole_embryo_vol', True))
@@ -93,6 +98,12 @@ def run(cfg_path):
     spec_fdr = float(cfg.get('spec_fdr', 0.2))
 
     rad_dir = p(cfg.get('rad_dir'))
+
+    stats_runner = cfg.get('stats_runner', 'lm_sm')
+
+    null_dir = cfg.get('null_dir')
+    if null_dir is not None:
+        null_dir = (Path(cfg_path).parent / null_dir).resolve()  # Made if it does not exist
     run_permutation_stats.run(wt_dir=wt_dir,
                               mut_dir=mut_dir,
                               out_dir=out_dir,
@@ -105,7 +116,9 @@ def run(cfg_path):
                               two_way=two_way,
                               treat_dir=treat_dir,
                               inter_dir=inter_dir,
-                              rad_dir=rad_dir
+                              rad_dir=rad_dir,
+                              stats_runner=stats_runner,
+                              null_dir=null_dir
     )
 
 
@@ -4,6 +4,8 @@ The code to run linear models in R.
 The current interface to R is to write binary files that R can read (numpy_to_dat). The reason r2py wasn't used is that
 it used to be a pain to install. I imagine it's better now and using docker should improve things so adding
 rp2y interface is on the todo list
+
+lm_fast does the same as lm_r (rscripts/lmFast.R) in-process using numpy. R is kept as a reference.
 """
 
 import subprocess as sub
@@ -11,7 +13,7 @@ import os
 import struct
 from pathlib import Path
 import tempfile
-from typing import Tuple
+from typing import Tuple, Callable
 import shutil
 
 from itertools import chain
@@ -19,6 +21,9 @@ from logzero import logger as logging
 
 import numpy as np
 import pandas as pd
+import patsy
+from scipy import stats
+from scipy.linalg import solve_triangular
 import statsmodels.formula.api as smf
 
 from lama import common
@@ -27,7 +32,7 @@ from tqdm import tqdm
 LM_SCRIPT = str(common.lama_root_dir / 'stats' / 'rscripts' / 'lmFast.R')
 
 # If debugging, don't delete the temp files used for communication with R so they can be used for R debugging.
-DEBUGGING = True
+DEBUGGING = False
 
 
 def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False, use_staging: bool = True,
@@ -110,18 +115,16 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bo
             # if you're doing a two-way, you need to get three arrays (i.e. genotype, treatment and interaction)
             # converted to np.ndarray with three dimensions 
 
-            p_all = np.array(
-                [np.fromfile((line_level_pval_out_file + '_genotype'), dtype=np.float64).astype(np.float32),
-                 np.fromfile((line_level_pval_out_file + '_treatment'), dtype=np.float64).astype(np.float32),
-                 np.fromfile((line_level_pval_out_file + '_interaction'), dtype=np.float64).astype(np.float32)])
+            p_all = np.array([_read_r_output(line_level_pval_out_file + '_genotype'),
+                              _read_r_output(line_level_pval_out_file + '_treatment'),
+                              _read_r_output(line_level_pval_out_file + '_interaction')])
 
-            t_all = np.array(
-                [np.fromfile((line_level_tstat_out_file + '_genotype'), dtype=np.float64).astype(np.float32),
-                 np.fromfile((line_level_tstat_out_file + '_treatment'), dtype=np.float64).astype(np.float32),
-                 np.fromfile((line_level_tstat_out_file + '_interaction'), dtype=np.float64).astype(np.float32)])
+            t_all = np.array([_read_r_output(line_level_tstat_out_file + '_genotype'),
+                              _read_r_output(line_level_tstat_out_file + '_treatment'),
+                              _read_r_output(line_level_tstat_out_file + '_interaction')])
         else:
-            p_all = np.fromfile(line_level_pval_out_file, dtype=np.float64).astype(np.float32)
-            t_all = np.fromfile(line_level_tstat_out_file, dtype=np.float64).astype(np.float32)
+            p_all = _read_r_output(line_level_pval_out_file)
+            t_all = _read_r_output(line_level_tstat_out_file)
 
     except FileNotFoundError as e:
         print(f'Linear model file from R not found {e}')
@@ -132,42 +135,55 @@ def lm_r(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bo
         os.remove(groups_file)
 
         if two_way:
-            os.remove(line_level_pval_out_file + '_genotype')
-            os.remove(line_level_pval_out_file + '_treatment')
-            os.remove(line_level_pval_out_file + '_interaction')
-            os.remove(line_level_tstat_out_file + '_genotype')
-            os.remove(line_level_tstat_out_file + '_treatment')
-            os.remove(line_level_tstat_out_file + '_interaction')
+            result_files = [f'{out}_{effect}' for out in (line_level_pval_out_file, line_level_tstat_out_file)
+                            for effect in ('genotype', 'treatment', 'interaction')]
         else:
-            os.remove(line_level_pval_out_file)
-            os.remove(line_level_tstat_out_file)
+            result_files = [line_level_pval_out_file, line_level_tstat_out_file]
+
+        for result_file in result_files:
+            try:
+                os.remove(result_file)
+            except PermissionError:
+                # Windows will not delete a file that is memory mapped. It's in the temp dir so leave it
+                logging.warning(f'Could not delete temporary file {result_file}')
     return p_all, t_all
 
 
-def _numpy_to_dat(mat: np.ndarray, outfile: str):
+def _numpy_to_dat(mat: np.ndarray, outfile: str, block_size: int = 100000):
     """
     Convert a numpy array to a binary file for reading in by R
 
+    The file has two integers (rows, columns) followed by the data as column-major float64
+
     Parameters
     ----------
     mat
         the data to be send to r
     outfile
         the tem file name to store the binary file
-
+    block_size
+        The number of columns to convert to float64 at a time. Limits the memory used for the conversion
 
     """
-    # mat = mat.as_matrix()
-    # create a binary file
     with open(outfile, 'wb') as binfile:
         # and write out two integers with the row and column dimension
 
         header = struct.pack('2I', mat.shape[0], mat.shape[1])
         binfile.write(header)
-        # then loop over columns and write each
-        for i in range(mat.shape[1]):
-            data = struct.pack('%id' % mat.shape[0], *mat[:, i])
-            binfile.write(data)
+        # Column-major order of mat is row-major order of its transpose. No copy if mat is already
+        # Fortran-ordered float64
+        for i in range(0, mat.shape[1], block_size):
+            np.ascontiguousarray(mat[:, i: i + block_size].T, dtype=np.float64).tofile(binfile)
+
+
+def _read_r_output(path: str) -> np.ndarray:
+    """
+    Memory map a float32 results file written by lmFast.R
+
+    Copy-on-write, so the results can be modified in place (eg. NaN replacement) without changing the file.
+    On posix systems the file can be deleted while mapped.
+    """
+    return np.memmap(path, dtype=np.float32, mode='c')
 
 
 def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None,
@@ -258,3 +274,208 @@ def lm_sm(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None,
     t_all = np.negative(np.array(tvals))  # The tvaue for genotype[T.mut] is what we want
 
     return p_all, t_all
+
+
+def lm_np(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None,
+          boxcox: bool = False, use_staging: bool = True, two_way: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    A drop-in replacement for lm_sm that fits the labels together rather than one statsmodels fit per label.
+
+    The design matrix is built once. NaN values are dropped per label as statsmodels does with missing='drop', so the
+    labels are grouped by their pattern of non-NaN specimens and each group is solved as a single multi-response least
+    squares problem.
+
+    Parameters
+    ----------
+    See lm_sm. plot_dir and boxcox are not used
+
+    Returns
+    -------
+    p-values: shape (n labels, 1) or for two-way (n labels, 3) (genotype, treatment, interaction)
+    t-statistics: shape (n labels,) or for two-way (n labels, 3)
+    """
+    if two_way:
+        formula = 'genotype * treatment + staging' if use_staging else 'genotype * treatment'
+    elif use_staging:
+        formula = 'genotype + staging'
+    else:
+        formula = 'genotype'
+
+    design = _design_matrix(info, formula)
+
+    if two_way:
+        effects = [i for i, col in enumerate(design.columns) if col not in ('Intercept', 'staging')]
+    else:
+        effects = [i for i, col in enumerate(design.columns) if col.startswith('genotype')]
+        if len(effects) != 1:
+            raise ValueError(f'Expected two genotypes for the linear model. Got {info.genotype.unique()}')
+
+    x = design.values
+    y = np.asarray(data, dtype=np.float64)
+
+    p_all = np.full((y.shape[1], len(effects)), np.nan)
+    t_all = np.full((y.shape[1], len(effects)), np.nan)
+
+    # If a label column is set to all 0 (or NaN), a line has all the mutants qc'd and it's not for analysis
+    cols_to_fit = np.flatnonzero(np.nan_to_num(y).any(axis=0))
+
+    # Specimens (rows) used for each label
+    valid = ~np.isnan(y[:, cols_to_fit]) & ~np.isnan(x).any(axis=1)[:, np.newaxis]
+    row_patterns, pattern_idx = np.unique(valid.T, axis=0, return_inverse=True)
+
+    for i, rows in enumerate(row_patterns):
+        cols = cols_to_fit[pattern_idx.ravel() == i]
+        p, t = _ols_pt(x[rows], y[rows][:, cols])
+        p_all[cols] = p[effects].T
+        t_all[cols] = t[effects].T
+
+    # The tvalue for genotype[T.mut] is what we want
+    t_all = np.negative(t_all)
+
+    if not two_way:
+        t_all = t_all.ravel()
+
+    return p_all, t_all
+
+
+def lm_fast(data: np.ndarray, info: pd.DataFrame, plot_dir: Path = None, boxcox: bool = False,
+            use_staging: bool = True, two_way: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    In-process numpy version of lm_r. Gives the same results as rscripts/lmFast.R without writing the data to disk and
+    starting R for each chunk.
+
+    Parameters
+    ----------
+    See lm_r. plot_dir and boxcox are not used
+
+    Returns
+    -------
+    As lm_r. The line-level results followed by the specimen-level results for each mutant.
+    For two-way, shape (3, n) with rows genotype, treatment, interaction
+
+    Notes
+    -----
+    Unlike lmFast.R, specimens with NaN values are dropped for only the affected columns rather than for all columns
+    """
+    # lmFast.R uses the absolute values of the data. Only copy the data if needed
+    if np.any(data < 0):
+        data = np.abs(data)
+
+    return line_and_specimen_level(lm_np, data, info, use_staging=use_staging, two_way=two_way)
+
+
+def line_and_specimen_level(stats_runner: Callable, data: np.ndarray, info: pd.DataFrame, use_staging: bool = True,
+                            two_way: bool = False) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    lm_r returns the line-level results followed by the specimen-level results of each mutant (see lmFast.R).
+    lm_sm and lm_np only do the line-level fit, so here each mutant is also fitted against the baselines and the results
+    are stacked in the same layout as lm_r.
+
+    For two-way analysis each interaction specimen is fitted against all the non-interaction specimens
+
+    Parameters
+    ----------
+    stats_runner
+        lm_sm or lm_np
+    data, info, use_staging, two_way
+        see lm_r. genotype should be 'wildtype' or 'mutant'. treatment should be 'vehicle' or 'treatment'
+    """
+    if two_way:
+        spec_rows = ((info.genotype == 'mutant') & (info.treatment == 'treatment')).values
+        base_rows = np.flatnonzero(~spec_rows)
+    else:
+        spec_rows = (info.genotype == 'mutant').values
+        base_rows = np.flatnonzero((info.genotype == 'wildtype').values)
+
+    p, t = stats_runner(data, info, use_staging=use_staging, two_way=two_way)
+    p_results = [p]
+    t_results = [t]
+
+    for spec_row in np.flatnonzero(spec_rows):
+        rows = np.append(base_rows, spec_row)
+        p, t = stats_runner(data[rows], info.iloc[rows], use_staging=use_staging, two_way=two_way)
+        p_results.append(p)
+        t_results.append(t)
+
+    if two_way:
+        # (genotype, treatment, interaction) x (line + specimen results)
+        p_all = np.hstack([np.asarray(p, dtype=np.float32).T for p in p_results])
+        t_all = np.hstack([np.asarray(t, dtype=np.float32).T for t in t_results])
+    else:
+        p_all = np.concatenate([np.asarray(p, dtype=np.float32).ravel() for p in p_results])
+        t_all = np.concatenate([np.asarray(t, dtype=np.float32).ravel() for t in t_results])
+
+    return p_all, t_all
+
+
+def _design_matrix(info: pd.DataFrame, formula: str) -> pd.DataFrame:
+    """
+    Get the design matrix for the right hand side of a model formula. Columns are named and ordered as in statsmodels.
+    Rows with missing values are kept (as NaN) so they can be dropped per label.
+    """
+    return patsy.dmatrix(formula, info, NA_action=patsy.NAAction(NA_types=[]), return_type='dataframe')
+
+
+def _ols_pt(x: np.ndarray, y: np.ndarray) -> Tuple[np.ndarray, np.ndarray]:
+    """
+    Fit the linear model y = xb for all columns of y at once and get the p-values and t-statistics of the coefficients.
+
+    Parameters
+    ----------
+    x
+        The design matrix. rows: specimens, columns: model terms
+    y
+        rows: specimens, columns: labels or voxels
+
+    Returns
+    -------
+    p-values and t-statistics. Shape (num terms, num columns of y). NaN if the design is not of full rank.
+    """
+    n, k = x.shape
+
+    if n <= k or np.linalg.matrix_rank(x) < k:
+        nans = np.full((k, y.shape[1]), np.nan)
+        return nans, nans.copy()
+
+    q, r = np.linalg.qr(x)
+    coef = solve_triangular(r, q.T @ y)
+
+    df_resid = n - k
+    resid = y - x @ coef
+    resvar = np.einsum('ij,ij->j', resid, resid) / df_resid
+
+    # Diagonal of (X'X)^-1 from the R of the QR decomposition. This is chol2inv(R) in lmFast.R
+    r_inv = solve_triangular(r, np.eye(k))
+    unscaled_var = np.einsum('ij,ij->i', r_inv, r_inv)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        t = coef / np.sqrt(np.outer(unscaled_var, resvar))
+
+    p = 2 * stats.t.sf(np.abs(t), df_resid)
+
+    return p, t
+
+
+# Approximate peak memory of each stats runner as a multiple of the float64 size of the data chunk it is given.
+# Used to plan the chunks (LineData.chunk_plan). The values are upper bounds with some headroom:
+# lm_np, lm_fast: peak Python allocations measured with tracemalloc (test_linear_model.test_memory_overhead) are
+#   3.9-4.6x for 20-100 specimens: the float64 copy, the row subset and residuals of each NaN pattern, and the
+#   specimen-level copies of the baseline rows. 6 allows for the BLAS work space, which tracemalloc does not see
+# lm_sm: measured at about 3x for 1000 or more columns, as the fits are per column. Given the same value as lm_np
+# lm_r: counted from lmFast.R, as R's memory cannot be measured from Python. The chunk written for R (1), the vector
+#   read by readBin (1), the matrix and its abs (2), and the lm fit (model frame response, qr, residuals, fitted values
+#   and effects: 5). The specimen-level fits add up to another 3 while the line-level results are held
+MEMORY_OVERHEAD = {
+    'lm_r': 12,
+    'lm_sm': 6,
+    'lm_np': 6,
+    'lm_fast': 6
+}
+
+# The linear model functions that can be selected with the 'stats_runner' config option
+STATS_RUNNERS = {
+    'lm_r': lm_r,
+    'lm_sm': lm_sm,
+    'lm_np': lm_np,
+    'lm_fast': lm_fast
+}
@@ -28,16 +28,19 @@ p-values, tvalues could be obtained from the same call the lm() as in the standa
 """
 
 from os.path import expanduser
-from typing import Union, Tuple, List
+from typing import Union, Tuple, List, Callable
 import random
 from pathlib import Path
 import math
 from collections import Counter
+from contextlib import nullcontext
+import tempfile
+import os
 
 import pandas as pd
 import numpy as np
 from scipy.special import comb
-import statsmodels.formula.api as smf
+from scipy import stats
 from joblib import Parallel, delayed
 import datetime
 from logzero import logger
@@ -46,9 +49,19 @@ import random
 import itertools
 
 from lama.stats.linear_model import lm_r, lm_sm
+from lama.stats.permutation_stats.null_store import NullStore, NULL_SEED
+from lama.stats.permutation_stats.sampling import random_combinations, random_partitions
 
 home = expanduser('~')
 
+# The number of permutations solved together in _null_line_thread. Bounds the size of the indicator matrix
+PERM_CHUNK_SIZE = 5000
+
+# The files null_line shares with its workers
+NULL_LINE_VALUES_FILE = 'values.npy'
+NULL_LINE_STAGING_FILE = 'staging.npy'
+NULL_LINE_PVALS_FILE = 'pvals.npy'
+
 
 def random_combination(iterable, r):
     "Random selection from itertools.combinations(iterable, r)"
@@ -75,137 +88,152 @@ def recursive_comb_maker(lst, n, steps, i, recurs_results):
         return recursive_comb_maker(list(filter(lambda val: val not in comb_result[0], lst)), n, steps, i + 1, recurs_results)
 
 
-def generate_random_combinations(data: pd.DataFrame, num_perms):
+def generate_random_combinations(data: pd.DataFrame, num_perms: int, seed: int = NULL_SEED) -> dict:
+    """
+    Draw the synthetic mutants of the line-level null for each label. The number of synthetic mutants follows the sizes
+    of the mutant lines (see combinations_per_n) and for each size the combinations are unique and drawn uniformly at
+    random. Labels with the same non-NaN baselines share the same arrays
+
+    Parameters
+    ----------
+    data
+        columns: labels, line and optionally staging
+    num_perms
+        The number of permutations
+    seed
+        The seed of the random generator
+
+    Returns
+    -------
+    {label: [(num_combs, n) int32 array for each n in ascending order]}. The values are the row positions of the
+    synthetic mutants in the baselines
+    """
     logger.info('generating permutations')
     data = data.drop(columns='staging', errors='ignore')
     line_specimen_counts = get_line_specimen_counts(data)
+    rng = np.random.default_rng(seed)
 
-    result = {}
-    # now for each label calcualte number of combinations we need for each
-    for label in line_specimen_counts:
-        label_indices_result = []
-        counts = line_specimen_counts[label].value_counts()
+    baselines = data[data.line == 'baseline'].drop(columns='line')
+    masks = ~baselines[line_specimen_counts.columns].isna().values
 
-        number_of_lines = counts[counts.index != 0].sum()  # Drop the lines with zero labels (have been qc'd out)
-        ratios = counts[counts.index != 0] / number_of_lines
-        num_combs = num_perms * ratios
+    label_combs = {}
+    needed = {}  # (mask, n): number of combinations
+    for i, label in enumerate(line_specimen_counts):
+        mask = masks[:, i].tobytes()
+        num_combs = combinations_per_n(line_specimen_counts[label], num_perms, masks[:, i].sum()).num_combs
+        label_combs[label] = (mask, num_combs)
+        for n, num in num_combs.items():
+            needed[(mask, n)] = max(needed.get((mask, n), 0), int(num))
 
-        # get wt data for label
-        label_data = data[[label, 'line']]
-        label_data = label_data[label_data.line == 'baseline']
-        label_data = label_data[~label_data[label].isna()]
+    drawn = {}
+    for (mask, n), num in needed.items():
+        rows = np.flatnonzero(np.frombuffer(mask, dtype=bool))
+        drawn[(mask, n)] = rows[random_combinations(len(rows), n, num, rng)].astype(np.int32)
 
-        # Soret out the numnbers
+    result = {}
+    for label, (mask, num_combs) in label_combs.items():
+        result[label] = [drawn[(mask, n)][:num] for n, num in num_combs.items()]
+    return result
 
-        # Sort out the numbers
-        records = []
 
-        for n, n_combs_to_try in num_combs.items():
-            n_combs_to_try = math.ceil(n_combs_to_try)
-            max_combs = int(comb(len(label_data), n))
-            # logger.info(f'max_combinations for n={n} and wt_n={len(label_data)} = {max_combs}')
-            records.append([n, n_combs_to_try, max_combs])
-        df = pd.DataFrame.from_records(records, columns=['n', 'num_combs', 'max_combs'], index='n').sort_index(
-            ascending=True)
+def combinations_per_n(line_counts: pd.Series, num_perms: int, num_baselines: int) -> pd.DataFrame:
+    """
+    Share the permutations of a label between the mutant line sizes
 
-        # test whether it's possible to have this number of permutations with data structure
-        print(f'Max combinations for label {label} is {df.max_combs.sum()}')
-        if num_perms > df.max_combs.sum():
-            raise ValueError(f'Max number of combinations is {df.max_combs.sum()}, you requested {num_perms}')
+    Parameters
+    ----------
+    line_counts
+        The number of non-NaN specimens of the label in each mutant line
+    num_perms
+        The number of permutations
+    num_baselines
+        The number of non-NaN baselines of the label
 
-        # Now spread the overflow from any ns to other groups
+    Returns
+    -------
+    index: n, the number of synthetic mutants
+    columns: num_combs (the number of permutations with n synthetic mutants), max_combs
+    """
+    counts = line_counts.value_counts()
 
-        # Kyle - What is this?
-        while True:
-            df['overflow'] = df.num_combs - df.max_combs  # Get the 'overflow' num permutations over maximumum unique
-            groups_full = df[df.overflow >= 0].index
+    number_of_lines = counts[counts.index != 0].sum()  # Drop the lines with zero labels (have been qc'd out)
+    ratios = counts[counts.index != 0] / number_of_lines
+    num_combs = num_perms * ratios
 
-            df['overflow'][df['overflow'] < 0] = 0
-            extra = df[df.overflow > 0].overflow.sum()
+    # Sort out the numbers
+    records = []
 
-            df.num_combs -= df.overflow
+    for n, n_combs_to_try in num_combs.items():
+        n_combs_to_try = math.ceil(n_combs_to_try)
+        max_combs = int(comb(num_baselines, n))
+        # logger.info(f'max_combinations for n={n} and wt_n={len(label_data)} = {max_combs}')
+        records.append([n, n_combs_to_try, max_combs])
+    df = pd.DataFrame.from_records(records, columns=['n', 'num_combs', 'max_combs'], index='n').sort_index(
+        ascending=True)
 
-            if extra < 1:  # All combimation amounts have been distributed
-                break
+    # test whether it's possible to have this number of permutations with data structure
+    if num_perms > df.max_combs.sum():
+        raise ValueError(f'Max number of combinations is {df.max_combs.sum()}, you requested {num_perms}')
 
-            num_non_full_groups = len(df[df.overflow >= 0])
+    # Cap each n at its number of unique combinations and share what is left over between the ns that are not full
+    while True:
+        overflow = (df.num_combs - df.max_combs).clip(lower=0)
+        df.num_combs -= overflow
+        not_full = df.num_combs < df.max_combs
 
-            top_up_per_group = math.ceil(extra / num_non_full_groups)
-            for n, row in df.iterrows():
-                if n in groups_full:
-                    continue
-                # Add the topup amount
-                row.num_combs += top_up_per_group
+        if overflow.sum() < 1 or not not_full.any():  # All combination amounts have been distributed
+            break
 
-        # now generate the indices
-        indx = label_data.index
-        for n, row in df.iterrows():
+        df.loc[not_full, 'num_combs'] += math.ceil(overflow.sum() / not_full.sum())
 
-            combs_gen = itertools.combinations(indx, n)
-            for i, combresult in enumerate(combs_gen):
-                if i == row.num_combs:
-                    break
-                label_indices_result.append(combresult)
+    return df
 
-        result[label] = label_indices_result
-    return result
 
+def generate_random_two_way_combinations(data: pd.DataFrame, num_perms: int, seed: int = NULL_SEED) -> dict:
+    """
+    Draw the synthetic specimens of the two-way line-level null for each label. In each permutation the label's non-NaN
+    baselines are split at random into groups of len(baselines) // n_groups. The first three groups are the synthetic
+    mutants, synthetic treated specimens and synthetic interaction specimens. Labels with the same non-NaN baselines
+    share the same array
 
-def generate_random_two_way_combinations(data: pd.DataFrame, num_perms):
+    Parameters
+    ----------
+    data
+        columns: labels, line and optionally staging
+    num_perms
+        The number of permutations
+    seed
+        The seed of the random generator
+
+    Returns
+    -------
+    {label: (num_perms, n_groups - 1, group size) int32 array}. The values are the row positions of the synthetic
+    specimens in the baselines
+    """
     logger.info('generating permutations')
     data = data.drop(columns='staging', errors='ignore')
     line_specimen_counts = get_line_specimen_counts(data, two_way=True)
     n_groups = get_two_way_n_groups(data)
+    rng = np.random.default_rng(seed)
+
+    baselines = data[data.line == 'baseline'].drop(columns='line')
 
+    drawn = {}
     result = {}
     # now for each label calculate number of combinations we need for each
     for label in line_specimen_counts:
-        label_indices_result = []
-        counts = line_specimen_counts[label].value_counts()
-
-        number_of_lines = counts[counts.index != 0].sum()  # Drop the lines with zero labels (have been qc'd out)
-        ratios = counts[counts.index != 0] / number_of_lines
-        num_combs = num_perms * ratios
-
-        # get wt data for label
-        label_data = data[[label, 'line']]
-        label_data = label_data[label_data.line == 'baseline']
-        label_data = label_data[~label_data[label].isna()]
-
-        # Soret out the numnbers
-
-        # Sort out the numbers
-        records = []
-
-        for n, n_combs_to_try in num_combs.items():
-            n_combs_to_try = math.ceil(n_combs_to_try)
-            max_combs = two_way_max_combinations(n, n_groups)
-            # logger.info(f'max_combinations for n={n} and wt_n={len(label_data)} = {max_combs}')
-            records.append([n, n_combs_to_try, max_combs])
-        df = pd.DataFrame.from_records(records, columns=['n', 'num_combs', 'max_combs'], index='n').sort_index(
-            ascending=True)
-
-        # test whether it's possible to have this number of permutations with data structure
-        # so for the two-way this wont change
-        #print(f'Max combinations for label {label} is {max_combs}')
-        if num_perms > df.max_combs.sum():
-            raise ValueError(f'Max number of combinations is {max_combs}, you requested {num_perms}')
-
-
-        indx = label_data.index
+        rows = np.flatnonzero(~baselines[label].isna().values)
 
-        label_indices_result = []
-
-        # generate combinations for no. of desired perms
-        for perm in range(num_perms):
-            full_combination = recursive_comb_maker(indx, len(indx), n_groups - 1, i=1, recurs_results=[])
-            # print(full_combination)
+        max_combs = two_way_max_combinations(len(rows), n_groups)
+        if num_perms > max_combs:
+            raise ValueError(f'Max number of combinations is {max_combs}, you requested {num_perms}')
 
-            label_indices_result.append(full_combination)
-            # reset result list
-            recurs_results = []
+        key = rows.tobytes()
+        if key not in drawn:
+            partitions = random_partitions(len(rows), n_groups - 1, len(rows) // n_groups, num_perms, rng)
+            drawn[key] = rows[partitions].astype(np.int32)
+        result[label] = drawn[key]
 
-        result[label] = label_indices_result
     return result
 
 
@@ -244,7 +272,7 @@ def two_way_max_combinations(num_wts: int, n_groups: int) -> int:
     # I dont need n - you can get the total per group from the wts
     n_per_group = num_wts // n_groups
     comb_per_group = [(comb(num_wts - (n_per_group * i), n_per_group)) for i in range(0, n_groups)]
-    total_combs_for_n = np.product(comb_per_group)
+    total_combs_for_n = np.prod(comb_per_group)
     # Now weight based on how many lines have this n
     return int(total_combs_for_n)
 
@@ -286,7 +314,7 @@ def get_line_specimen_counts(input_data: pd.DataFrame, two_way: bool = False) ->
 
 
 def null(input_data: pd.DataFrame,
-         num_perm: int, two_way: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
+         num_perm: int, two_way: bool = False, null_dir: Path = None) -> Tuple[pd.DataFrame, pd.DataFrame, List]:
     """
     Generate null distributions for line and specimen-level data
 
@@ -305,6 +333,10 @@ def null(input_data: pd.DataFrame,
     two_way
         makes it a two-way null
 
+    null_dir
+        Where to keep the checkpointed line-level null (see null_store). If None, a temporary folder is used.
+        Not used for the two-way null
+
     Returns
     -------
     line-level null distribution
@@ -320,119 +352,238 @@ def null(input_data: pd.DataFrame,
     # Use the generic staging label from now on
     input_data.rename(columns={'crl': 'staging', 'volume': 'staging'}, inplace=True)
 
-    label_names = input_data.drop(['staging', 'line'], axis='columns').columns
-
-
-    # Store p-value and t-value results. One tuple (len==num labels) per iteration
-    spec_p = []
-
     # Create synthetic specimens by iteratively relabelling each baseline as synthetic mutant
     baselines = input_data[input_data['line'] == 'baseline']
 
     # Get the line specimen n numbers. Keep the first column
     # line_specimen_counts = get_line_specimen_counts(input_data)
-    # Pregenerate all the combinations
-    wt_indx_combinations = generate_random_two_way_combinations(input_data, num_perm) if two_way \
-        else generate_random_combinations(input_data, num_perm)
+    # Pregenerate all the combinations. The one-way line-level permutations are made as they are needed by null_store
+    if two_way:
+        wt_indx_combinations = generate_random_two_way_combinations(input_data, num_perm)
+
+    # Get the specimen-level null distribution. i.e. the distributuion of p-values obtained from relabelling each
+    # baseline once
+    spec_df = null_specimen(baselines, two_way=two_way)
 
-    # Split data into a numpy array of raw data and dataframe for staging and genotype fpr the LM code
-    data = baselines.drop(columns=['staging', 'line']).values
-    info = baselines[['staging', 'line']]
+    if two_way:
+        line_df = null_line(wt_indx_combinations, baselines, num_perm, two_way=two_way)
+    else:
+        line_df = null_line_checkpointed(input_data, num_perm, null_dir)
+    #print(line_df['x3'])
+    return strip_x([line_df, spec_df])
 
-    # just for testing rn
-    line_df = null_line(wt_indx_combinations, baselines, num_perm, two_way=two_way)
 
-    # Get the specimen-level null distribution. i.e. the distributuion of p-values obtained from relabelling each
-    # baseline once. Loop over each specimen and set to 'synth_hom'
-    if two_way:  # two-way flag
-        # so for two_way we have three spec tests - geno, treat and int
-        geno_info = info.copy()
-        treat_info = info.copy()
-        inter_info = info.copy()
-        for index, meta in info.iterrows():
+def null_specimen(baselines: pd.DataFrame, two_way: bool = False) -> pd.DataFrame:
+    """
+    Get the specimen-level null distribution. Each baseline in turn is relabelled as a synthetic mutant and tested against
+    the other baselines with label ~ genotype + staging.
 
-            geno_info.loc[:, 'genotype'] = 'wt'  # Set all genotypes to WT
-            geno_info.loc[:, 'treatment'] = 'veh'  # Set all treatments to vehicle
+    Only the synthetic mutant's row of the design changes between these fits, so they are not made one at a time. With
+    the intercept and staging projected out, the genotype t-statistic of a baseline is its residual scaled by its
+    leverage (the externally studentised residual), so all baselines and labels are done with a few array operations
+    (see _specimen_p).
 
-            treat_info.loc[:, 'genotype'] = 'wt'  # Set all genotypes to WT
-            treat_info.loc[:, 'treatment'] = 'veh'  # Set all treatments to vehicle
+    For two-way, each baseline gives three rows. The genotype and treatment tests are both the test above. In the
+    interaction test one other random baseline is also a synthetic mutant and another is a synthetic treated specimen
+    (drawn with recursive_comb_maker). The interaction fits of all the baselines are solved together (see
+    _interaction_p).
 
-            inter_info.loc[:, 'genotype'] = 'wt'  # Set all genotypes to WT
-            inter_info.loc[:, 'treatment'] = 'veh'  # Set all treatments to vehicle
-            
+    Parameters
+    ----------
+    baselines
+        columns: labels, staging, line
 
-            # now relabel based on the combinations
+    two_way
+        makes it a two-way null
 
-            #for geno effect label index as just synth mut:
-            geno_info.loc[[index], 'genotype'] = 'synth_mut'
+    Returns
+    -------
+    One row per baseline (three for two-way). Each entry is an array of p-values, one for each effect
 
-            #similarly for treatment:
-            treat_info.loc[[index], 'treatment'] = 'synth_treat'
+    Notes
+    -----
+    A label that is NaN for the synthetic mutant gets a NaN p-value. NaNs in the other baselines are dropped
+    """
+    labels = baselines.drop(columns=['staging', 'line'])
+    data = labels.values.astype(np.float64)
+    staging = baselines['staging'].values.astype(np.float64)
 
-            # So the first logical thing is synth index as the interaction
-            inter_info.loc[[index], 'genotype'] = 'synth_mut'
-            inter_info.loc[[index], 'treatment'] = 'synth_treat'
-            # then randomly assign 1/3 as mut and 1/3 as treat
-            # generate list but fuck the index off:
-            all_rows = info.drop(index).index.values
+    p = _specimen_p(data, staging)
 
-            #should be a list of two
-            combs = recursive_comb_maker(all_rows,n=len(all_rows),steps=2,i=1,recurs_results=[])
+    if two_way:
+        mut = []
+        treat = []
+        for index in baselines.index:
+            # The other baselines are split into three random groups. The first of the first two groups are the extra
+            # synthetic mutant and synthetic treated specimen
+            all_rows = baselines.drop(index).index.values
+            combs = recursive_comb_maker(all_rows, n=len(all_rows), steps=2, i=1, recurs_results=[])
+            mut.append(baselines.index.get_loc(combs[0][0]))
+            treat.append(baselines.index.get_loc(combs[1][0]))
+
+        inter_p = _interaction_p(data, staging, np.array(mut), np.array(treat))
+
+        spec_p = []
+        for i in range(len(data)):
+            spec_p.extend([p[i, :, np.newaxis], p[i, :, np.newaxis], inter_p[i]])
+    else:
+        spec_p = list(p[:, :, np.newaxis])
 
-            #assign synth int mutants
-            inter_info.loc[combs[0][0], 'genotype'] = 'synth_mut'
+    return pd.DataFrame.from_records(spec_p, columns=labels.columns)
 
-            #assign synth int treatments
-            inter_info.loc[combs[1][0], 'treatment'] = 'synth_treat'
 
-            for _info in [geno_info,treat_info,inter_info]:
-                row = data[_info.index.get_loc(index), :]
-                labels_to_skip = np.isnan(row)
-                if any(labels_to_skip):
-                    # Set the whole label column to zero. R:lm() will return NaN for this column
-                    d = np.copy(data)
-                    d[:, labels_to_skip] = 0.0
-                else:
-                    d = data
-                p,t = lm_sm(d, _info, two_way=True)  # TODO: move this to statsmodels
-                if len(p) != data.shape[1]:
-                    raise ValueError(
-                        f'The length of p-values results: {data.shape[1]} does not match the length of the input data: {len(p)}')
+def _row_groups(y: np.ndarray, staging: np.ndarray):
+    """
+    Group the labels by the baselines used in their fits. Baselines with a NaN label value or staging are dropped as
+    statsmodels does with missing='drop'. Labels that are all 0 or NaN are not fitted (see lm_sm)
 
-                spec_p.append(p)
+    Yields
+    ------
+    boolean mask of the baselines used, label columns
+    """
+    fit_cols = np.flatnonzero(np.nan_to_num(y).any(axis=0))
+    valid = ~np.isnan(y[:, fit_cols]) & ~np.isnan(staging)[:, np.newaxis]
+    row_patterns, pattern_idx = np.unique(valid.T, axis=0, return_inverse=True)
 
-    else:
-        for index, _ in info.iterrows():
-            info.loc[:, 'genotype'] = 'wt'  # Set all genotypes to WT
-            info.loc[[index], 'genotype'] = 'synth_hom'  # Set the ith baseline to synth hom
-            row = data[info.index.get_loc(index), :]
+    for i, rows in enumerate(row_patterns):
+        yield rows, fit_cols[pattern_idx.ravel() == i]
 
-            # Get columns (labels) where the mutant specimen (as it's line level)
-            # has a null value (i.e. This specimen is QC-flagged at these labels)
-            # Set all values to zero
-            labels_to_skip = np.isnan(row)
-            if any(labels_to_skip):
-                # Set the whole label column to zero. R:lm() will return NaN for this column
-                d = np.copy(data)
-                d[:, labels_to_skip] = 0.0
-            else:
-                d = data
 
-            # Get a p-value for each organ
-            p, t = lm_sm(d, info)  # TODO: move this to statsmodels
+def _specimen_p(y: np.ndarray, staging: np.ndarray) -> np.ndarray:
+    """
+    p-values of label ~ genotype + staging with each baseline in turn as the only synthetic mutant
 
-            # Check that there are equal amounts of p-values than there are data points
-            if len(p) != data.shape[1]:
-                raise ValueError(
-                    f'The length of p-values results: {data.shape[1]} does not match the length of the input data: {len(p)}')
+    The genotype indicator of baseline i, with the intercept and staging projected out, has a squared norm of 1 - h_i
+    (h_i is the leverage of the baseline) and its product with the projected labels is the baseline's residual. So the
+    genotype coefficient is r_i / (1 - h_i) and the residual sum of squares is rss - r_i^2 / (1 - h_i)
 
-            spec_p.append(p)
+    Parameters
+    ----------
+    y
+        (baselines, labels)
+    staging
+        (baselines,)
 
-    spec_df = pd.DataFrame.from_records(spec_p, columns=label_names)
+    Returns
+    -------
+    (baselines, labels) p-values. NaN where the baseline is not in the label's fit
+    """
+    p = np.full(y.shape, np.nan)
 
-    line_df = null_line(wt_indx_combinations, baselines, num_perm, two_way=two_way)
-    #print(line_df['x3'])
-    return strip_x([line_df, spec_df])
+    for rows, cols in _row_groups(y, staging):
+        df_resid = rows.sum() - 3  # intercept, genotype and staging
+        if df_resid < 1:
+            continue
+
+        q, _ = np.linalg.qr(np.column_stack([np.ones(rows.sum()), staging[rows]]))
+        y_rows = y[rows][:, cols]
+        resid = y_rows - q @ (q.T @ y_rows)
+        rss = np.einsum('ij,ij->j', resid, resid)
+        gg = 1 - np.einsum('ij,ij->i', q, q)[:, np.newaxis]
+
+        with np.errstate(divide='ignore', invalid='ignore'):
+            beta = resid / gg
+            t = beta / np.sqrt(np.maximum(rss - beta * resid, 0.0) / df_resid / gg)
+
+        p[np.ix_(rows, cols)] = 2 * stats.t.sf(np.abs(t), df_resid)
+
+    return p
+
+
+def _interaction_p(y: np.ndarray, staging: np.ndarray, mut: np.ndarray, treat: np.ndarray) -> np.ndarray:
+    """
+    p-values of label ~ genotype * treatment + staging for the two-way specimen-level null. For baseline i the synthetic
+    mutants are i and mut[i] and the synthetic treated specimens are i and treat[i].
+
+    The intercept and staging are projected out of the labels and of the genotype, treatment and interaction columns,
+    as in _null_line_thread. This leaves a 3x3 system per baseline, which are solved together for all the baselines and
+    labels
+
+    Parameters
+    ----------
+    y
+        (baselines, labels)
+    staging
+        (baselines,)
+    mut, treat
+        (baselines,) row of the extra synthetic mutant and synthetic treated specimen of each baseline
+
+    Returns
+    -------
+    (baselines, labels, 3) p-values of genotype, treatment and interaction (as the statsmodels terms genotype[T.wt],
+    treatment[T.veh] and genotype[T.wt]:treatment[T.veh]). NaN where the baseline is not in the label's fit or the
+    design is singular
+    """
+    n = len(y)
+    p = np.full(y.shape + (3,), np.nan)
+
+    # The genotype, treatment and interaction columns of each baseline's design
+    wt = np.ones((n, n))
+    wt[np.arange(n), np.arange(n)] = 0
+    veh = wt.copy()
+    wt[np.arange(n), mut] = 0
+    veh[np.arange(n), treat] = 0
+    design = np.stack([wt, veh, wt * veh], axis=2)
+
+    for rows, cols in _row_groups(y, staging):
+        df_resid = rows.sum() - 5  # intercept, genotype, treatment, interaction and staging
+        specs = np.flatnonzero(rows)
+        if df_resid < 1:
+            continue
+
+        q, _ = np.linalg.qr(np.column_stack([np.ones(rows.sum()), staging[rows]]))
+        y_rows = y[rows][:, cols]
+        resid = y_rows - q @ (q.T @ y_rows)
+        yy = np.einsum('ij,ij->j', resid, resid)
+
+        z = design[specs][:, rows]
+        z -= q @ np.einsum('ji,sjk->sik', q, z)
+
+        # The design is singular if a baseline's extra synthetic specimens are not in the label's fit
+        p[np.ix_(specs, cols)] = _design_p(z, resid, yy, df_resid)
+
+    return p
+
+
+def _design_p(z: np.ndarray, resid: np.ndarray, yy: np.ndarray, df_resid: int) -> np.ndarray:
+    """
+    p-values of the columns of a set of designs that differ only in their tested columns. The intercept and staging
+    must already be projected out of the tested columns and the labels. Used for the genotype * treatment designs of
+    the two-way nulls
+
+    Parameters
+    ----------
+    z
+        (designs, specimens, terms) the projected tested columns of each design
+    resid
+        (specimens, labels) the projected labels
+    yy
+        (labels,) the squared norms of resid
+    df_resid
+        The residual degrees of freedom of the full model
+
+    Returns
+    -------
+    (designs, labels, terms) p-values. NaN where the design is singular
+    """
+    p = np.full((len(z), resid.shape[1], z.shape[2]), np.nan)
+
+    ok = np.linalg.matrix_rank(z) == z.shape[2]
+    if not ok.any():
+        return p
+    z = z[ok]
+
+    zz_inv = np.linalg.inv(np.einsum('sji,sjk->sik', z, z))
+    zy = np.einsum('sji,jl->sil', z, resid)
+    beta = zz_inv @ zy
+    rss = np.maximum(yy - np.einsum('sil,sil->sl', beta, zy), 0.0)
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        se = np.sqrt(np.einsum('sii->si', zz_inv)[:, :, np.newaxis] * (rss / df_resid)[:, np.newaxis, :])
+        t = beta / se
+
+    p[ok] = (2 * stats.t.sf(np.abs(t), df_resid)).transpose(0, 2, 1)
+    return p
 
 
 def null_line(wt_indx_combinations: dict,
@@ -440,17 +591,19 @@ def null_line(wt_indx_combinations: dict,
               num_perms=1000, two_way:bool=False) -> pd.DataFrame:
     """
     Generate pvalue null distributions for all labels in 'data'
-    NaN values are excluded potentailly resultnig in different sets of specimens for each label. This makes it tricky to
-    use Rs vectorised lm() function, so we use statsmodels here and just loop over the data, with each label in its own
-    process using joblib.
+    NaN values are excluded potentailly resultnig in different sets of specimens for each label, so the labels are
+    fitted separately. They are shared between joblib processes in ranges of labels.
+
+    The label data, staging and the combination arrays are written once to memory-mapped .npy files, so the workers
+    are only sent their range of labels and the names of the files. Each worker writes its p-values into its columns
+    of a preallocated (permutations, labels) memory-mapped array
 
     Parameters
     ----------
-    line_specimen_counts
-        The number of specimens in each mutant line. Used to specify the number of synthetic mutants so the null
-        matches our data in terms of sample number
+    wt_indx_combinations
+        From generate_random_combinations or generate_random_two_way_combinations
     data
-        Label data in each column except last 2 which are 'staging' and 'genotype'
+        The baselines. Label data in each column and 'staging' and 'line' columns
     num_perms
         Usually about 10000
 
@@ -462,40 +615,64 @@ def null_line(wt_indx_combinations: dict,
     -----
     If QC has been applied to the data, we may have some NANs
     """
+    starttime = datetime.datetime.now()
+
+    labels = list(data.drop(['staging', 'line'], axis='columns', errors='ignore').columns)
+
+    with tempfile.TemporaryDirectory() as shared_dir:
+        shared_dir = Path(shared_dir)
+        np.save(shared_dir / NULL_LINE_VALUES_FILE, data[labels].values.astype(np.float64))
+        np.save(shared_dir / NULL_LINE_STAGING_FILE, data['staging'].values.astype(np.float64))
+
+        # Labels with the same baselines share their combinations, either the same array or leading slices of it
+        # (see generate_random_combinations). So each array is saved once, keyed by the array that owns its data and
+        # its offset and strides in that array. The owning arrays are kept alive by wt_indx_combinations
+        def key(arr):
+            base = arr
+            while isinstance(base.base, np.ndarray):
+                base = base.base
+            offset = arr.__array_interface__['data'][0] - base.__array_interface__['data'][0]
+            return id(base), offset, arr.strides, arr.shape[1:]
+
+        longest = {}
+        for label in labels:
+            for arr in (wt_indx_combinations[label] if not two_way else [wt_indx_combinations[label]]):
+                if len(arr) > len(longest.get(key(arr), ())):
+                    longest[key(arr)] = arr
+
+        files = {}
+        for i, (k, arr) in enumerate(longest.items()):
+            files[k] = f'combs_{i}.npy'
+            np.save(shared_dir / files[k], arr)
 
-    def prepare(label):
         if two_way:
-            return data[[label, 'staging', 'genotype','treatment']]
+            label_combs = [(files[key(wt_indx_combinations[label])], len(wt_indx_combinations[label]))
+                           for label in labels]
+            shape = (num_perms, len(labels), 3)
         else:
-            return data[[label, 'staging', 'genotype']]
+            label_combs = [[(files[key(arr)], len(arr)) for arr in wt_indx_combinations[label]] for label in labels]
+            shape = (max((sum(num for _, num in c) for c in label_combs), default=0), len(labels))
 
-    if two_way:
-        #make genotype and treatment cols
-        data['genotype'] = 'wt'
-        data['treatment'] = 'veh'
-        data = data.drop(['line'], axis='columns')
-    else:
-        data = data.rename(columns={'line': 'genotype'})
+        pvals = np.lib.format.open_memmap(shared_dir / NULL_LINE_PVALS_FILE, mode='w+', dtype=np.float64, shape=shape)
+        pvals[:] = np.nan
+        pvals.flush()
 
-    starttime = datetime.datetime.now()
+        # A few ranges of labels per process
+        chunk_size = max(1, math.ceil(len(labels) / (4 * (os.cpu_count() or 1))))
+        Parallel(n_jobs=-1)(delayed(_null_line_worker)(shared_dir, labels[i: i + chunk_size], i,
+                                                       label_combs[i: i + chunk_size], two_way)
+                            for i in tqdm(range(0, len(labels), chunk_size)))
 
-    cols = list(data.drop(['staging', 'genotype', 'treatment'], axis='columns').columns) if two_way else \
-        list(data.drop(['staging', 'genotype'], axis='columns').columns)
+        pvals = np.load(shared_dir / NULL_LINE_PVALS_FILE)
 
     # Apparently there may be spaces in the two_way radiomics data
+    cols = [col.strip(' ') for col in labels]
 
-    cols = [col.strip(' ') for col in cols]
-
-    # Run each label on a thread
     if two_way:
-        pdists = Parallel(n_jobs=-1)(delayed(_two_way_null_line_thread)
-                                     (prepare(i), num_perms, wt_indx_combinations, i) for i in tqdm(cols))
+        # Each entry is the array of genotype, treatment and interaction p-values
+        line_pdsist_df = pd.DataFrame({col: list(pvals[:, i]) for i, col in enumerate(cols)})
     else:
-        pdists = Parallel(n_jobs=-1)(delayed(_null_line_thread)
-                                 (prepare(i), num_perms, wt_indx_combinations, i) for i in tqdm(cols))
-
-    line_pdsist_df = pd.DataFrame(pdists).T
-    line_pdsist_df.columns = cols
+        line_pdsist_df = pd.DataFrame(pvals, columns=cols)
 
     endtime = datetime.datetime.now()
     elapsed = endtime - starttime
@@ -503,10 +680,110 @@ def null_line(wt_indx_combinations: dict,
     return line_pdsist_df
 
 
+def _null_line_worker(shared_dir: Path, labels: List[str], start: int, label_combs: List, two_way: bool):
+    """
+    Run _null_line_thread or _two_way_null_line_thread for a range of labels and write the p-values into their columns
+    of the shared p-value array (see null_line)
+
+    Parameters
+    ----------
+    shared_dir
+        Has the label data, staging, combinations and p-value array
+    labels
+        The names of the labels in the range
+    start
+        The column of the first label
+    label_combs
+        For each label, the combinations file and the number of its rows that are used. For one-way, a list of these
+        for each n
+    two_way
+        makes it a two-way null
+    """
+    values = np.load(shared_dir / NULL_LINE_VALUES_FILE, mmap_mode='r')
+    staging = np.load(shared_dir / NULL_LINE_STAGING_FILE, mmap_mode='r')
+    pvals = np.load(shared_dir / NULL_LINE_PVALS_FILE, mmap_mode='r+')
+
+    def load(file_name, num):
+        return np.load(shared_dir / file_name, mmap_mode='r')[:num]
+
+    for col, (label, combs) in enumerate(zip(labels, label_combs), start):
+        data = pd.DataFrame({label: values[:, col], 'staging': staging, 'genotype': 'wt'})
+
+        if two_way:
+            data['treatment'] = 'veh'
+            line_p = np.array(_two_way_null_line_thread(data, len(pvals), {label: load(*combs)}, label))
+        else:
+            line_p = np.array(_null_line_thread(data, len(pvals), {label: [load(*c) for c in combs]}, label))
+
+        pvals[:len(line_p), col] = line_p
+
+    pvals.flush()
+
+
+def null_line_checkpointed(input_data: pd.DataFrame, num_perms: int, null_dir: Path = None) -> pd.DataFrame:
+    """
+    Generate the one-way line-level null distributions for all labels using a NullStore. The permutations are shared
+    between the mutant line sizes as in generate_random_combinations, but are drawn and computed in blocks that are
+    saved as they finish, so a rerun only computes the blocks that are missing (see null_store)
+
+    Parameters
+    ----------
+    input_data
+        As null
+    num_perms
+        The number of permutations
+    null_dir
+        Where to keep the null distributions. If None, a temporary folder is used
+
+    Returns
+    -------
+    DataFrame of null distributions. Each label in a column
+    """
+    starttime = datetime.datetime.now()
+
+    data = input_data.drop(columns='staging', errors='ignore')
+    labels = list(data.drop(columns='line').columns)
+    baselines = input_data[input_data['line'] == 'baseline']
+    line_specimen_counts = get_line_specimen_counts(data)
+
+    with (tempfile.TemporaryDirectory() if null_dir is None else nullcontext(null_dir)) as store_dir:
+        store = NullStore(Path(store_dir), baselines, labels)
+        logger.info(f'Null distributions are stored in {store.dir}')
+
+        # The number of permutations of each n for each label, and of each group of labels that share the permutations
+        label_combs = {}
+        needed = {}
+        for label in labels:
+            num_combs = combinations_per_n(line_specimen_counts[label], num_perms, store.group_size(label)).num_combs
+            label_combs[label] = num_combs
+
+            group = store.label_group[label][0]
+            for n, num in num_combs.items():
+                needed[(group, n)] = max(needed.get((group, n), 0), int(num))
+
+        store.fill(needed)
+
+        pdists = [np.concatenate([store.pvalues(label, n, int(num)) for n, num in label_combs[label].items()])
+                  for label in labels]
+
+    line_pdsist_df = pd.DataFrame(pdists).T
+    # Apparently there may be spaces in the two_way radiomics data
+    line_pdsist_df.columns = [col.strip(' ') for col in labels]
+
+    logger.info(f'Time taken for null distribution calculation: {datetime.datetime.now() - starttime}')
+    return line_pdsist_df
+
+
 def _null_line_thread(*args) -> List[float]:
     """
     Create a null distribution for a single label.  This can put put onto a thread or process
 
+    The model label ~ genotype + staging is solved for all permutations at once. Only the genotype column of the design
+    changes between permutations, so the intercept and staging columns are factored (QR) once and projected out of both
+    the label data and the synthetic mutant indicators (Frisch-Waugh-Lovell). The genotype t-statistic of every
+    permutation then comes from a few matrix products. The p-values are the same as for C(genotype)[T.wt] from a
+    statsmodels fit of each permutation (tested in test_distributions)
+
     Returns
     -------
     pvalue distribution
@@ -515,86 +792,90 @@ def _null_line_thread(*args) -> List[float]:
 
     label = data.columns[0]
 
-    data = data.astype({label: np.float,
-                        'staging': np.float})
+    # Drop specimens with missing values as statsmodels does with missing='drop'
+    data = data[[label, 'staging']].astype(np.float64)
+    fit_rows = data.notna().all(axis=1).values
+    y = data[label].values[fit_rows]
 
-    synthetics_sets_done = []
+    q, _ = np.linalg.qr(np.column_stack([np.ones(len(y)), data['staging'].values[fit_rows]]))
+    y_resid = y - q @ (q.T @ y)
+    yy = y_resid @ y_resid
+    df_resid = len(y) - 3  # intercept, genotype and staging
 
     line_p = []
 
-    perms_done = 0
-
     # Get combinations of WT indices for current label
-    indxs = wt_indx_combinations[label]
-    for comb in indxs:
-        data.loc[:, 'genotype'] = 'wt'
-        data.loc[data.index.isin(comb), 'genotype'] = 'synth_hom'
-        # _label_synthetic_mutants(data, n, synthetics_sets_done)
+    for combs_n in wt_indx_combinations[label]:
+        for start in range(0, len(combs_n), PERM_CHUNK_SIZE):
+            combs = combs_n[start: start + PERM_CHUNK_SIZE]
+
+            # One row per permutation with the synthetic mutants set to 1
+            g = np.zeros((len(combs), len(data)))
+            g[np.arange(len(combs))[:, np.newaxis], combs] = 1.0
+            g = g[:, fit_rows]
 
-        perms_done += 1
+            g -= (g @ q) @ q.T
+            gy = g @ y_resid
+            gg = np.einsum('ij,ij->i', g, g)
 
-        model = smf.ols(formula=f'{label} ~ C(genotype) + staging', data=data, missing='drop')
-        fit = model.fit()
-        p = fit.pvalues['C(genotype)[T.wt]']
+            beta = gy / gg
+            rss = np.maximum(yy - beta * gy, 0.0)
+            t = beta / np.sqrt(rss / df_resid / gg)
+
+            line_p.extend(2 * stats.t.sf(np.abs(t), df_resid))
 
-        line_p.append(p)
     return line_p
 
 
-def _two_way_null_line_thread(*args) -> List[float]:
+def _two_way_null_line_thread(*args) -> List[np.ndarray]:
     """
-    same as _null_line_thread but for two way
-    TODO: merge two_way and null_threads
-    Parameters
-    ----------
-    args
+    Create a two-way null distribution for a single label, as _null_line_thread does for one-way.
+
+    The model label ~ genotype * treatment + staging is solved for all permutations at once. The intercept and staging
+    are projected out of the label data and of the genotype, treatment and interaction columns of each permutation,
+    leaving a 3x3 system per permutation (see _design_p). The p-values are the same as from a statsmodels fit of each
+    permutation (tested in test_distributions)
 
     Returns
     -------
-
+    For each permutation, the p-values of genotype, treatment and interaction
     """
     data, num_perms, wt_indx_combinations, label = args
-    # print('Generating null for', label)
 
     label = data.columns[0]
 
-    data = data.astype({label: np.float,
-                        'staging': np.float})
+    # Drop specimens with missing values as statsmodels does with missing='drop'
+    data = data[[label, 'staging']].astype(np.float64)
+    fit_rows = data.notna().all(axis=1).values
+    y = data[label].values[fit_rows]
 
-    synthetics_sets_done = []
+    q, _ = np.linalg.qr(np.column_stack([np.ones(len(y)), data['staging'].values[fit_rows]]))
+    y_resid = (y - q @ (q.T @ y))[:, np.newaxis]
+    yy = np.einsum('ij,ij->j', y_resid, y_resid)
+    df_resid = len(y) - 5  # intercept, genotype, treatment, interaction and staging
 
     line_p = []
 
-    perms_done = 0
+    combs_all = wt_indx_combinations[label]
+    for start in range(0, len(combs_all), PERM_CHUNK_SIZE):
+        combs = combs_all[start: start + PERM_CHUNK_SIZE]
+        perms = np.arange(len(combs))[:, np.newaxis]
 
-    # Get combinations of WT indices for current label
-    indxs = wt_indx_combinations[label]
-    for comb in indxs:
-        # set up genotype and treatment
-        data.loc[:, 'genotype'] = 'wt'
-        data.loc[:,'treatment'] = 'veh'
+        # The groups are the synthetic mutants, synthetic treated specimens and synthetic interaction specimens
+        wt = np.ones((len(combs), len(data)))
+        veh = np.ones((len(combs), len(data)))
+        wt[perms, combs[:, 0]] = 0
+        veh[perms, combs[:, 1]] = 0
+        wt[perms, combs[:, 2]] = 0
+        veh[perms, combs[:, 2]] = 0
+        z = np.stack([wt, veh, wt * veh], axis=2)[:, fit_rows]
 
-        # mains
-        data.loc[data.index.isin(comb[0]), 'genotype'] = 'synth_mut'
-        data.loc[data.index.isin(comb[1]), 'treatment'] = 'synth_treat'
+        z -= q @ np.einsum('ji,sjk->sik', q, z)
+        line_p.extend(_design_p(z, y_resid, yy, df_resid)[:, 0])
 
-        # interactions
-        data.loc[data.index.isin(comb[2]), 'genotype'] = 'synth_mut'
-        data.loc[data.index.isin(comb[2]), 'treatment'] = 'synth_treat'
-
-        # _label_synthetic_mutants(data, n, synthetics_sets_done)
-
-        perms_done += 1
-
-        fit = smf.ols(formula=f'{label} ~ genotype * treatment + staging', data=data, missing='drop').fit()
-        # get all pvals except intercept and staging
-
-        # fit.pvalues is a series - theefore you have to use .index
-        p = fit.pvalues[~fit.pvalues.index.isin(['Intercept','staging'])]
-        #pvalues go in the order of genotype, treatment, interaction.
-        line_p.append(p.values)
     return line_p
 
+
 def _label_synthetic_mutants(info: pd.DataFrame, n: int, sets_done: List) -> bool:
     """
     Given a dataframe of wild type data, relabel n baselines as synthetic mutant in place.
@@ -653,7 +934,8 @@ def strip_x(dfs):
 
 def alternative(input_data: pd.DataFrame,
                 plot_dir: Union[None, Path] = None,
-                boxcox: bool = False, two_way: bool = False) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
+                boxcox: bool = False, two_way: bool = False,
+                stats_runner: Callable = lm_sm) -> Tuple[pd.DataFrame, pd.DataFrame, pd.DataFrame, pd.DataFrame]:
     """
     Generate alterntive (mutant) distributions for line and pecimen-level data
 
@@ -662,6 +944,8 @@ def alternative(input_data: pd.DataFrame,
     input_data
     plot_dir
     boxcox
+    stats_runner
+        The linear model function to use. lm_sm or lm_np
 
     Returns
     -------
@@ -727,7 +1011,7 @@ def alternative(input_data: pd.DataFrame,
         p: np.array
         t: np.array
 
-        p, t = lm_sm(data, info, two_way=True)
+        p, t = stats_runner(data, info, two_way=True)
 
         res_p = ['two_way'] + list(p)  # line_name, label_1, label_2 ......
         alt_line_pvalues.append(res_p)
@@ -768,7 +1052,7 @@ def alternative(input_data: pd.DataFrame,
                 #print("info", info)
                 #print("type of info", type(info))
                 #print('Type of data', type(data[-1]), data[-1][0])
-                p, t = lm_sm(data, info, two_way=True)  # returns p_values for all organs, 1 iteration
+                p, t = stats_runner(data, info, two_way=True)  # returns p_values for all organs, 1 iteration
 
                 res_p = [line_id, specimen_id] + list(p)
                 alt_spec_pvalues.append(res_p)
@@ -812,7 +1096,7 @@ def alternative(input_data: pd.DataFrame,
             p: np.array
             t: np.array
 
-            p, t = lm_sm(data, info)  # returns p_values for all organs, 1 iteration
+            p, t = stats_runner(data, info)  # returns p_values for all organs, 1 iteration
 
             res_p = [line_id] + list(p)  # line_name, label_1, label_2 ......
             alt_line_pvalues.append(res_p)
@@ -840,7 +1124,7 @@ def alternative(input_data: pd.DataFrame,
 
             info = df_wt_mut[['genotype', 'staging']]
 
-            p, t = lm_sm(data, info)  # returns p_values for all organs, 1 iteration
+            p, t = stats_runner(data, info)  # returns p_values for all organs, 1 iteration
             res_p = [line_id, specimen_id] + list(p)
             alt_spec_pvalues.append(res_p)
 
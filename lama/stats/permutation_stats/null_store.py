@@ -0,0 +1,298 @@
+"""
+An on-disk, checkpointed store of the line-level null distribution used by the permutation stats.
+
+In each permutation of the line-level null, n baselines are relabelled as synthetic mutants, with n taken from the
+sizes of the mutant lines. The permutations for each n form a fixed sequence of unique random combinations. Each block
+of the sequence is drawn with its own seed, excluding the combinations in the blocks before it. The p-values are
+computed a block at a time, and each block is saved as soon as it is finished:
+
+    <store>/<key>/baselines.npy                  (baselines, labels) label values
+                  staging.npy                    (baselines,) staging
+                  <group>_n<n>/combs_00000.npy   (block, n) int32 indices of the synthetic mutants in the group
+                               pvals_00000.npy   (block, labels in the group) float64 p-values
+
+The key is made from the baseline data (specimen ids, label values and staging), the labels and the permutation seed.
+Labels that have the same non-NaN baselines are in the same group and share the permutations.
+
+So a run that crashes resumes from the last finished block. Adding a mutant line only needs the permutations for any
+new n. And asking for more permutations only computes the blocks that are not already in the store.
+"""
+
+from pathlib import Path
+from typing import List, Dict, Tuple
+import hashlib
+import json
+import math
+import os
+import tempfile
+
+import numpy as np
+import pandas as pd
+from scipy import stats
+from scipy.special import comb
+from joblib import Parallel, delayed
+from logzero import logger as logging
+
+from lama.stats.permutation_stats.sampling import random_combinations
+
+# Change this if the permutations or the model change so old stores are not used
+STORE_VERSION = 2
+NULL_SEED = 999
+BLOCK_SIZE = 1000  # Permutations per stored block
+LABEL_CHUNK_SIZE = 1000  # Labels per worker task
+
+BASELINES_FILE = 'baselines.npy'
+STAGING_FILE = 'staging.npy'
+SHARD_SUFFIX = '.partial.npy'  # A block's p-values while they are being written
+
+
+class NullStore:
+    def __init__(self, store_dir: Path, baselines: pd.DataFrame, labels: List[str], seed: int = NULL_SEED):
+        """
+        Parameters
+        ----------
+        store_dir
+            Where to keep the null distributions. Made if it does not exist. Can be shared between analyses
+        baselines
+            The baseline specimens. Columns include the labels and 'staging'
+        labels
+            The label columns
+        seed
+            The permutation seed
+        """
+        self.labels = list(labels)
+        self.seed = seed
+        self.values = baselines[self.labels].to_numpy(dtype=np.float64)
+        self.staging = baselines['staging'].to_numpy(dtype=np.float64)
+
+        data_hash = hashlib.sha1(np.ascontiguousarray(np.column_stack([self.values, self.staging])).tobytes())
+        parts = {'version': STORE_VERSION,
+                 'baselines': [str(x) for x in baselines.index],
+                 'data': data_hash.hexdigest(),
+                 'labels': self.labels,
+                 'seed': seed}
+        self.key = hashlib.sha1(json.dumps(parts, sort_keys=True).encode()).hexdigest()[:16]
+
+        self.dir = Path(store_dir) / self.key
+        self.dir.mkdir(parents=True, exist_ok=True)
+
+        info_file = self.dir / 'info.json'
+        if not info_file.is_file():
+            with open(info_file, 'w') as fh:
+                json.dump(parts, fh, indent=1)
+
+        # Group the labels by their non-NaN baselines. The permutations are drawn from these baselines
+        masks = ~np.isnan(self.values)
+        patterns, inverse = np.unique(masks.T, axis=0, return_inverse=True)
+        inverse = inverse.ravel()
+
+        self.groups: List[Tuple[np.ndarray, np.ndarray]] = []  # (baseline rows, label columns)
+        self.label_group: Dict[str, Tuple[int, int]] = {}  # label: (group, column within the group)
+
+        for g, pattern in enumerate(patterns):
+            cols = np.flatnonzero(inverse == g)
+            self.groups.append((np.flatnonzero(pattern), cols))
+            for i, col in enumerate(cols):
+                self.label_group[self.labels[col]] = (g, i)
+
+        self._combs: Dict[Tuple[int, int], List[np.ndarray]] = {}  # (group, n): combinations of each block
+
+    def group_size(self, label: str) -> int:
+        """
+        Number of baselines the permutations of a label are drawn from
+        """
+        return len(self.groups[self.label_group[label][0]][0])
+
+    def _mask_hash(self, group: int) -> str:
+        rows = self.groups[group][0]
+        return hashlib.sha1(rows.astype(np.int64).tobytes()).hexdigest()[:10]
+
+    def _dir(self, group: int, n: int) -> Path:
+        return self.dir / f'{self._mask_hash(group)}_n{n}'
+
+    def _max_combs(self, group: int, n: int) -> int:
+        return int(comb(len(self.groups[group][0]), n, exact=True))
+
+    def _num_blocks(self, group: int, n: int, num_perms: int) -> int:
+        return math.ceil(min(num_perms, self._max_combs(group, n)) / BLOCK_SIZE)
+
+    def fill(self, needed: Dict[Tuple[int, int], int], n_jobs: int = -1):
+        """
+        Compute any blocks that are missing from the store
+
+        Parameters
+        ----------
+        needed
+            {(group, n): number of permutations}
+        n_jobs
+            joblib processes
+        """
+        tasks = []
+        num_done = 0
+        for (group, n), num_perms in sorted(needed.items()):
+            for block in range(self._num_blocks(group, n, num_perms)):
+                if (self._dir(group, n) / f'pvals_{block:05d}.npy').is_file():
+                    num_done += 1
+                else:
+                    tasks.append((group, n, block))
+
+        logging.info(f'Null distribution: {num_done} blocks of {BLOCK_SIZE} permutations already done. '
+                     f'{len(tasks)} to do')
+
+        if not tasks:
+            return
+
+        # The workers read the baselines from the store rather than each being sent a copy
+        for name, arr in [(BASELINES_FILE, self.values), (STAGING_FILE, self.staging)]:
+            if not (self.dir / name).is_file():
+                _save_atomic(self.dir / name, arr)
+
+        # Run a batch of blocks at a time and save them as they finish. Each worker gets a range of a block's labels and
+        # writes its p-values into the block's shard. A shard is renamed to the block's p-value file once it is complete
+        batch_size = 2 * (os.cpu_count() or 1)
+
+        with Parallel(n_jobs=n_jobs) as parallel:
+            for start in range(0, len(tasks), batch_size):
+                batch = tasks[start: start + batch_size]
+                jobs = []
+
+                for group, n, block in batch:
+                    rows, cols = self.groups[group]
+                    combs = self._combinations(group, n, block)
+                    block_dir = self._dir(group, n)
+                    block_dir.mkdir(exist_ok=True)
+                    np.save(block_dir / f'combs_{block:05d}.npy', combs)
+
+                    shard = block_dir / f'pvals_{block:05d}{SHARD_SUFFIX}'
+                    np.lib.format.open_memmap(shard, mode='w+', dtype=np.float64, shape=(len(combs), len(cols)))
+
+                    for col_start in range(0, len(cols), LABEL_CHUNK_SIZE):
+                        jobs.append(delayed(_null_block_worker)(self.dir, rows, cols, col_start,
+                                                                min(col_start + LABEL_CHUNK_SIZE, len(cols)),
+                                                                block_dir / f'combs_{block:05d}.npy', shard))
+                parallel(jobs)
+
+                for group, n, block in batch:
+                    block_dir = self._dir(group, n)
+                    os.replace(block_dir / f'pvals_{block:05d}{SHARD_SUFFIX}', block_dir / f'pvals_{block:05d}.npy')
+
+                logging.info(f'Null distribution: {min(start + batch_size, len(tasks))} of {len(tasks)} blocks done')
+
+    def _combinations(self, group: int, n: int, block: int) -> np.ndarray:
+        """
+        The synthetic mutants of a block of permutations as indices into the group's baselines. A block is drawn with a
+        seed made from the store seed, the group, n and the block number, and excludes the combinations of the blocks
+        before it. So it needs those blocks, which are read from the store or drawn first
+        """
+        done = self._combs.setdefault((group, n), [])
+        block_dir = self._dir(group, n)
+
+        while len(done) <= block:
+            b = len(done)
+            combs_file = block_dir / f'combs_{b:05d}.npy'
+            if (block_dir / f'pvals_{b:05d}.npy').is_file():
+                done.append(np.load(combs_file))
+                continue
+
+            num_combs = min(BLOCK_SIZE, self._max_combs(group, n) - b * BLOCK_SIZE)
+            rng = np.random.default_rng([self.seed, int(self._mask_hash(group), 16), n, b])
+            previous = np.concatenate(done) if done else None
+            done.append(random_combinations(len(self.groups[group][0]), n, num_combs, rng, exclude=previous))
+
+        return done[block]
+
+    def pvalues(self, label: str, n: int, num_perms: int) -> np.ndarray:
+        """
+        The p-values of the first num_perms permutations of a label with n synthetic mutants. The blocks must be in the
+        store (see fill)
+        """
+        group, col = self.label_group[label]
+        block_dir = self._dir(group, n)
+
+        result = []
+        for block in range(self._num_blocks(group, n, num_perms)):
+            result.append(np.load(block_dir / f'pvals_{block:05d}.npy', mmap_mode='r')[:, col])
+
+        if not result:
+            return np.empty(0)
+        return np.concatenate(result)[:num_perms]
+
+
+def _save_atomic(path: Path, arr: np.ndarray):
+    fd, tmp = tempfile.mkstemp(dir=path.parent, suffix='.tmp')
+    with os.fdopen(fd, 'wb') as fh:
+        np.save(fh, arr)
+    os.replace(tmp, path)
+
+
+def _null_block_worker(store_dir: Path, rows: np.ndarray, cols: np.ndarray, start: int, stop: int, combs_file: Path,
+                       shard: Path):
+    """
+    Compute the p-values of labels start:stop of a group for a block of permutations and write them into the block's
+    shard. The baselines, the combinations and the shard are memory mapped, so nothing large is sent to the worker
+
+    Parameters
+    ----------
+    store_dir
+        The store, which has the baseline values and staging
+    rows, cols
+        The baseline rows and label columns of the group
+    start, stop
+        The range of the group's labels to do
+    combs_file
+        The block's combinations
+    shard
+        The block's (permutations, labels in the group) p-value array
+    """
+    values = np.load(store_dir / BASELINES_FILE, mmap_mode='r')
+    staging = np.load(store_dir / STAGING_FILE, mmap_mode='r')
+
+    pvals = _null_block(values[np.ix_(rows, cols[start: stop])], staging[rows], np.load(combs_file))
+
+    out = np.load(shard, mmap_mode='r+')
+    out[:, start: stop] = pvals
+    out.flush()
+
+
+def _null_block(y: np.ndarray, staging: np.ndarray, combs: np.ndarray) -> np.ndarray:
+    """
+    p-values of the genotype effect for a block of permutations, for all the labels of a group at once.
+
+    As distributions._null_line_thread, the model label ~ genotype + staging is solved with the intercept and staging
+    projected out of the labels and the synthetic mutant indicators
+
+    Parameters
+    ----------
+    y
+        (baselines, labels) values with no NaNs
+    staging
+        (baselines,) staging. Baselines with no staging value are dropped
+    combs
+        (permutations, n) indices of the synthetic mutants
+
+    Returns
+    -------
+    (permutations, labels) p-values
+    """
+    fit_rows = ~np.isnan(staging)
+    y = y[fit_rows]
+
+    q, _ = np.linalg.qr(np.column_stack([np.ones(len(y)), staging[fit_rows]]))
+    y_resid = y - q @ (q.T @ y)
+    yy = np.einsum('ij,ij->j', y_resid, y_resid)
+    df_resid = len(y) - 3  # intercept, genotype and staging
+
+    # One row per permutation with the synthetic mutants set to 1
+    g = np.zeros((len(combs), len(staging)))
+    g[np.arange(len(combs))[:, np.newaxis], combs] = 1.0
+    g = g[:, fit_rows]
+
+    g -= (g @ q) @ q.T
+    gy = g @ y_resid
+    gg = np.einsum('ij,ij->i', g, g)[:, np.newaxis]
+
+    beta = gy / gg
+    rss = np.maximum(yy - beta * gy, 0.0)
+    t = beta / np.sqrt(rss / df_resid / gg)
+
+    return 2 * stats.t.sf(np.abs(t), df_resid)
@@ -5,10 +5,13 @@ Given a Null and Altertiove distribution of a parameter (organ)
 return a p-value threshold so that the false discovery will be set to 5%.
 """
 
+from typing import Tuple
+
 import pandas as pd
 import numpy as np
 
 TESTING = False  # If set to true the p-threshold will be set high an dthe fdr < 0.05
+BLOCK_SIZE = 2 ** 22  # Approximate number of p-values sorted at once
 
 
 # to get some positive hits for testing
@@ -21,6 +24,9 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
     Given a wild type null distribution of p-values and a alternative (mutant)  distribution
     find the largest p-value threshold that would give a FDR < 0.05
 
+    The p-values of all labels (and effects) are sorted once, and the FDR at every candidate threshold is computed from
+    cumulative counts of the null and alternative p-values below it (see _thresholds)
+
     Parameters
     ----------
     null_dist
@@ -33,6 +39,9 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
 
     target_threshold
         The target FDR threshold
+    two_way
+        Each entry is an array of p-values, one for each effect (genotype, treatment, interaction)
+
     Returns
     -------
     pd.DataFrame
@@ -43,171 +52,137 @@ def get_thresholds(null_dist: pd.DataFrame, alt_dist: pd.DataFrame, target_thres
             num_null, num_null_<=_thresh, num_alt, num_alt_<=_thresh]
 
     """
-    results = []
-
-    # Prevent overwriting originals
-    null_dist = null_dist.copy()
-    alt_dist = alt_dist.copy()
-
-    for label in null_dist:
+    labels = list(null_dist.columns)
+    effect_list = ['genotype', 'treatment', 'interaction']
 
-        if two_way:
-            # TODO seem if you can improve performance
-            # convert this back to an array
+    if two_way:
+        # One column for each label and effect. The effects of a label are adjacent
+        wt_pvals = [np.vstack(null_dist[label].values).astype(float) for label in labels]
+        n_effects = wt_pvals[0].shape[1] if labels else 0
+        wt_pvals = np.hstack(wt_pvals) if labels else np.empty((len(null_dist), 0))
+        mut_pvals = (np.hstack([np.vstack(alt_dist[label].values).astype(float) for label in labels])
+                     if labels else np.empty((len(alt_dist), 0)))
+    else:
+        n_effects = 1
+        wt_pvals = null_dist[labels].to_numpy(dtype=float)
+        mut_pvals = alt_dist[labels].to_numpy(dtype=float)
 
-            wt_pvals = np.vstack(null_dist[label].values).transpose()
-            mut_pvals = np.vstack(alt_dist[label].values).transpose()
+    p_thresh, best_fdr, num_null_lt_thresh, num_hits = _thresholds(wt_pvals, mut_pvals, target_threshold)
 
-            # Join array and vstack them - transpose so the effects are rows
-            all_p = np.concatenate((wt_pvals, mut_pvals), axis=1)
+    num_null = len(wt_pvals)
+    num_alt = len(mut_pvals)
 
-            # sort for each effect
+    results = []
 
-            for row in all_p:
-                row.sort()
+    for col in range(len(p_thresh)):
+        label = labels[col // n_effects]
 
-            # crete empty lists
+        if np.isnan(p_thresh[col]):  # No candidate thresholds
+            record = [np.nan, 1, 'NA', 'NA', 'NA', 0]
+        else:
+            record = [p_thresh[col], best_fdr[col], num_null, int(num_null_lt_thresh[col]), num_alt,
+                      int(num_hits[col])]
 
-            p_fdr_df = []
+        if two_way:
+            results.append([int(label), effect_list[col % n_effects]] + record)
+        else:
+            results.append([int(label)] + record)
 
-            # iterate for each effect
-            for i, row in enumerate(all_p):
-                pthresh_fdrs = []
-                row = [x for x in row if x <= 0.05]
-                # what to do if the rows are empty
-                for p_to_test in row:
-                    # basically index only compares the correct effect
+    if two_way:
+        header = ['label', 'effect', 'p_thresh', 'fdr',
+                  'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
 
-                    fdr_at_thresh = fdr_calc(wt_pvals[i], mut_pvals[i], p_to_test)
+        result_df = pd.DataFrame.from_records(results, columns=header, index='label')
+        result_df.sort_values(by=['label','effect'], inplace=True)
 
-                    if fdr_at_thresh is not None:
-                        pthresh_fdrs.append((p_to_test, fdr_at_thresh))
+    else:
+        header = ['label', 'p_thresh', 'fdr',
+                  'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
 
-                p_fdr = pd.DataFrame.from_records(pthresh_fdrs, columns=['p', 'fdr'])
+        result_df = pd.DataFrame.from_records(results, columns=header, index='label')
+        result_df.sort_values(by='label', inplace=True)
 
-                p_fdr_df.append(p_fdr)
+    return result_df
 
 
+def _thresholds(null_pvals: np.ndarray, alt_pvals: np.ndarray, target_threshold: float
+                ) -> Tuple[np.ndarray, np.ndarray, np.ndarray, np.ndarray]:
+    """
+    Find the p-value threshold for each column of the null and alternative p-values.
 
-            # enumerate for performance
-            for i, p_fdr in enumerate(p_fdr_df):
+    The candidate thresholds are all the null and alternative p-values <= 0.05. For each candidate, the FDR (see
+    fdr_calc) is the proportion of null p-values below it over the proportion of alternative p-values below it. The
+    threshold is the largest candidate with an FDR <= target_threshold, or if there are none, the candidate with the
+    lowest FDR. Candidates with no alternative p-values below them are not used.
 
-                if len(p_fdr) > 0:
-                    p_under_target_fdr = p_fdr[p_fdr.fdr <= target_threshold]
+    The null and alternative p-values of each column are sorted together once. The counts of each below every
+    candidate are then cumulative sums over the sorted values, taken at the first of any tied values.
 
-                    if len(p_under_target_fdr) < 1:
-                        lowest_fdr_row = p_fdr.loc[p_fdr['fdr'].idxmin()]
-                        p_thresh = lowest_fdr_row['p']
-                        best_fdr = lowest_fdr_row['fdr']
-                    else:
-                        row = p_fdr.loc[p_under_target_fdr.p.idxmax()]
-                        p_thresh = row['p']
-                        best_fdr = row['fdr']
+    Parameters
+    ----------
+    null_pvals
+        (num null, columns)
+    alt_pvals
+        (num alt, columns)
+    target_threshold
+        The target FDR
 
-                    num_hits = len(mut_pvals[i][mut_pvals[i] <= p_thresh])
-                    num_null = len(wt_pvals[i])
-                    num_alt = len(mut_pvals[i])
+    Returns
+    -------
+    p-value thresholds (nan if there are no candidates), their FDRs (1 if no candidates), number of null p-values <=
+    the threshold, number of alternative p-values <= the threshold
+    """
+    n_null = len(null_pvals)
+    n_alt = len(alt_pvals)
+    n_cols = null_pvals.shape[1]
 
-                    num_null_lt_thresh = len(wt_pvals[i][wt_pvals[i] <= p_thresh])
+    p_thresh = np.full(n_cols, np.nan)
+    best_fdr = np.ones(n_cols)
+    num_null_lt = np.zeros(n_cols, dtype=int)
+    num_alt_lt = np.zeros(n_cols, dtype=int)
 
-                else:
-                    best_fdr = 1
-                    p_thresh = np.NAN
-                    num_hits = 0
-                    num_null, num_null_lt_thresh, num_alt = ['NA'] * 3
+    n = n_null + n_alt
+    block = max(1, BLOCK_SIZE // max(1, n))
 
-                effect_list = ['genotype', 'treatment', 'interaction']
-                results.append([int(label), effect_list[i], p_thresh, best_fdr,
-                                num_null, num_null_lt_thresh, num_alt, num_hits])
+    for c0 in range(0, n_cols, block):
+        c1 = min(c0 + block, n_cols)
+        cols = np.arange(c1 - c0)
 
+        pvals = np.concatenate([null_pvals[:, c0: c1], alt_pvals[:, c0: c1]])
+        order = np.argsort(pvals, axis=0, kind='stable')  # nans last
+        sorted_p = np.take_along_axis(pvals, order, axis=0)
+        is_alt = order >= n_null
 
-        else:
-            wt_pvals = null_dist[label].values
-            mut_pvals = alt_dist[label].values
-
-            wt_pvals.sort()
-            mut_pvals.sort()
-            all_p = list(wt_pvals) + list(mut_pvals)
-            all_p.sort()
-            pthresh_fdrs = []
-            # For every available p-value from the null + alternative distributions, That is lower than 0.05
-            # get the associated FDR for that threshold
-            all_p = [x for x in all_p if x <= 0.05]
-            for p_to_test in all_p:
-
-                fdr_at_thresh = fdr_calc(wt_pvals, mut_pvals, p_to_test)
-
-                if fdr_at_thresh is not None:
-                    pthresh_fdrs.append((p_to_test, fdr_at_thresh))
-
-            # create a dataframe of p-value thresholds and associated fdrs
-            p_fdr_df = pd.dataframe.from_records(pthresh_fdrs, columns=['p', 'fdr'])
-
-            if len(p_fdr_df) > 0:
-                p_under_target_fdr = p_fdr_df[p_fdr_df.fdr <= target_threshold]
-
-                if len(p_under_target_fdr) < 1:
-                    lowest_fdr_row = p_fdr_df.loc[p_fdr_df['fdr'].idxmin()]
-                    p_thresh = lowest_fdr_row['p']
-                    best_fdr = lowest_fdr_row['fdr']
-                else:
-                    row = p_fdr_df.loc[p_under_target_fdr.p.idxmax()]
-                    p_thresh = row['p']
-                    best_fdr = row['fdr']
-
-                # Total number of parameters across all lines that are below our p-value threshold
-                num_hits = len(mut_pvals[mut_pvals <= p_thresh])
-
-                num_null = len(wt_pvals)
-                num_alt = len(mut_pvals)
-
-                num_null_lt_thresh = len(wt_pvals[wt_pvals <= p_thresh])
-                # num_alt_lt_thresh = len(mut_pvals[mut_pvals <= p_thresh])
-
-            else:
-                best_fdr = 1
-                p_thresh = np.NAN
-                num_hits = 0
-                num_null, num_null_lt_thresh, num_alt = ['NA'] * 3
-
-            results.append([int(label), p_thresh, best_fdr,
-                            num_null, num_null_lt_thresh, num_alt, num_hits])
-
-            # iteration over each group needs to be done separately
-
-            #     if n_accept_pvals < 1:
-            #         # No acceptable p-value threshold for this label. Choose minimum fdr.
-            #         lowest_fdr_row = [p_fdr.loc[p_fdr['fdr'].idxmin()] for p_fdr in p_fdr_df]
-            #         p_thresh = [row['p'] for row in lowest_fdr_row]
-            #         best_fdr = [row['fdr'] for row in lowest_fdr_row]
-            #
-            # elif two_way:
-            #     # this is amazing if it works
-            #     rows = []
-            #     for i, p_fdr in enumerate(p_fdr_df):
-            #         rows.append(p_fdr.loc[p_under_target_fdr[i].p.idxmax()])
-            #     p_thresh = [row['p'] for row in rows]
-            #     best_fdr = [row['fdr'] for row in rows]
-
-        # TODO: what about if the labels are not numbers
+        # Index of the first of each run of tied values, so the counts are of p-values strictly below the candidate
+        positions = np.arange(n)[:, None]
+        new_value = np.ones(sorted_p.shape, dtype=bool)
+        new_value[1:] = sorted_p[1:] != sorted_p[:-1]
+        first = np.maximum.accumulate(np.where(new_value, positions, 0), axis=0)
 
-    if two_way:
-        header = ['label', 'effect', 'p_thresh', 'fdr',
-                  'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
+        alt_before = np.cumsum(is_alt, axis=0) - is_alt
+        alt_lt = np.take_along_axis(alt_before, first, axis=0)
+        null_lt = first - alt_lt
 
-        result_df = pd.DataFrame.from_records(results, columns=header, index='label')
-        result_df.sort_values(by=['label','effect'], inplace=True)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            fdrs = np.clip((null_lt / n_null) / (alt_lt / n_alt), 0, 1)
 
-    else:
-        header = ['label', 'p_thresh', 'fdr',
-                  'num_null', 'num_null_lt_thresh', 'num_alt', 'num_alt_lt_thresh']
+        candidate = (sorted_p <= 0.05) & (alt_lt > 0)
+        under_target = candidate & (fdrs <= target_threshold)
 
-        result_df = pd.DataFrame.from_records(results, columns=header, index='label')
-        result_df.sort_values(by='label', inplace=True)
+        # The largest p-value under the target FDR. Otherwise the first with the lowest FDR
+        last_under = n - 1 - np.argmax(under_target[::-1], axis=0)
+        lowest = np.argmin(np.where(candidate, fdrs, np.inf), axis=0)
+        chosen = np.where(under_target.any(axis=0), last_under, lowest)
 
+        found = candidate.any(axis=0)
+        thresh = sorted_p[chosen, cols]
 
+        p_thresh[c0: c1] = np.where(found, thresh, np.nan)
+        best_fdr[c0: c1] = np.where(found, fdrs[chosen, cols], 1)
+        num_null_lt[c0: c1] = (null_pvals[:, c0: c1] <= thresh).sum(axis=0)
+        num_alt_lt[c0: c1] = (alt_pvals[:, c0: c1] <= thresh).sum(axis=0)
 
-    return result_df
+    return p_thresh, best_fdr, num_null_lt, num_alt_lt
 
 
 def fdr_calc(null_pvals, alt_pvals, thresh, two_way=False) -> float:
@@ -55,6 +55,7 @@ from lama.paths import specimen_iterator, get_specimen_dirs, LamaSpecimenData
 from lama.qc.organ_vol_plots import make_plots, pvalue_dist_plots
 from lama.common import write_array, read_array, init_logging, git_log, LamaDataException
 from lama.stats.common import cohens_d
+from lama.stats import linear_model
 from lama.stats.penetrence_expressivity_plots import heatmaps_for_permutation_stats
 
 GENOTYPE_P_COL_NAME = 'genotype_effect_p_value'
@@ -652,7 +653,9 @@ def run(wt_dir: Path,
         two_way: bool = False,
         treat_dir: Path = None,
         inter_dir: Path = None,
-        rad_dir: Path = None):
+        rad_dir: Path = None,
+        stats_runner: str = 'lm_sm',
+        null_dir: Path = None):
     """
     Run the permutation-based stats pipeline
 
@@ -690,7 +693,18 @@ def run(wt_dir: Path,
         For calcualting organ volumes
     two_way
         Activates the two-way simulation
+    stats_runner
+        The linear model function to use for the alternative distributions.
+        'lm_sm' (statsmodels) or 'lm_np' (numpy, all labels fitted together)
+    null_dir
+        Where to keep the checkpointed line-level null distributions. A rerun with the same baselines resumes or reuses
+        them, and a rerun with a larger num_perms only computes the extra permutations.
+        Defaults to out_dir/distributions/null_store
     """
+    if stats_runner not in ('lm_sm', 'lm_np'):
+        raise ValueError(f"stats_runner should be 'lm_sm' or 'lm_np' not {stats_runner}")
+    lm_func = linear_model.STATS_RUNNERS[stats_runner]
+
     # Collate all the staging and organ volume data into csvs
     np.random.seed(999)
     init_logging(out_dir / 'stats.log')
@@ -760,7 +774,9 @@ def run(wt_dir: Path,
 
     # Get the null distributions
     logging.info('Generating null distribution')
-    line_null, specimen_null = distributions.null(data, num_perms, two_way=two_way)
+    if null_dir is None:
+        null_dir = dists_out / 'null_store'
+    line_null, specimen_null = distributions.null(data, num_perms, two_way=two_way, null_dir=null_dir)
 
     # with open(dists_out / 'null_ids.yaml', 'w') as fh:
     #     yaml.dump(null_ids, fh)
@@ -775,7 +791,8 @@ def run(wt_dir: Path,
 
     # Get the alternative p-value distribution (and t-values now (2 and 3)
     logging.info('Generating alternative distribution')
-    line_alt, spec_alt, line_alt_t, spec_alt_t = distributions.alternative(data, two_way=two_way)
+    line_alt, spec_alt, line_alt_t, spec_alt_t = distributions.alternative(data, two_way=two_way,
+                                                                                    stats_runner=lm_func)
 
     line_alt_pvals_file = dists_out / 'alt_line_dist_pvalues.csv'
     spec_alt_pvals_file = dists_out / 'alt_specimen_dist_pvalues.csv'
@@ -0,0 +1,196 @@
+"""
+Random sampling of the synthetic mutants for the line-level null distributions.
+
+The permutations are drawn as integer index arrays rather than tuples of specimen ids. Each row of an array is one
+permutation and holds the (sorted) indices of the baselines that are relabelled as synthetic mutants.
+"""
+
+import math
+from itertools import combinations, chain
+from typing import Callable, Tuple, Iterator
+
+import numpy as np
+from scipy.special import comb
+
+# If the number of possible combinations is no more than this multiple of the number needed, they are all enumerated
+# and sampled from. Otherwise random subsets are drawn and duplicates rejected, which is then cheap
+ENUMERATE_RATIO = 4
+
+# The maximum number of random values drawn in one round of rejection sampling (80 MB of float64). Bounds the memory
+# used when many permutations are drawn from many baselines
+MAX_BATCH_ELEMENTS = 10_000_000
+
+
+def random_combinations(num_items: int, n: int, num_combs: int, rng: np.random.Generator,
+                        exclude: np.ndarray = None) -> np.ndarray:
+    """
+    Draw unique n-subsets of range(num_items) uniformly at random
+
+    Parameters
+    ----------
+    num_items
+        The number of items (baselines) to choose from
+    n
+        The size of each subset
+    num_combs
+        The number of subsets to draw
+    rng
+        The random generator
+    exclude
+        (m, n) subsets that must not be drawn again. For example from an earlier block of permutations
+
+    Returns
+    -------
+    (num_combs, n) int32. Each row is a subset in ascending order. The rows are in the order they were drawn
+
+    Raises
+    ------
+    ValueError
+        If there are not num_combs subsets left to draw
+    """
+    if exclude is None:
+        exclude = np.empty((0, n), dtype=np.int32)
+
+    max_combs = int(comb(num_items, n, exact=True))
+    if num_combs > max_combs - len(exclude):
+        raise ValueError(f'Cannot draw {num_combs} combinations of {n} from {num_items}. '
+                         f'{max_combs - len(exclude)} are left')
+
+    if num_combs == 0:
+        return np.empty((0, n), dtype=np.int32)
+
+    # The key of a subset is the XOR of a random 64 bit number for each of its items (Zobrist hashing). Equal subsets
+    # always have equal keys. A collision between different subsets only means a subset is not drawn
+    weights = np.random.default_rng(0).integers(0, np.iinfo(np.int64).max, num_items, dtype=np.int64)
+    seen = _keys(exclude, weights)
+
+    if max_combs <= ENUMERATE_RATIO * (num_combs + len(exclude)):
+        all_combs = np.fromiter(chain.from_iterable(combinations(range(num_items), n)), dtype=np.int32,
+                                count=max_combs * n).reshape(max_combs, n)
+        all_combs = all_combs[~np.isin(_keys(all_combs, weights), seen)]
+        return all_combs[rng.choice(len(all_combs), num_combs, replace=False)]
+
+    def draw(batch_size):
+        batch = np.sort(np.argpartition(rng.random((batch_size, num_items)), n - 1, axis=1)[:, :n], axis=1)
+        return batch.astype(np.int32), _keys(batch, weights)
+
+    return _draw_unique(draw, num_items, num_combs, seen)
+
+
+def random_partitions(num_items: int, num_groups: int, group_size: int, num_perms: int,
+                      rng: np.random.Generator) -> np.ndarray:
+    """
+    Randomly split range(num_items) into num_groups groups of group_size, num_perms times. Used for the two-way null,
+    where the groups are the synthetic mutants, synthetic treated specimens and synthetic interaction specimens
+
+    Parameters
+    ----------
+    num_items
+        The number of items (baselines) to choose from
+    num_groups
+        The number of groups
+    group_size
+        The number of items in each group
+    num_perms
+        The number of partitions
+    rng
+        The random generator
+
+    Returns
+    -------
+    (num_perms, num_groups, group_size) int32. The groups do not overlap and no partition is drawn twice. Partitions
+    with the same groups in a different order are different partitions
+
+    Raises
+    ------
+    ValueError
+        If there are not num_perms partitions to draw
+    """
+    if num_groups * group_size > num_items:
+        raise ValueError(f'Cannot make {num_groups} groups of {group_size} from {num_items}')
+
+    max_perms = math.prod(comb(num_items - i * group_size, group_size, exact=True) for i in range(num_groups))
+    if num_perms > max_perms:
+        raise ValueError(f'Cannot draw {num_perms} partitions of {num_items} into {num_groups} groups of '
+                         f'{group_size}. There are {max_perms}')
+
+    if num_perms == 0:
+        return np.empty((0, num_groups, group_size), dtype=np.int32)
+
+    if max_perms <= ENUMERATE_RATIO * num_perms:
+        # Most of the partitions are needed, so rejection sampling would mostly draw repeats
+        all_perms = np.fromiter(chain.from_iterable(chain.from_iterable(
+            _partitions(tuple(range(num_items)), num_groups, group_size))), dtype=np.int32,
+            count=max_perms * num_groups * group_size).reshape(max_perms, num_groups, group_size)
+        return all_perms[rng.choice(max_perms, num_perms, replace=False)]
+
+    # Zobrist keys as in random_combinations, with a random number for each item in each group
+    weights = np.random.default_rng(0).integers(0, np.iinfo(np.int64).max, (num_groups, num_items), dtype=np.int64)
+    groups = np.arange(num_groups)[:, np.newaxis]
+
+    def draw(batch_size):
+        order = np.argsort(rng.random((batch_size, num_items)), axis=1)[:, :num_groups * group_size]
+        batch = np.sort(order.reshape(batch_size, num_groups, group_size), axis=2)
+        keys = np.bitwise_xor.reduce(weights[groups, batch].reshape(batch_size, -1), axis=1)
+        return batch.astype(np.int32), keys
+
+    return _draw_unique(draw, num_items, num_perms, np.empty(0, dtype=np.int64))
+
+
+def _partitions(items: Tuple[int, ...], num_groups: int, group_size: int) -> Iterator[Tuple[Tuple[int, ...], ...]]:
+    """
+    All the ordered partitions of items into num_groups groups of group_size, each group in ascending order
+    """
+    if num_groups == 0:
+        yield ()
+        return
+    for group in combinations(items, group_size):
+        rest = tuple(i for i in items if i not in group)
+        for partition in _partitions(rest, num_groups - 1, group_size):
+            yield (group,) + partition
+
+
+def _draw_unique(draw: Callable[[int], Tuple[np.ndarray, np.ndarray]], num_items: int, num: int,
+                 seen: np.ndarray) -> np.ndarray:
+    """
+    Rejection sampling of num unique draws
+
+    Parameters
+    ----------
+    draw
+        Makes a batch of random draws. Takes the batch size and returns the draws and their keys
+    num_items
+        The number of random values drawn for each row of a batch
+    num
+        The number of draws needed
+    seen
+        The keys of draws that must not be repeated
+
+    Returns
+    -------
+    The num draws, in the order they were drawn
+    """
+    result = []
+    num_drawn = 0
+
+    while num_drawn < num:
+        # Draw a few more than needed to allow for the duplicates, but keep each round under MAX_BATCH_ELEMENTS
+        batch_size = min(math.ceil((num - num_drawn) * 1.2) + 16, max(1, MAX_BATCH_ELEMENTS // num_items))
+        batch, keys = draw(batch_size)
+
+        # Keep the first of any repeated draws in the batch and those not already drawn
+        _, first = np.unique(keys, return_index=True)
+        first.sort()
+        first = first[~np.isin(keys[first], seen)][: num - num_drawn]
+
+        result.append(batch[first])
+        seen = np.concatenate([seen, keys[first]])
+        num_drawn += len(first)
+
+    return np.concatenate(result)
+
+
+def _keys(subsets: np.ndarray, weights: np.ndarray) -> np.ndarray:
+    if not len(subsets):
+        return np.empty(0, dtype=np.int64)
+    return np.bitwise_xor.reduce(weights[subsets], axis=1)
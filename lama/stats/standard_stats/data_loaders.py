@@ -21,7 +21,7 @@ loaded only once
 from abc import ABC
 from pathlib import Path
 from typing import Union, List, Iterator, Tuple, Iterable, Callable
-import math
+from concurrent.futures import ThreadPoolExecutor
 import tempfile
 
 import numpy as np
@@ -34,17 +34,19 @@ import SimpleITK as sitk
 from lama.img_processing.normalise import IntensityMaskNormalise, IntensityHistogramMatch
 
 from lama import common
-from lama.img_processing.misc import blur
+from lama.img_processing.misc import MaskedGaussianBlur
 from lama.paths import specimen_iterator
 
-import os
 import gc
 import sys
-import psutil
 
 GLCM_FILE_SUFFIX = '.npz'
 DEFAULT_FWHM = 100  # um
 DEFAULT_VOXEL_SIZE = 14.0
+# If no memory budget is set for the stats, use this fraction of the available memory
+DEFAULT_MEMORY_FRACTION = 0.5
+# Number of volumes to load and blur at once. Each worker holds a full 3D volume and its blurred copy
+DEFAULT_LOADER_WORKERS = 4
 
 
 class LineData:
@@ -67,9 +69,8 @@ class LineData:
         Parameters
         ----------
         data
-            debug: It's a list of 1D arrays. Trying to save memory. The Vstack to create data was duplicating a lot
             2D np.ndarray
-                voxel_data
+                voxel_data (float32, may be a np.memmap)
                     row: specimens
                     columns: data points
             pd.DataFrame
@@ -97,6 +98,7 @@ class LineData:
         self.outdirs = None
         self.size = np.prod(shape)
         self.mask = mask
+        self._chunk_plans = {}  # (max_memory_gb, overhead_factor): plan
 
         logging.info(f"Create line data '{self.line}'")
 
@@ -118,80 +120,84 @@ class LineData:
     def genotypes(self):
         return self.info.genotype
 
-    def get_num_chunks(self, log: bool=False):
+    def get_num_chunks(self, max_memory_gb: float = None, overhead_factor: float = 1, log: bool=False):
         """
-        Using the size of the data set and the available memory, get the number of chunks needed to analyse the data
-        without maxing out the memory.
+        Get the number of chunks needed to analyse the data without maxing out the memory. See chunk_plan
 
-        The overhead is quite large
-            First the data is written to a binary file for R to read in
-            Then there is the data (pvalues and t-statistics) output by R into another binary file
-            Plus any overhead R encounters when fitting the linear models
+        Parameters
+        ----------
+        max_memory_gb, overhead_factor: See chunk_plan
+        log: Whether to log data size information
+        """
+        return len(self.chunk_plan(max_memory_gb, overhead_factor, log=log))
+
+    def chunk_plan(self, max_memory_gb: float = None, overhead_factor: float = 1, log: bool = False) -> List[slice]:
+        """
+        Plan how to split the data column-wise so each chunk fits into the memory budget.
+        The plan for each budget and overhead is made on the first call and reused after that, so the chunks do not
+        change as the process grows.
 
-        Currently The overhead factor is set to 100X the size of the data being analysed
+        The memory needed for each data column is n_specimens * 8 bytes (the linear models work in float64) multiplied
+        by the overhead of the stats runner (see linear_model.MEMORY_OVERHEAD)
 
         Parameters
         ----------
-        log: Whether to log data size information
+        max_memory_gb
+            The memory budget for each chunk. If None, DEFAULT_MEMORY_FRACTION of the currently available memory
+        overhead_factor
+            Peak memory used by the stats runner as a multiple of the float64 size of the chunk
+        log
+            Whether to log the plan
 
         Returns
         -------
-
+        Column slices of the data. One per chunk
         """
+        key = (max_memory_gb, overhead_factor)
+        if key in self._chunk_plans:
+            return self._chunk_plans[key]
 
-        overhead_factor = 100
-        # debug
-        bytes_free = common.available_memory()
-        procMemRSS_bytes = psutil.Process(os.getpid()).memory_info().rss
+        n_specimens, n_columns = self.data.shape
 
-        num_chunks = math.ceil((procMemRSS_bytes * overhead_factor) / bytes_free)
-
-        if log:
-            logging.info(f'\nAvailable memory: {common.bytesToGb(bytes_free)} GB\nProcess memory: {common.bytesToGb(procMemRSS_bytes)} GB')
+        if max_memory_gb:
+            budget_bytes = max_memory_gb * 1024 ** 3
+        else:
+            budget_bytes = common.available_memory() * DEFAULT_MEMORY_FRACTION
 
+        bytes_per_column = n_specimens * np.dtype(np.float64).itemsize * overhead_factor
+        chunk_size = max(1, int(budget_bytes // bytes_per_column))
 
+        plan = [slice(i, min(i + chunk_size, n_columns)) for i in range(0, n_columns, chunk_size)]
+        self._chunk_plans[key] = plan
 
-        if num_chunks > 1:
-            return num_chunks
-        else:
+        if log:
+            logging.info(f'\nMemory budget: {common.bytesToGb(budget_bytes)} GB\n'
+                         f'Data: {n_specimens} specimens x {n_columns} columns\n'
+                         f'Chunk plan: {len(plan)} chunks of up to {chunk_size} columns')
 
-            return 1
+        return plan
 
-    def chunks(self) -> Iterator[np.ndarray]:
+    def chunks(self, plan: List[slice]) -> Iterator[np.ndarray]:
         """
-        Return chunks of the data.
+        Return chunks of the data as set out in a plan from chunk_plan.
+
+        Parameters
+        ----------
+        plan
+            The column slices from chunk_plan. Passed in so the chunks are the ones planned for the stats runner's
+            memory budget and overhead
 
         Yields
         -------
-        Chunks split column-wise (axis=1)
-
-        Notes
-        -----
-        np.array_split returns a view on the data not a copy
-
-        # TODO: Allow chunk size to be set via config
-        # TODO: Organ vol self.data is a Dataframe voxeld ata is list of arrays. Should standardise this
+        Chunks split column-wise (axis=1). These are views on the data, not copies
         """
-        num_chunks = self.get_num_chunks()
-
-        try:
-            self.data.shape
-        except AttributeError:
-            specimen_size = len(self.data[0])
+        if isinstance(self.data, pd.DataFrame):
+            data = self.data.values
         else:
-            specimen_size = self.data.shape[1]
-
-        chunk_size = math.ceil(specimen_size/ num_chunks)
-
-        for i in range(0, specimen_size, chunk_size):
-            try:
-                self.data.shape
-            except AttributeError:
-                chunk = np.array([x[i: i + chunk_size] for x in self.data])
-            else:
-                chunk = np.array([x[i: i + chunk_size] for _, x in self.data.iterrows()])
+            data = self.data
 
-            yield chunk
+        for cols in plan:
+            yield data[:, cols]
 
     @property  # delete
     def mask_size(self) -> int:
@@ -297,9 +303,14 @@ class DataLoader:
 
         self.normaliser = None
 
-        self.blur_fwhm = config.get('blur', DEFAULT_FWHM)
+        # Optional lama.stats.standard_stats.voxel_cache.VoxelCache for the preprocessed voxel data
+        self.voxel_cache = None
+
+        self.blur_fwhm = config.get('blur_fwhm', config.get('blur', DEFAULT_FWHM))
         self.voxel_size = config.get('voxel_size', DEFAULT_VOXEL_SIZE)
+        self.blur_method = config.get('blur_method', 'auto')
         self.memmap = memmap
+        self.loader_workers = max(1, int(config.get('loader_workers', DEFAULT_LOADER_WORKERS)))
 
     @staticmethod
     def factory(type_: str):
@@ -350,19 +361,70 @@ class DataLoader:
 
         raise NotImplementedError
 
-        # flatten the array
-    def _flatten(self, vols):
-        for i, vol in enumerate(vols):
-            blurred_array = blur(sitk.GetArrayFromImage(vol), self.blur_fwhm, self.voxel_size)
-            masked = blurred_array[self.mask != False]
-            if self.memmap:
-                t = tempfile.TemporaryFile()
-                m = np.memmap(t, dtype=masked.dtype, mode='w+', shape=masked.shape)
-                m[:] = masked
-                masked = m
+    def _new_store(self, n_specimens: int) -> np.ndarray:
+        """
+        Allocate the 2D float32 array that the voxel data is read into.
+        Rows: specimens. Columns: voxels within the mask.
+
+        Fortran ordered so the column-wise chunks used by the stats are contiguous.
+        If memmap is set, the array is backed by an anonymous temporary file
+        """
+        shape = (n_specimens, int(np.count_nonzero(self.mask)))
+
+        if self.memmap:
+            return np.memmap(tempfile.TemporaryFile(), dtype=np.float32, mode='w+', shape=shape, order='F')
+        return np.empty(shape, dtype=np.float32, order='F')
+
+    def _blur_engine(self) -> MaskedGaussianBlur:
+        """
+        The blur used on the voxel data. Returns the blurred voxels within the mask
+        """
+        return MaskedGaussianBlur(self.mask, self.blur_fwhm, self.voxel_size, self.blur_method)
+
+    def _map_rows(self, func: Callable[[int], None], n_rows: int):
+        """
+        Call func(row) for each row of the store, using loader_workers threads.
+
+        Threads are used as SimpleITK IO and the scipy.ndimage filters release the GIL, and each call writes its row
+        directly into the shared store. As only loader_workers calls run at once, at most that many full 3D volumes are
+        in memory.
+        """
+        if self.loader_workers == 1 or n_rows < 2:
+            for row in range(n_rows):
+                func(row)
+            return
+
+        with ThreadPoolExecutor(max_workers=min(self.loader_workers, n_rows)) as pool:
+            # Consume the results so that exceptions from the workers are raised here
+            for _ in pool.map(func, range(n_rows)):
+                pass
+
+    def _flatten(self, vols: List[sitk.Image], out: np.ndarray = None) -> np.ndarray:
+        """
+        Blur, mask and ravel SimpleITK images into the rows of a 2D store
+
+        Parameters
+        ----------
+        vols
+            The images
+        out
+            Write into this 2D array. If None, a new store is made
+
+        Returns
+        -------
+        The 2D array
+        """
+        if out is None:
+            out = self._new_store(len(vols))
+
+        blur = self._blur_engine()
+
+        def flatten_row(i):
+            blur(sitk.GetArrayFromImage(vols[i]), out=out[i])
 
-            vols[i] = masked
+        self._map_rows(flatten_row, len(vols))
 
+        return out
 
     def cluster_data(self):
         raise NotImplementedError
@@ -411,18 +473,18 @@ class DataLoader:
                 [self.treatment_dir, ['wildtype','treatment']],
                 [self.interaction_dir, ['mutant','treatment']]]
 
-        data = []
-         
+        # Get the paths for all conditions first so the data can be read into one 2D array
+        paths_per_condition = [list(self._get_metadata(_dir)['data_path']) for _dir, _ in condition_list]
+
+        data = self._new_store(sum(len(paths) for paths in paths_per_condition))
+        row = 0
+
         full_staging = pd.DataFrame()
 
         paths_list = []
  
         # unpack list
-        for _dir, condition in condition_list: 
-                    
-            metadata = self._get_metadata(_dir)
-            
-            paths = list(metadata['data_path'])
+        for (_dir, condition), paths in zip(condition_list, paths_per_condition):
             
             paths_list.extend(paths)
 
@@ -438,7 +500,11 @@ class DataLoader:
             
             # should be no baseline ids, so no need to filter specimens
 
-            vols = self._read(paths)
+            # The rows of data for this condition
+            vols = data[row: row + len(paths)]
+            row += len(paths)
+
+            self._read(paths, out=vols)
 
             if self.normaliser:
                 # this makes sense right?
@@ -451,31 +517,23 @@ class DataLoader:
                     self.normaliser.normalise(vols, )
                 elif isinstance(self.normaliser, IntensityHistogramMatch):
                     # we have to re-read the data to be to be 3D array
-                    vols = [common.LoadImage(path).img for path in paths]
+                    imgs = [common.LoadImage(path).img for path in paths]
                     if _dir == self.wt_dir:
                         wt_paths = [path for path in paths if ('baseline' in str(path))]
                         wt_vols = [common.LoadImage(path).img for path in wt_paths]
 
                         ref_vol = common.LoadImage(self.ref_vol).img if self.ref_vol else wt_vols[0]
 
-                    self.normaliser.normalise(vols, ref_vol)
+                    self.normaliser.normalise(imgs, ref_vol)
 
                     #flatten the array
-                    self._flatten(vols)
-
-            masked_data = [x.ravel() for x in vols]
+                    self._flatten(imgs, out=vols)
 
             full_staging = pd.concat((full_staging, staging))
             # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
             if 'value' in full_staging:
                 staging.rename(columns={'value': 'staging'}, inplace=True)
 
-            # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
-            # Stick all arrays in a list instead
-            
-            data.extend(masked_data)
-
-
             # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
             if _dir == self.interaction_dir: 
@@ -489,7 +547,9 @@ class DataLoader:
         per line that can be used to go into the statistics pipeline.
 
         The wild type data is the same for each mutant line so we don't have to do multiple reads of the potentially
-        large dataset
+        large dataset. The data is held in one 2D array with the wild types in the first rows. Each line's mutants are
+        read into the rows after the wild types, so the LineData for a line is only valid until the next line is
+        yielded.
 
         Returns:
         -------
@@ -504,8 +564,16 @@ class DataLoader:
         if self.baseline_ids:
             wt_paths, wt_staging = self.filter_specimens(self.baseline_ids, wt_paths, wt_staging)
 
+        mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
+        mut_gb = mut_metadata.groupby('line')
+
+        # Room for the wild types and the line with the most mutants
+        max_line_size = int(mut_gb.size().max()) if len(mut_metadata) else 0
+        data = self._new_store(len(wt_paths) + max_line_size)
+        wt_vols = data[:len(wt_paths)]
+
         logging.info('loading baseline data')
-        wt_vols = self._read(wt_paths)
+        self._read(wt_paths, out=wt_vols)
 
         if self.normaliser:
             if isinstance(self.normaliser,IntensityMaskNormalise):
@@ -517,33 +585,19 @@ class DataLoader:
                 self.normaliser.normalise(wt_vols,)
             elif isinstance(self.normaliser, IntensityHistogramMatch):
                 # we have to re-read the data to be to be 3D array
-                wt_vols = [common.LoadImage(path).img for path in wt_paths]
+                wt_imgs = [common.LoadImage(path).img for path in wt_paths]
 
                 # check in the config if there is a reference volume
                 # get the reference volume
 
-                ref_vol_path = wt_paths.parent
-                ref_vol = common.LoadImage(ref_vol_path)
-
+                ref_vol = wt_imgs[0]
 
-                ref_vol = wt_vols[0]
+                self.normaliser.normalise(wt_imgs, ref_vol)
+                self._flatten(wt_imgs, out=wt_vols)
 
-                self.normaliser.normalise(wt_vols, ref_vol)
-                self._flatten(wt_vols)
-
-
-
-        # Make a 2D array of the WT data
-        masked_wt_data = [x.ravel() for x in wt_vols]
-
-        mut_metadata = self._get_metadata(self.mut_dir, self.lines_to_process)
-
-                         
         # Iterate over the lines
         logging.info('loading mutant data')
 
-        mut_gb = mut_metadata.groupby('line')
-
         for line, mut_df in mut_gb:
 
             # Make dataframe of specimen_id, genotype, staging
@@ -558,32 +612,26 @@ class DataLoader:
                 if ids:
                     mut_paths, mut_staging = self.filter_specimens(self.mutant_ids[line], mut_paths, mut_staging)
 
-            mut_vols = self._read(mut_paths)
+            n_specimens = len(wt_paths) + len(mut_paths)
+            mut_vols = data[len(wt_paths): n_specimens]
+            self._read(mut_paths, out=mut_vols)
 
             if self.normaliser:
                 if isinstance(self.normaliser, IntensityMaskNormalise):
                     self.normaliser.normalise(mut_vols, )
                 elif isinstance(self.normaliser, IntensityHistogramMatch):
-                    mut_vols = [common.LoadImage(path).img for path in mut_paths]
-                    self.normaliser.normalise(mut_vols, ref_vol)
-                    self._flatten(mut_vols)
-                    
-            masked_mut_data = [x.ravel() for x in mut_vols]
+                    mut_imgs = [common.LoadImage(path).img for path in mut_paths]
+                    self.normaliser.normalise(mut_imgs, ref_vol)
+                    self._flatten(mut_imgs, out=mut_vols)
 
             staging = pd.concat((wt_staging, mut_staging))
             # Id there is a value column, change to staging. TODO: make lama spitout staging header instead of value
             if 'value' in staging:
                 staging.rename(columns={'value': 'staging'}, inplace=True)
 
-            # data = np.vstack((masked_wt_data, masked_mut_data)) # This almost doubled memory usage.
-            # Stick all arrays in a list instead
-            data = masked_wt_data[:]
-            data.extend(masked_mut_data)
-
-
             # cluster_data = self.cluster_data(data)  # The data to use for doing t-sne and clustering
 
-            input_ = LineData(data, staging, line, self.shape, (wt_paths, mut_paths), self.mask)
+            input_ = LineData(data[:n_specimens], staging, line, self.shape, (wt_paths, mut_paths), self.mask)
             yield input_
 
         
@@ -602,45 +650,61 @@ class VoxelDataLoader(DataLoader):
         pass
         #self.labe
 
-    def _read(self, paths: Iterable) -> List[np.ndarray]:
+    def _read(self, paths: Iterable, out: np.ndarray = None) -> np.ndarray:
         """
         - Read in the voxel-based data into 3D arrays
         - Apply guassian blur to the 3D image
         - mask
-        - Unravel
+        - Unravel into a row of a 2D array
 
+        The volumes are processed by loader_workers threads (see _map_rows).
 
         Parameters
         ----------
         paths
             Path to load
+        out
+            2D array to write the data into. One row per path. If None, a new store is made (see _new_store)
 
         Returns
         -------
-        List of numpy arrays of blurred, masked, and raveled data
+        2D array of blurred, masked, and raveled data. Rows: specimens, columns: voxels
         """
+        paths = list(paths)
 
-        images = []
+        if out is None:
+            out = self._new_store(len(paths))
+
+        blur = self._blur_engine()
+
+        def read_row(i):
+            data_path = paths[i]
+
+            if self.voxel_cache:
+                cached = self.voxel_cache.get(data_path)
+                if cached is not None:
+                    out[i] = cached
+                    if not self.shape:
+                        self.shape = self.mask.shape  # The volumes are the same shape as the mask
+                    return
 
-        for data_path in paths:
             logging.info(f'loading data: {data_path.name}')
-            loader = common.LoadImage(data_path)
+            array = common.LoadImage(data_path).array
 
             if not self.shape:
-                self.shape = loader.array.shape
+                self.shape = array.shape
+
+            blur(array, out=out[i])
 
-            blurred_array = blur(loader.array, self.blur_fwhm, self.voxel_size)
-            masked = blurred_array[self.mask != False]
+            if self.voxel_cache:
+                self.voxel_cache.put(data_path, out[i])
 
-            if self.memmap:
-                t = tempfile.TemporaryFile()
-                m = np.memmap(t, dtype=masked.dtype, mode='w+', shape=masked.shape)
-                m[:] = masked
-                masked = m
+        self._map_rows(read_row, len(paths))
 
-            images.append(masked)
+        if self.voxel_cache:
+            self.voxel_cache.log_stats()
 
-        return images
+        return out
 
     def _get_data_file_path(self):
         """
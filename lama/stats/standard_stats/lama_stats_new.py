@@ -11,7 +11,8 @@ To do 060819
 """
 
 from pathlib import Path
-from typing import Union, List
+from typing import Union, List, Dict
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import os
 from logzero import logger as logging
 import logzero
@@ -20,15 +21,21 @@ import gc
 
 from lama.common import cfg_load
 from lama.stats.standard_stats.stats_objects import Stats, OrganVolume
-from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData, JacobianDataLoader, IntensityDataLoader
+from lama.stats.standard_stats.data_loaders import DataLoader, load_mask, LineData, JacobianDataLoader, IntensityDataLoader, VoxelDataLoader
+from lama.stats.standard_stats.voxel_cache import VoxelCache, DEFAULT_MAX_SIZE_GB
 from lama.stats.standard_stats.results_writer import ResultsWriter
 from lama import common
 from lama.stats import linear_model
 from lama.elastix import PROPAGATE_CONFIG
 from lama.elastix.propagate_volumes import PropagateHeatmap
+from lama.elastix.elastix_registration import image_voxels
 from lama.img_processing.normalise import Normaliser
 from lama.qc import organ_vol_plots
 
+# Rough peak memory use of propagating heatmaps onto one specimen: the displacement field as it is made and in the
+# resampling transform, and the heatmaps
+HEATMAP_PROPAGATION_BYTES_PER_VOXEL = 64
+
 
 def run(config_path: Path,
         wt_dir: Path,
@@ -100,10 +107,20 @@ def run(config_path: Path,
     if mutant_file:
         mutant_file = config_path.parent / mutant_file
 
+    stats_runner = stats_config.get('stats_runner', 'lm_fast')
+    if stats_runner not in linear_model.STATS_RUNNERS:
+        raise ValueError(f'stats_runner must be one of {list(linear_model.STATS_RUNNERS)}')
+    logging.info(f'Using {stats_runner} for the linear models')
+
     ref_vol_path = stats_config.get('reference_vol')
     if ref_vol_path:
         ref_vol_path = config_path.parent / ref_vol_path
 
+    voxel_cache_dir = stats_config.get('voxel_cache_dir')
+    if voxel_cache_dir:
+        voxel_cache_dir = config_path.parent / voxel_cache_dir
+        logging.info(f'Caching preprocessed voxel data in {voxel_cache_dir}')
+
     # Run each data class through the pipeline.
     for stats_type in stats_config['stats_types']:
 
@@ -119,6 +136,11 @@ def run(config_path: Path,
                               baseline_file=baseline_file, mutant_file=mutant_file, memmap=memmap,
                               treatment_dir=treatment_dir, interaction_dir=interaction_dir, ref_vol_path=ref_vol_path)
 
+        if voxel_cache_dir and isinstance(loader, VoxelDataLoader):
+            loader.voxel_cache = VoxelCache(voxel_cache_dir, mask, loader.blur_fwhm, loader.voxel_size,
+                                            loader.blur_method,
+                                            stats_config.get('voxel_cache_max_gb', DEFAULT_MAX_SIZE_GB))
+
         # Only affects organ vol loader.
         if not stats_config.get('normalise_organ_vol_to_mask'):
             loader.norm_to_mask_volume_on = False
@@ -163,7 +185,8 @@ def run(config_path: Path,
                 stats_class = Stats.factory(stats_type)
                 stats_obj = stats_class(line_input_data, stats_type, stats_config.get('use_staging', True), stats_config.get('two_way', False))
       
-                stats_obj.stats_runner = linear_model.lm_r
+                stats_obj.stats_runner = linear_model.STATS_RUNNERS[stats_runner]
+                stats_obj.max_memory_gb = stats_config.get('max_memory_gb')
                 stats_obj.run_stats()
       
                 logging.info('Statistical analysis finished.')
@@ -192,17 +215,10 @@ def run(config_path: Path,
                         line_heatmap = writer.line_heatmap
                         line_reg_dir = mut_dir / 'output' / line_id
                         if stats_config.get('two_way', False):
-                            logging.info("Inverting interaction heatmaps")
-                            invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data,
-                                            two_way="int")
-                            logging.info("Inverting treatment heatmaps")
-                            line_heatmap = Path(str(line_heatmap).replace("_int_", "_treat_"))
-                            invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data,
-                                            two_way="treat")
-                            logging.info("Inverting genotype heatmaps")
-                            line_heatmap = Path(str(line_heatmap).replace("_treat_", "_geno_"))
-                            invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data,
-                                            two_way="geno")
+                            logging.info("Inverting interaction, treatment and genotype heatmaps")
+                            effect_heatmaps = {effect: Path(str(line_heatmap).replace("_int_", f"_{effect}_"))
+                                               for effect in ('int', 'treat', 'geno')}
+                            invert_heatmaps(effect_heatmaps, line_stats_out_dir, line_reg_dir, line_input_data)
                             logging.info('Finished writing heatmaps.')
                         else:
                             invert_heatmaps(line_heatmap, line_stats_out_dir, line_reg_dir, line_input_data)
@@ -223,22 +239,28 @@ def run(config_path: Path,
 
 
 
-def invert_heatmaps(heatmap: Path,
+def invert_heatmaps(heatmap: Union[Path, Dict[str, Path]],
                     stats_outdir: Path,
                     reg_outdir: Path,
                     input_: LineData,
                     two_way=False):
     """
-    Invert the stats heatmaps from a single line back onto inputs or registered volumes
+    Invert the stats heatmaps from a single line back onto inputs or registered volumes.
+    The specimens are done at once, as many as the cpus and memory allow
 
     Parameters
     ----------
-    line_dir
+    heatmap
+        The line heatmap. Or for a two-way design, {effect: heatmap} (eg. 'int', 'treat', 'geno'). These are all
+        propagated in one pass over each specimen's transforms, into a folder for each effect
+    stats_outdir
+        The line stats output folder. The inverted heatmaps go in 'inverted_heatmaps' within it
+    reg_outdir
         The registration output directory for a line
     input_
         Has paths for data locations
-    outdir
-        Where to put the inverted heatmaps
+    two_way
+        The effect of a single two-way heatmap
 
     Returns
     -------
@@ -248,12 +270,25 @@ def invert_heatmaps(heatmap: Path,
     inverted_heatmap_dir = stats_outdir / 'inverted_heatmaps'
     os.makedirs(inverted_heatmap_dir, exist_ok=True)
 
+    if isinstance(heatmap, dict):
+        two_way = True
+        heatmaps = {}
+        for effect, path in heatmap.items():
+            effect_dir = inverted_heatmap_dir / str(effect)
+            common.mkdir_force(effect_dir)
+            heatmaps[path] = effect_dir
+    elif two_way:
+        effect_dir = inverted_heatmap_dir / str(two_way)
+        common.mkdir_force(effect_dir)
+        heatmaps = {heatmap: effect_dir}
+    else:
+        heatmaps = heatmap
+
     # KD note  - baseline is done  for the two-way too.
     mut_specs = input_.mutant_ids()
-    if two_way:
-        inverted_heatmap_dir = inverted_heatmap_dir / str(two_way)
-        common.mkdir_force(inverted_heatmap_dir)
-    for i, spec_id in enumerate(mut_specs):
+
+    jobs = []
+    for spec_id in mut_specs:
         # Should not have to specify the path to the inv config again
         if two_way:
             #  so the reg_outdir is dependendent on condition
@@ -268,6 +303,34 @@ def invert_heatmaps(heatmap: Path,
             invert_config = Path(str(invert_config))
         else:
             invert_config = reg_outdir / str(spec_id) / 'output' / 'inverted_transforms' / PROPAGATE_CONFIG
+        jobs.append(invert_config)
 
-        inv = PropagateHeatmap(invert_config, heatmap, inverted_heatmap_dir)
-        inv.run()
\ No newline at end of file
+    if not jobs:
+        return
+
+    cpus = os.cpu_count() or 1
+    first_heatmap = heatmap if isinstance(heatmap, (str, Path)) else next(iter(heatmaps))
+    try:
+        mem_per_job = image_voxels(first_heatmap) * HEATMAP_PROPAGATION_BYTES_PER_VOXEL
+    except RuntimeError:
+        mem_per_job = 0
+    n_workers = min(cpus, len(jobs))
+    if mem_per_job:
+        n_workers = max(1, min(n_workers, int(common.available_memory() // mem_per_job)))
+    threads_per_job = max(1, cpus // n_workers)
+
+    logging.info(f'Propagating heatmaps onto {len(jobs)} specimens, {n_workers} at once')
+
+    def propagate(invert_config):
+        PropagateHeatmap(invert_config, heatmaps, inverted_heatmap_dir, threads=threads_per_job).run()
+
+    # The work is done by ITK, numpy or transformix subprocesses, which all release the GIL
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        futures = [pool.submit(propagate, invert_config) for invert_config in jobs]
+        try:
+            for future in as_completed(futures):
+                future.result()
+        except BaseException:
+            for future in futures:
+                future.cancel()  # Only stops those not started. Running ones are waited for
+            raise
\ No newline at end of file
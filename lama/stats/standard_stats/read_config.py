@@ -116,6 +116,30 @@ def validate(config: Dict):
         'reference_vol': {
             'required': False,
             'validate' : [lambda x: isinstance(x, str)]
+        },
+        'stats_runner': {
+            'required': False,
+            'validate': [options, ['lm_fast', 'lm_r', 'lm_sm', 'lm_np']]
+        },
+        'max_memory_gb': {
+            'required': False,
+            'validate': (num, 0)
+        },
+        'voxel_cache_dir': {
+            'required': False,
+            'validate': [lambda x: isinstance(x, str)]
+        },
+        'voxel_cache_max_gb': {
+            'required': False,
+            'validate': (num, 0)
+        },
+        'loader_workers': {
+            'required': False,
+            'validate': (num, 1)
+        },
+        'blur_method': {
+            'required': False,
+            'validate': [options, ['auto', 'spatial', 'fft']]
         }
 
 
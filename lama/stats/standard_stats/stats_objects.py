@@ -21,6 +21,7 @@ import pandas as pd
 
 from lama import common
 from lama.stats.standard_stats.data_loaders import LineData
+from lama.stats.linear_model import lm_sm, lm_np, line_and_specimen_level, MEMORY_OVERHEAD
 
 RSCRIPT_FDR = common.lama_root_dir / 'stats' / 'rscripts' / 'r_padjust.R'
 
@@ -48,6 +49,7 @@ class Stats:
         self.input_ = input_
         self.stats_type_ = stats_type
         self.stats_runner = None
+        self.max_memory_gb = None  # Memory budget for each chunk of data. See LineData.chunk_plan
         self.use_staging = use_staging
         self.two_way = two_way
 
@@ -85,16 +87,23 @@ class Stats:
 
         info = self.input_.info
 
-        num_chunks = self.input_.get_num_chunks(log=True)
+        overhead = MEMORY_OVERHEAD.get(self.stats_runner.__name__, max(MEMORY_OVERHEAD.values()))
+        chunk_plan = self.input_.chunk_plan(self.max_memory_gb, overhead, log=True)
+        num_chunks = len(chunk_plan)
 
-        for i, data_chunk in enumerate(self.input_.chunks()):
+        for i, data_chunk in enumerate(self.input_.chunks(chunk_plan)):
             # Chunk the data and send sequentially to R to not use all the memory
 
             logging.info(f'Chunk {i + 1}/{num_chunks}')
 
             current_chunk_size = data_chunk.shape[1]  # Final chunk may not be same size
 
-            p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging, two_way=self.two_way)
+            if self.stats_runner in (lm_sm, lm_np):
+                # These only do the line-level fit
+                p_all, t_all = line_and_specimen_level(self.stats_runner, data_chunk, info,
+                                                       use_staging=self.use_staging, two_way=self.two_way)
+            else:
+                p_all, t_all = self.stats_runner(data_chunk, info, use_staging=self.use_staging, two_way=self.two_way)
 
 
             # Convert all NANs in the pvalues to 1.0. Need to check that this is appropriate
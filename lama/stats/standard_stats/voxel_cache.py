@@ -0,0 +1,188 @@
+"""
+An on-disk cache of the preprocessed (blurred, masked and raveled) voxel data used by the voxel-based stats.
+
+The baseline set is usually the same for all the lines analysed, so with the cache only the first run has to load and
+blur each volume. Each entry is a float32 .npy file keyed by:
+    - the input file (resolved path, size and modification time)
+    - the blur FWHM, voxel size and blur method
+    - a hash of the mask
+
+The data are cached before normalisation as the normalisation depends on the other specimens in the analysis.
+
+When the cache grows past its size limit, the least recently used entries are deleted.
+"""
+
+from pathlib import Path
+import hashlib
+import os
+import tempfile
+import threading
+import time
+
+import numpy as np
+from logzero import logger as logging
+
+from lama import common
+
+# Change this if the preprocessing changes so old entries are not used
+CACHE_VERSION = 2
+DEFAULT_MAX_SIZE_GB = 50
+# Temp files older than this (seconds) are left from a crashed process and are removed
+STALE_TMP_AGE = 3600
+
+
+class VoxelCache:
+    def __init__(self,
+                 cache_dir: Path,
+                 mask: np.ndarray,
+                 blur_fwhm: float,
+                 voxel_size: float,
+                 blur_method: str = 'auto',
+                 max_size_gb: float = DEFAULT_MAX_SIZE_GB):
+        """
+        Parameters
+        ----------
+        cache_dir
+            Where to store the cache. Made if it does not exist. Can be shared between analyses
+        mask
+            The stats mask
+        blur_fwhm
+            Blur used on the data
+        voxel_size
+            Voxel size used to calculate the blur
+        blur_method
+            The MaskedGaussianBlur method. The methods give slightly different results so it is part of the key
+        max_size_gb
+            When the cache is bigger than this, least recently used entries are removed
+        """
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_size_bytes = max_size_gb * 1024 ** 3
+
+        mask_hash = hashlib.sha1(np.ascontiguousarray(mask != 0).tobytes()).hexdigest()
+        self._settings = f'{CACHE_VERSION}|{blur_fwhm}|{voxel_size}|{blur_method}|{mask.shape}|{mask_hash}'
+
+        # The cache may be used from several threads. The counters and size are updated under this lock
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+        self._remove_stale_tmp()
+        self._size_bytes = sum(_file_size(f) or 0 for f in self.cache_dir.glob('*.npy'))
+
+    def _entry(self, path: Path) -> Path:
+        stat = path.stat()
+        key = f'{path.resolve()}|{stat.st_size}|{stat.st_mtime_ns}|{self._settings}'
+        return self.cache_dir / f'{hashlib.sha1(key.encode()).hexdigest()}.npy'
+
+    def get(self, path: Path) -> np.ndarray:
+        """
+        Get the cached data for an input file
+
+        Returns
+        -------
+        The 1D preprocessed data or None if not in the cache
+        """
+        entry = self._entry(path)
+
+        try:
+            data = np.load(entry)
+        except (FileNotFoundError, ValueError, OSError):  # Missing, or partly written by a crashed process
+            with self._lock:
+                self.misses += 1
+            logging.debug(f'voxel cache miss: {path.name}')
+            return None
+
+        # Update the modification time so the eviction is least recently used
+        try:
+            os.utime(entry)
+        except FileNotFoundError:  # Evicted by another process since it was loaded
+            pass
+        with self._lock:
+            self.hits += 1
+        logging.debug(f'voxel cache hit: {path.name}')
+        return data
+
+    def put(self, path: Path, data: np.ndarray):
+        """
+        Add the preprocessed data for an input file to the cache
+        """
+        entry = self._entry(path)
+
+        # Write to a temp file and rename so other processes never see a partial entry
+        fd, tmp = tempfile.mkstemp(dir=self.cache_dir, suffix='.tmp')
+        try:
+            with os.fdopen(fd, 'wb') as fh:
+                np.save(fh, np.asarray(data, dtype=np.float32))
+
+            with self._lock:
+                # The entry may already exist if another thread or process has just added it
+                old_size = _file_size(entry) or 0
+                os.replace(tmp, entry)
+                self._size_bytes += (_file_size(entry) or 0) - old_size
+
+                if self._size_bytes > self.max_size_bytes:
+                    self._evict()
+        finally:
+            try:
+                os.unlink(tmp)
+            except FileNotFoundError:  # Renamed to the entry
+                pass
+
+    def _remove_stale_tmp(self):
+        """
+        Remove temp files left by puts that crashed. Recent ones may still be being written by another process
+        """
+        cutoff = time.time() - STALE_TMP_AGE
+        for f in self.cache_dir.glob('*.tmp'):
+            try:
+                if f.stat().st_mtime < cutoff:
+                    f.unlink()
+            except FileNotFoundError:
+                pass
+
+    def _evict(self):
+        """
+        Remove the least recently used entries until the cache is under 90% of its maximum size. Called with the lock
+        held. Entries removed by another process while this runs are skipped
+        """
+        self._remove_stale_tmp()
+
+        entries = []
+        for f in self.cache_dir.glob('*.npy'):
+            try:
+                stat = f.stat()
+            except FileNotFoundError:
+                continue
+            entries.append((stat.st_mtime, stat.st_size, f))
+        entries.sort(key=lambda e: e[0])
+
+        self._size_bytes = sum(size for _, size, _ in entries)
+        target = self.max_size_bytes * 0.9
+
+        removed = 0
+        for _, size, entry in entries:
+            if self._size_bytes <= target:
+                break
+            try:
+                entry.unlink()
+                removed += 1
+            except FileNotFoundError:  # Removed by another process
+                pass
+            self._size_bytes -= size
+
+        logging.info(f'voxel cache: removed {removed} entries. Cache size now {common.bytesToGb(self._size_bytes)} GB')
+
+    def log_stats(self):
+        with self._lock:
+            logging.info(f'voxel cache: {self.hits} hits, {self.misses} misses')
+
+
+def _file_size(path: Path) -> int:
+    """
+    The size of a cache entry, or None if it has been removed by another process
+    """
+    try:
+        return path.stat().st_size
+    except FileNotFoundError:
+        return None
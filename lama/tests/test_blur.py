@@ -0,0 +1,49 @@
+"""
+Test the masked blur used by the voxel stats loaders against the full-volume blur
+
+Usage:  pytest -q test_blur.py
+"""
+
+import numpy as np
+import pytest
+
+from lama.img_processing.misc import blur, MaskedGaussianBlur
+
+
+@pytest.mark.parametrize('method', ['spatial', 'fft'])
+@pytest.mark.parametrize('fwhm', [50, 100, 300])
+def test_masked_blur_matches_blur(method, fwhm):
+    rng = np.random.default_rng(999)
+    img = rng.normal(0, 1, (40, 50, 45)).astype(np.float32)
+
+    # Mask touching one edge of the volume, plus an isolated voxel
+    mask = np.zeros(img.shape, dtype=np.uint8)
+    mask[0:25, 10:40, 12:30] = 1
+    mask[35, 45, 40] = 1
+
+    expected = blur(img, fwhm, 14.0)[mask != 0]
+
+    masked_blur = MaskedGaussianBlur(mask, fwhm, 14.0, method)
+    result = masked_blur(img)
+    # Scratch buffers are reused between calls
+    result_2 = masked_blur(img * 2)
+
+    assert result.dtype == np.float32
+    assert np.allclose(result, expected, atol=1e-5)
+    assert np.allclose(result_2, expected * 2, atol=1e-5)
+
+
+def test_masked_blur_integer_input():
+    """
+    Integer volumes are blurred without rounding to the input dtype, as blur() does
+    """
+    rng = np.random.default_rng(3)
+    img = rng.integers(0, 255, (30, 30, 30)).astype(np.uint8)
+    mask = np.ones(img.shape, dtype=np.uint8)
+
+    result = MaskedGaussianBlur(mask, 100, 14.0)(img)
+
+    assert result.dtype == np.float32
+    assert np.allclose(result, blur(img.astype(np.float32), 100, 14.0).ravel(), atol=1e-3)
+    # blur() keeps the dtype, truncating the blurred values
+    assert blur(img, 100, 14.0).dtype == np.uint8
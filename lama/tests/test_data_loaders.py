@@ -0,0 +1,30 @@
+"""
+Test the chunking of the stats input data
+
+Usage:  pytest -q test_data_loaders.py
+"""
+
+import numpy as np
+import pandas as pd
+
+from lama.stats.standard_stats.data_loaders import LineData
+
+
+def test_chunk_plan():
+    data = np.zeros((10, 1000), dtype=np.float32)
+    info = pd.DataFrame({'genotype': ['wildtype'] * 10})
+    line_data = LineData(data, info, 'line1', (10, 10, 10), [[], []])
+
+    # 10 specimens * 8 bytes * overhead per column
+    gb = 10 * 8 * 100 / 1024 ** 3
+    plan = line_data.chunk_plan(gb, 1)
+    assert len(plan) == 10 and plan[-1] == slice(900, 1000)
+
+    # The plan is reused for the same budget and overhead but not for a different overhead
+    assert line_data.chunk_plan(gb, 1) is plan
+    assert len(line_data.chunk_plan(gb, 4)) == 40
+    assert line_data.get_num_chunks(gb, 4) == 40
+
+    chunks = list(line_data.chunks(line_data.chunk_plan(gb, 4)))
+    assert len(chunks) == 40 and chunks[0].shape == (10, 25)
+    assert np.shares_memory(chunks[0], data)
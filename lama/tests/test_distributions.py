@@ -1,10 +1,248 @@
+import numpy as np
 import pandas as pd
-from lama.stats.permutation_stats.distributions import generate_random_combinations
+import statsmodels.formula.api as smf
+from lama.stats.permutation_stats.distributions import (generate_random_combinations, _null_line_thread,
+                                                        null_line_checkpointed,
+                                                        null_specimen, _interaction_p, combinations_per_n,
+                                                        null_line, generate_random_two_way_combinations,
+                                                        _two_way_null_line_thread)
+from lama.stats.permutation_stats import null_store
+
+def _null_line_sm(data: pd.DataFrame, combs: list, label: str) -> list:
+    """
+    The reference for _null_line_thread. One statsmodels fit per permutation, as the null used to be made
+    """
+    data = data.astype({label: np.float64, 'staging': np.float64})
+    line_p = []
+    for comb in [comb for combs_n in combs for comb in combs_n]:
+        data['genotype'] = 'wt'
+        data.loc[data.index[comb], 'genotype'] = 'synth_hom'
+        fit = smf.ols(formula=f'{label} ~ C(genotype) + staging', data=data, missing='drop').fit()
+        line_p.append(fit.pvalues['C(genotype)[T.wt]'])
+    return line_p
+
+
+def _two_way_null_line_sm(data: pd.DataFrame, combs: np.ndarray, label: str) -> list:
+    """
+    The reference for _two_way_null_line_thread. One statsmodels fit per permutation, as the null used to be made
+    """
+    data = data.astype({label: np.float64, 'staging': np.float64})
+    line_p = []
+    for comb in combs:
+        data['genotype'] = 'wt'
+        data['treatment'] = 'veh'
+        data.loc[data.index[np.concatenate([comb[0], comb[2]])], 'genotype'] = 'synth_mut'
+        data.loc[data.index[np.concatenate([comb[1], comb[2]])], 'treatment'] = 'synth_treat'
+        fit = smf.ols(formula=f'{label} ~ genotype * treatment + staging', data=data, missing='drop').fit()
+        # genotype, treatment and interaction
+        line_p.append(fit.pvalues.drop(['Intercept', 'staging']).values)
+    return line_p
+
 
 def test_generate_random_combinations():
     df = pd.read_csv('/home/neil/Desktop/data.csv', index_col=0)
     generate_random_combinations(df,30)
 
 
+def test_null_line_thread_matches_statsmodels():
+    """
+    The vectorised null should give the same p-values as fitting each permutation with statsmodels
+    """
+    rng = np.random.default_rng(999)
+    n = 30
+    ids = [f'wt{i}' for i in range(n)]
+    data = pd.DataFrame({'x1': rng.normal(100, 10, n),
+                         'staging': rng.normal(1000, 50, n),
+                         'genotype': 'baseline'}, index=ids)
+    data.loc['wt3', 'x1'] = np.nan  # QC'd label
+
+    non_nan_rows = np.flatnonzero(~data.x1.isna())
+    combs = {'x1': [np.array([np.sort(rng.choice(non_nan_rows, size=k, replace=False)) for _ in range(20)])
+                    for k in [2, 3, 5]]}
+
+    p_np = _null_line_thread(data.copy(), 60, combs, 'x1')
+    p_sm = _null_line_sm(data.copy(), combs['x1'], 'x1')
+
+    assert np.allclose(p_np, p_sm, rtol=1e-6, atol=1e-12)
+
+
+def test_null_line():
+    """
+    The shared-memory null_line should give the same p-values as running _null_line_thread on each label
+    """
+    rng = np.random.default_rng(7)
+    ids = [f'wt{i}' for i in range(15)] + ['mut1', 'mut2', 'mut3', 'mut4', 'mut5']
+    data = pd.DataFrame(rng.normal(10, 1, (20, 5)), index=ids, columns=[f'x{i}' for i in range(5)])
+    data['staging'] = rng.normal(100, 5, 20)
+    data['line'] = ['baseline'] * 15 + ['line1', 'line1', 'line2', 'line2', 'line2']
+    data.loc['wt4', 'x1'] = np.nan
+    data.loc['mut5', 'x3'] = np.nan
+
+    combs = generate_random_combinations(data, 60)
+    baselines = data[data.line == 'baseline']
+    result = null_line(combs, baselines, 60)
+
+    for label in data.columns[:5]:
+        expected = _null_line_thread(baselines[[label, 'staging']], 60, combs, label)
+        assert np.allclose(result[label].dropna(), expected)
+
+
+def test_two_way_null_line_matches_statsmodels():
+    """
+    The vectorised two-way null should give the same p-values as fitting each permutation with statsmodels, both
+    directly and through the shared-memory null_line
+    """
+    rng = np.random.default_rng(3)
+    ids = [f'wt{i}' for i in range(18)] + [f's{i}' for i in range(12)]
+    data = pd.DataFrame(rng.normal(10, 1, (30, 3)), index=ids, columns=['x1', 'x2', 'x3'])
+    data['staging'] = rng.normal(100, 5, 30)
+    data['line'] = ['baseline'] * 18 + ['mutants'] * 4 + ['treatment'] * 4 + ['mut_treat'] * 4
+    data.loc['wt3', 'x2'] = np.nan
+
+    combs = generate_random_two_way_combinations(data, 40)
+    baselines = data[data.line == 'baseline']
+    result = null_line(combs, baselines, 40, two_way=True)
+
+    for label in ['x1', 'x2', 'x3']:
+        info = baselines[[label, 'staging']].assign(genotype='wt', treatment='veh')
+        p_np = _two_way_null_line_thread(info.copy(), 40, combs, label)
+        p_sm = _two_way_null_line_sm(info.copy(), combs[label], label)
+
+        assert np.allclose(p_np, p_sm, rtol=1e-6, atol=1e-12)
+        assert np.allclose(np.stack(result[label]), p_np)
+
+
+def test_null_line_strided_combinations():
+    """
+    Combinations that are views of the same array but with different strides are not shared between labels
+    """
+    rng = np.random.default_rng(1)
+    data = pd.DataFrame(rng.normal(10, 1, (12, 2)), columns=['x1', 'x2'])
+    data['staging'] = rng.normal(100, 5, 12)
+    data['line'] = 'baseline'
+
+    combs = np.array([np.sort(rng.choice(12, 3, replace=False)) for _ in range(20)], dtype=np.int32)
+    wt_indx_combinations = {'x1': [combs[:10]], 'x2': [combs[::2]]}
+    result = null_line(wt_indx_combinations, data, 10)
+
+    for label in ['x1', 'x2']:
+        expected = _null_line_thread(data[[label, 'staging']], 10, wt_indx_combinations, label)
+        assert np.allclose(result[label], expected)
+
+
+def test_null_line_checkpointed(tmp_path, monkeypatch):
+    """
+    The stored null should match _null_line_thread on the same permutations. A rerun should reuse the stored blocks
+    and a rerun with more permutations should only add the extra blocks
+    """
+    monkeypatch.setattr(null_store, 'BLOCK_SIZE', 20)
+    rng = np.random.default_rng(3)
+    n = 20
+    ids = [f'wt{i}' for i in range(n)] + ['mut1', 'mut2', 'mut3', 'mut4']
+    data = pd.DataFrame({'x1': rng.normal(100, 10, len(ids)),
+                         'x2': rng.normal(50, 5, len(ids)),
+                         'x3': rng.normal(20, 3, len(ids)),
+                         'staging': rng.normal(1000, 50, len(ids)),
+                         'line': ['baseline'] * n + ['line1', 'line1', 'line2', 'line2']}, index=ids)
+    data.loc['wt3', 'x2'] = np.nan  # QC'd label
+    data.loc['mut4', 'x3'] = np.nan  # Gives line2 an n of 1 for x3
+
+    result = null_line_checkpointed(data, 50, tmp_path)
+    store_dir = next(d for d in tmp_path.iterdir())
+    blocks = sorted(store_dir.glob('*/pvals_*.npy'))
+    mtimes = [b.stat().st_mtime_ns for b in blocks]
+
+    # x3 has 20 permutations with one synthetic mutant (all there are) and the rest with two
+    baselines = data[data.line == 'baseline']
+    store = null_store.NullStore(tmp_path, baselines, ['x1', 'x2', 'x3'])
+    for label in ['x1', 'x2', 'x3']:
+        group = store.label_group[label][0]
+        rows = store.groups[group][0]
+        combs = []
+        for n_muts, num in ([(1, 20), (2, 30)] if label == 'x3' else [(2, 50)]):
+            c = np.concatenate([store._combinations(group, n_muts, b) for b in range(-(-num // 20))])[:num]
+            assert len(np.unique(c, axis=0)) == num
+            combs.append(rows[c])
+        pdist = _null_line_thread(baselines[[label, 'staging']], 50, {label: combs}, label)
+        assert np.allclose(result[label], pdist)
+
+    # Rerunning uses the stored blocks
+    pd.testing.assert_frame_equal(null_line_checkpointed(data, 50, tmp_path), result)
+    assert [b.stat().st_mtime_ns for b in blocks] == mtimes
+
+    # Topping up adds blocks and keeps the first permutations
+    more = null_line_checkpointed(data, 80, tmp_path)
+    assert len(list(store_dir.glob('*/pvals_*.npy'))) > len(blocks)
+    assert [b.stat().st_mtime_ns for b in blocks] == mtimes
+    assert np.allclose(more['x1'][:50], result['x1'])
+
+
+def test_combinations_per_n():
+    # Two lines of 2 and two of 5. There are only 28 combinations of 2 from 8 baselines, so the rest go to the 5s
+    df = combinations_per_n(pd.Series([2, 5, 2, 5, 0]), 70, 8)
+    assert df.num_combs.to_dict() == {2: 28, 5: 42}
+
+    df = combinations_per_n(pd.Series([2, 5, 2, 5]), 30, 10)
+    assert df.num_combs.to_dict() == {2: 15, 5: 15}
+
+
+def test_generate_random_combinations_shared():
+    rng = np.random.default_rng(0)
+    ids = [f'wt{i}' for i in range(12)] + ['mut1', 'mut2', 'mut3']
+    data = pd.DataFrame({'x1': rng.normal(size=15), 'x2': rng.normal(size=15), 'x3': rng.normal(size=15),
+                         'line': ['baseline'] * 12 + ['line1'] * 3}, index=ids)
+    data.loc['wt2', 'x3'] = np.nan
+
+    result = generate_random_combinations(data, 100)
+
+    # x1 and x2 have the same baselines so share their permutations
+    assert result['x1'][0] is not None and np.shares_memory(result['x1'][0], result['x2'][0])
+    assert result['x1'][0].shape == (100, 3) and result['x1'][0].dtype == np.int32
+    assert 2 not in result['x3'][0]
+    assert len(np.unique(result['x3'][0], axis=0)) == 100
+
+
+def test_specimen_null_matches_statsmodels():
+    """
+    The specimen-level null should give the same p-values as fitting each relabelled baseline with statsmodels
+    """
+    rng = np.random.default_rng(4)
+    n = 25
+    ids = [f'wt{i}' for i in range(n)]
+    baselines = pd.DataFrame({'x1': rng.normal(100, 10, n),
+                              'x2': rng.normal(50, 5, n),
+                              'staging': rng.normal(1000, 50, n),
+                              'line': 'baseline'}, index=ids)
+    baselines.loc['wt3', 'x2'] = np.nan  # QC'd label
+
+    result = null_specimen(baselines)
+
+    for i, spec in enumerate(ids):
+        for label in ['x1', 'x2']:
+            if np.isnan(baselines.loc[spec, label]):
+                assert np.isnan(result[label][i][0])
+                continue
+            info = baselines.assign(genotype='wt')
+            info.loc[spec, 'genotype'] = 'synth_hom'
+            fit = smf.ols(f'{label} ~ genotype + staging', data=info, missing='drop').fit()
+            assert np.isclose(result[label][i][0], fit.pvalues['genotype[T.wt]'], rtol=1e-6)
+
+    # The interaction test with other baselines as the extra synthetic mutant and treated specimen
+    mut = np.roll(np.arange(n), 1)
+    treat = np.roll(np.arange(n), 2)
+    mut[0] = 3  # wt3 is not in the x2 fit so wt0's interaction design is singular for x2
+    p = _interaction_p(baselines[['x1', 'x2']].values, baselines.staging.values, mut, treat)
+
+    for i, spec in enumerate(ids):
+        info = baselines.assign(genotype='wt', treatment='veh')
+        info.loc[[spec, ids[mut[i]]], 'genotype'] = 'synth_mut'
+        info.loc[[spec, ids[treat[i]]], 'treatment'] = 'synth_treat'
+        fit = smf.ols('x1 ~ genotype * treatment + staging', data=info, missing='drop').fit()
+        expected = fit.pvalues.drop(['Intercept', 'staging']).values
+        assert np.allclose(p[i, 0], expected, rtol=1e-6)
+
+    assert np.isnan(p[0, 1]).all() and np.isnan(p[3, 1]).all() and not np.isnan(p[1, 1]).any()
+
+
 if __name__ == '__main__':
-    test_generate_random_combinations()
\ No newline at end of file
+    test_generate_random_combinations()
@@ -0,0 +1,57 @@
+"""
+Test the job queue used by lama_job_runner
+
+Usage:  pytest -q test_job_queue.py
+"""
+
+import os
+
+from lama.job_queue import JobQueue
+
+
+def test_claim_finish(tmp_path):
+    queue = JobQueue.create(tmp_path / 'q', ['a', 'b'], done={1: 'complete'})
+
+    job = queue.claim()
+    assert job.job == 'a' and job.attempt == 1
+
+    # Running jobs and finished jobs can't be claimed
+    assert queue.claim() is None
+    assert not queue.finished()
+
+    queue.finish(job, 'complete')
+    assert queue.finished()
+    assert list(queue.status()['status']) == ['complete', 'complete']
+
+
+def test_failed_jobs_are_retried(tmp_path):
+    queue = JobQueue.create(tmp_path / 'q', ['a'], max_attempts=2)
+
+    job = queue.claim()
+    queue.finish(job, 'failed')
+
+    retry = queue.claim()
+    assert retry.attempt == 2
+
+    queue.finish(retry, 'failed')
+    assert queue.finished()
+    assert queue.status().at[0, 'status'] == 'failed'
+
+
+def test_dead_jobs_are_requeued(tmp_path):
+    queue = JobQueue.create(tmp_path / 'q', ['a'], lease_timeout=60)
+
+    job = queue.claim()
+    # Simulate a worker that stopped heartbeating a while ago
+    os.utime(job.claim_file, (0, 0))
+
+    retry = queue.claim()
+    assert retry.attempt == 2
+    assert queue.status().at[0, 'status'] == 'running'
+
+    # The original worker turns up again. Its result is ignored
+    queue.finish(job, 'complete')
+    assert not queue.finished()
+
+    queue.finish(retry, 'complete')
+    assert queue.finished()
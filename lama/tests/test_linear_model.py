@@ -0,0 +1,125 @@
+"""
+Test the in-process linear model runners against the statsmodels implementation
+
+Usage:  pytest -q test_linear_model.py
+"""
+
+import shutil
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from lama.stats.linear_model import lm_sm, lm_np, lm_fast, lm_r, line_and_specimen_level, MEMORY_OVERHEAD
+
+
+def _make_data(two_way=False):
+    rng = np.random.default_rng(999)
+    n = 24
+    info = pd.DataFrame({'staging': rng.normal(1000, 40, n),
+                         'genotype': ['wt'] * 16 + ['hom'] * 8},
+                        index=[f'spec_{i}' for i in range(n)])
+    if two_way:
+        info['treatment'] = ['veh', 'treat'] * 12
+
+    data = rng.normal(10, 2, (n, 10))
+    return data, info
+
+
+def test_lm_np_matches_lm_sm():
+    data, info = _make_data()
+    # QC'd labels
+    data[[3, 5], 2] = np.nan
+    data[3, 7] = np.nan
+    # Label with all mutants QC'd out
+    data[:, 4] = 0
+
+    p_sm, t_sm = lm_sm(data, info)
+    p_np, t_np = lm_np(data, info)
+
+    assert p_np.shape == p_sm.shape
+    assert t_np.shape == t_sm.shape
+    assert np.allclose(p_np, p_sm, equal_nan=True)
+    assert np.allclose(t_np, t_sm, equal_nan=True)
+
+
+def test_lm_np_matches_lm_sm_two_way():
+    data, info = _make_data(two_way=True)
+
+    p_sm, t_sm = lm_sm(data, info, two_way=True)
+    p_np, t_np = lm_np(data, info, two_way=True)
+
+    assert p_np.shape == (data.shape[1], 3)
+    assert np.allclose(p_np, p_sm.astype(float))
+    assert np.allclose(t_np, t_sm.astype(float))
+
+
+def _standard_stats_info(info: pd.DataFrame) -> pd.DataFrame:
+    # The standard stats pipeline labels specimens as wildtype/mutant
+    info = info.copy()
+    info['genotype'] = info.genotype.map({'wt': 'wildtype', 'hom': 'mutant'})
+    return info
+
+
+def test_lm_fast_layout():
+    """
+    lm_fast should return the line-level results followed by the specimen-level results of each mutant, as lm_r does
+    """
+    data, info = _make_data()
+    info = _standard_stats_info(info)
+    n_labels = data.shape[1]
+    mutant_rows = np.flatnonzero(info.genotype == 'mutant')
+    wt_rows = np.flatnonzero(info.genotype == 'wildtype')
+
+    p, t = lm_fast(data, info)
+    assert p.shape == t.shape == (n_labels * (len(mutant_rows) + 1),)
+
+    p_line, t_line = lm_sm(data, info.replace({'wildtype': 'wt'}))
+    assert np.allclose(p[:n_labels], p_line.ravel(), rtol=1e-4)
+    assert np.allclose(t[:n_labels], t_line, rtol=1e-4)
+
+    # Last specimen-level result
+    rows = np.append(wt_rows, mutant_rows[-1])
+    p_spec, t_spec = lm_sm(data[rows], info.iloc[rows].replace({'wildtype': 'wt'}))
+    assert np.allclose(p[-n_labels:], p_spec.ravel(), rtol=1e-4)
+    assert np.allclose(t[-n_labels:], t_spec, rtol=1e-4)
+
+
+@pytest.mark.skipif(shutil.which('Rscript') is None, reason='R is not installed')
+def test_lm_fast_matches_lm_r():
+    for two_way in [False, True]:
+        data, info = _make_data(two_way=two_way)
+        info = _standard_stats_info(info)
+        if two_way:
+            info['treatment'] = info.treatment.map({'veh': 'vehicle', 'treat': 'treatment'})
+
+        p_r, t_r = lm_r(data, info, two_way=two_way)
+        p_np, t_np = lm_fast(data, info, two_way=two_way)
+
+        assert np.allclose(p_np, p_r, rtol=1e-4)
+        assert np.allclose(t_np, t_r, rtol=1e-4)
+
+
+@pytest.mark.parametrize('runner', ['lm_np', 'lm_fast'])
+def test_memory_overhead(runner):
+    """
+    The peak memory of the runner should be within its MEMORY_OVERHEAD, which is used to plan the stats chunks
+    """
+    rng = np.random.default_rng(5)
+    n = 40
+    info = pd.DataFrame({'staging': rng.normal(1000, 40, n),
+                         'genotype': ['wildtype'] * 32 + ['mutant'] * 8},
+                        index=[f'spec_{i}' for i in range(n)])
+    data = rng.normal(10, 2, (n, 20000)).astype(np.float32)
+    data[3, ::5] = np.nan
+
+    tracemalloc.start()
+    if runner == 'lm_np':
+        line_and_specimen_level(lm_np, data, info)
+    else:
+        lm_fast(data, info)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+
+    assert peak <= MEMORY_OVERHEAD[runner] * data.shape[0] * data.shape[1] * 8
@@ -0,0 +1,42 @@
+"""
+Test the organ volumes counted with np.bincount against SimpleITK's LabelStatisticsImageFilter
+
+Usage:  pytest -q test_organ_vol_calculation.py
+"""
+
+import numpy as np
+import pandas as pd
+import SimpleITK as sitk
+
+from lama.img_processing.organ_vol_calculation import label_sizes
+
+
+def test_label_sizes(tmp_path):
+    rng = np.random.default_rng(1)
+
+    expected = {}
+    for i, max_label in enumerate([10, 12, 7]):
+        spec_dir = tmp_path / 'labels' / f'spec{i}'
+        spec_dir.mkdir(parents=True)
+        arr = rng.integers(0, max_label + 1, (20, 30, 40)).astype(np.uint8)
+        arr[arr == 3] = 0  # A label missing from all the specimens
+        labelmap = sitk.GetImageFromArray(arr)
+        sitk.WriteImage(labelmap, str(spec_dir / f'spec{i}.nrrd'))
+
+        lsf = sitk.LabelStatisticsImageFilter()
+        lsf.Execute(labelmap, labelmap)
+        expected[f'spec{i}'] = {label: lsf.GetCount(label) if lsf.HasLabel(label) else 0
+                                for label in range(1, max_label + 1)}
+
+    expected = pd.DataFrame(expected).T
+    labelled = expected.sum(axis=1)
+
+    label_sizes(tmp_path / 'labels', tmp_path / 'organ_vols.csv', threads=2)
+    result = pd.read_csv(tmp_path / 'organ_vols.csv', index_col=0)
+    result.columns = result.columns.astype(int)
+    pd.testing.assert_frame_equal(result, expected, check_dtype=False)
+
+    label_sizes(tmp_path / 'labels', tmp_path / 'normalised.csv', normalise_to_labels=True)
+    result = pd.read_csv(tmp_path / 'normalised.csv', index_col=0)
+    result.columns = result.columns.astype(int)
+    pd.testing.assert_frame_equal(result, expected.divide(labelled, axis=0), check_dtype=False)
@@ -0,0 +1,71 @@
+"""
+Test the p-value thresholds found from cumulative counts against testing each candidate threshold with fdr_calc
+
+Usage:  pytest -q test_p_thresholds.py
+"""
+
+import numpy as np
+import pandas as pd
+
+from lama.stats.permutation_stats.p_thresholds import get_thresholds, fdr_calc
+
+
+def _expected(null, alt, target=0.05):
+    """
+    The threshold for one label by trying every null and alternative p-value <= 0.05
+    """
+    candidates = sorted(x for x in np.concatenate([null, alt]) if x <= 0.05)
+    p_fdr = [(p, fdr_calc(null, alt, p)) for p in candidates]
+    p_fdr = [(p, fdr) for p, fdr in p_fdr if fdr is not None]
+
+    if not p_fdr:
+        return np.nan, 1
+
+    under = [(p, fdr) for p, fdr in p_fdr if fdr <= target]
+    if under:
+        return max(under, key=lambda x: x[0])
+    return min(p_fdr, key=lambda x: x[1])
+
+
+def test_thresholds():
+    rng = np.random.default_rng(0)
+    labels = [str(i) for i in range(1, 9)]
+
+    # Rounding gives tied p-values
+    null = pd.DataFrame(np.round(rng.random((500, 8)) ** 2, 3), columns=labels)
+    alt = pd.DataFrame(np.round(rng.random((12, 8)) ** 6, 3), columns=labels)
+    null.iloc[::7, 2] = np.nan
+    alt.iloc[:, 0] = 0.9  # No candidate thresholds
+    null.iloc[:, 1] = 0.001  # No threshold with an FDR under the target
+
+    result = get_thresholds(null, alt)
+
+    for label in labels:
+        p_thresh, fdr = _expected(null[label].values, alt[label].values)
+        row = result.loc[int(label)]
+        if np.isnan(p_thresh):
+            assert np.isnan(row.p_thresh) and row.fdr == 1 and row.num_null == 'NA'
+            continue
+        assert row.p_thresh == p_thresh and row.fdr == fdr
+        assert row.num_null_lt_thresh == np.sum(null[label].values <= p_thresh)
+        assert row.num_alt_lt_thresh == np.sum(alt[label].values <= p_thresh)
+
+
+def test_two_way_thresholds():
+    rng = np.random.default_rng(1)
+    labels = [str(i) for i in range(1, 6)]
+
+    # Each entry has the genotype, treatment and interaction p-values
+    null = pd.DataFrame({l: list(np.round(rng.random((300, 3)) ** 2, 3)) for l in labels})
+    alt = pd.DataFrame({l: list(np.round(rng.random((10, 3)) ** 6, 3)) for l in labels})
+
+    result = get_thresholds(null, alt, two_way=True)
+    assert len(result) == len(labels) * 3
+
+    for label in labels:
+        wt = np.vstack(null[label].values)
+        mut = np.vstack(alt[label].values)
+        for i, effect in enumerate(['genotype', 'treatment', 'interaction']):
+            row = result[(result.index == int(label)) & (result.effect == effect)].iloc[0]
+            p_thresh, fdr = _expected(wt[:, i], mut[:, i])
+            assert np.isclose(row.p_thresh, p_thresh, equal_nan=True) and row.fdr == fdr
@@ -0,0 +1,52 @@
+"""
+Test the pairwise registration scheduler with stand-in registration and mean transform functions
+
+Usage:  pytest -q test_pairwise_scheduler.py
+"""
+
+import os
+import threading
+
+import pytest
+
+from lama.elastix.pairwise_scheduler import PairwiseScheduler
+
+
+def test_pairwise_scheduler_ids_with_underscores(tmp_path):
+    # a_b_c could be the pair (a_b, c) or (a, b_c) if the claims were named member_group
+    ids = ['a', 'a_b', 'b_c', 'c']
+    registered = []
+    means = []
+    lock = threading.Lock()
+
+    def register(member, group):
+        with lock:
+            registered.append((member, group))
+
+    scheduler = PairwiseScheduler(ids, n_procs=3, status_dir=tmp_path / 'status', fail_fast=True)
+    assert scheduler.run(register, means.append) == []
+
+    assert sorted(registered) == sorted((m, g) for g in ids for m in ids if m != g)
+    assert sorted(means) == sorted(ids)
+    assert len(os.listdir(tmp_path / 'status' / 'finished')) == 12
+
+    # A second worker on the same status folder finds everything done
+    registered.clear()
+    PairwiseScheduler(ids, status_dir=tmp_path / 'status').run(register, means.append)
+    assert registered == []
+
+
+def test_pairwise_scheduler_failures(tmp_path):
+    ids = ['a', 'b', 'c']
+
+    def register(member, group):
+        if (member, group) == ('a', 'b'):
+            raise RuntimeError('elastix failed')
+
+    means = []
+    scheduler = PairwiseScheduler(ids, status_dir=tmp_path / 'status', fail_fast=False)
+    assert scheduler.run(register, means.append) == ['a_b']
+    assert sorted(means) == ['a', 'c']  # No mean transform for b
+
+    with pytest.raises(RuntimeError):
+        PairwiseScheduler(ids, status_dir=tmp_path / 'status2').run(register, means.append)
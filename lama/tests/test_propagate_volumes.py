@@ -0,0 +1,151 @@
+"""
+Test the native label propagation, which resamples against a cached displacement field of the chained transforms,
+against resampling with the equivalent ITK composite transform
+
+Usage:  pytest -q test_propagate_volumes.py
+"""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+import yaml
+
+from lama.elastix import PROPAGATE_CONFIG, PROPAGATE_LABEL_TRANFORM
+from lama.elastix.propagate_volumes import PropagateLabelMap, PropagateHeatmap, FIELD_CACHE_DIR
+
+SIZE = (30, 25, 20)
+SPACING = (14.0, 14.0, 14.0)
+ORIGIN = (5.0, -10.0, 0.0)
+GRID_SIZE = (9, 8, 7)
+GRID_SPACING = (75.0, 75.0, 75.0)
+GRID_ORIGIN = (-100.0, -100.0, -100.0)
+SPECIMEN = 'spec1'
+
+
+def _write_tform(path, transform_type, params, extra=''):
+    path.parent.mkdir(parents=True)
+    with open(path, 'w') as fh:
+        fh.write(f'(Transform "{transform_type}")\n'
+                 f'(NumberOfParameters {len(params)})\n'
+                 f'(TransformParameters {" ".join(f"{p:.10f}" for p in params)})\n'
+                 '(InitialTransformParametersFileName "NoInitialTransform")\n'
+                 '(HowToCombineTransforms "Compose")\n'
+                 '(FixedImageDimension 3)\n'
+                 '(Size {} {} {})\n(Index 0 0 0)\n'.format(*SIZE) +
+                 '(Spacing {} {} {})\n'.format(*SPACING) +
+                 '(Origin {} {} {})\n'.format(*ORIGIN) +
+                 '(Direction 1 0 0 0 1 0 0 0 1)\n(FinalBSplineInterpolationOrder 3)\n' + extra)
+
+
+def _setup(tmp_path):
+    """
+    An affine and a B-spline propagation stage for one specimen, and the equivalent ITK transform
+    """
+    rng = np.random.default_rng(5)
+    root = tmp_path / 'inverted_transforms'
+
+    matrix = np.eye(3) + rng.normal(0, 0.05, (3, 3))
+    translation = rng.normal(0, 5, 3)
+    center = np.array([200.0, 150.0, 120.0])
+    _write_tform(root / 'affine' / SPECIMEN / PROPAGATE_LABEL_TRANFORM, 'AffineTransform',
+                 list(matrix.ravel()) + list(translation),
+                 extra='(CenterOfRotationPoint {} {} {})\n'.format(*center))
+
+    coefs = rng.normal(0, 8, np.prod(GRID_SIZE) * 3)
+    _write_tform(root / 'deformable' / SPECIMEN / PROPAGATE_LABEL_TRANFORM, 'BSplineTransform', coefs,
+                 extra='(GridSize {} {} {})\n(GridIndex 0 0 0)\n'.format(*GRID_SIZE) +
+                       '(GridSpacing {} {} {})\n'.format(*GRID_SPACING) +
+                       '(GridOrigin {} {} {})\n'.format(*GRID_ORIGIN) +
+                       '(GridDirection 1 0 0 0 1 0 0 0 1)\n(BSplineTransformSplineOrder 3)\n')
+
+    config = root / PROPAGATE_CONFIG
+    with open(config, 'w') as fh:
+        yaml.dump({'label_propagation_order': ['affine', 'deformable']}, fh)
+
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix(matrix.ravel().tolist())
+    affine.SetTranslation(translation.tolist())
+    affine.SetCenter(center.tolist())
+
+    bspline = sitk.BSplineTransform(3, 3)
+    bspline.SetFixedParameters(list(GRID_SIZE) + list(GRID_ORIGIN) + list(GRID_SPACING) + [1, 0, 0, 0, 1, 0, 0, 0, 1])
+    bspline.SetParameters(coefs.tolist())
+
+    # The first stage's transform is applied last. ITK applies the last transform added first
+    return config, sitk.CompositeTransform([affine, bspline])
+
+
+def _expected(img, itk_transform, interpolator):
+    reference = sitk.Image(SIZE, img.GetPixelID())
+    reference.SetSpacing(SPACING)
+    reference.SetOrigin(ORIGIN)
+    return sitk.GetArrayFromImage(sitk.Resample(img, reference, itk_transform, interpolator, 0, img.GetPixelID()))
+
+
+def test_propagate_labels(tmp_path):
+    config, itk_transform = _setup(tmp_path)
+
+    # Label map and mask in the moving image space
+    rng = np.random.default_rng(0)
+    labels = sitk.GetImageFromArray(rng.integers(0, 300, (20, 25, 30)).astype(np.uint16))
+    labels.SetSpacing(SPACING)
+    mask = sitk.GetImageFromArray((rng.random((20, 25, 30)) > 0.5).astype(np.uint8))
+    mask.SetSpacing(SPACING)
+    sitk.WriteImage(labels, str(tmp_path / 'labels.nrrd'))
+    sitk.WriteImage(mask, str(tmp_path / 'mask.nrrd'))
+
+    outdir = tmp_path / 'inverted_labels'
+    outdir.mkdir()
+    PropagateLabelMap(config, [tmp_path / 'labels.nrrd', tmp_path / 'mask.nrrd'], outdir).run()
+
+    # The field is cached for the next propagation of this specimen
+    assert len(list((config.parent / FIELD_CACHE_DIR).glob(f'{SPECIMEN}_*.nrrd'))) == 1
+
+    for name, img in [('labels', labels), ('mask', mask)]:
+        result = sitk.ReadImage(str(outdir / SPECIMEN / f'{name}.nrrd'))
+        assert result.GetPixelID() == img.GetPixelID()
+        expected = _expected(img, itk_transform, sitk.sitkNearestNeighbor)
+        # Allow for points that lie almost exactly between two voxels
+        assert np.mean(sitk.GetArrayFromImage(result) != expected) < 1e-3
+
+
+def test_propagate_heatmap(tmp_path):
+    config, itk_transform = _setup(tmp_path)
+
+    z, y, x = np.mgrid[0:20, 0:25, 0:30]
+    heatmap = sitk.GetImageFromArray(np.sin(x / 4.0) * np.cos(y / 5.0) + z / 10.0)
+    heatmap.SetSpacing(SPACING)
+    sitk.WriteImage(heatmap, str(tmp_path / 'heatmap.nrrd'))
+
+    outdir = tmp_path / 'inverted_heatmaps'
+    outdir.mkdir()
+    PropagateHeatmap(config, tmp_path / 'heatmap.nrrd', outdir).run()
+
+    result = sitk.GetArrayFromImage(sitk.ReadImage(str(outdir / SPECIMEN / f'{SPECIMEN}.nrrd')))
+    assert np.allclose(result, _expected(heatmap, itk_transform, sitk.sitkBSpline), atol=1e-4)
+
+
+def test_propagate_fallback(tmp_path, monkeypatch):
+    """
+    Only transforms that can't be evaluated natively fall back to transformix. Other errors are raised
+    """
+    config, _ = _setup(tmp_path)
+    tform = config.parent / 'deformable' / SPECIMEN / PROPAGATE_LABEL_TRANFORM
+    tform.write_text(tform.read_text().replace('BSplineTransform', 'SplineKernelTransform'))
+
+    labels = sitk.GetImageFromArray(np.zeros((20, 25, 30), dtype=np.uint16))
+    sitk.WriteImage(labels, str(tmp_path / 'labels.nrrd'))
+    outdir = tmp_path / 'inverted_labels'
+    outdir.mkdir()
+
+    fallbacks = []
+    monkeypatch.setattr(PropagateLabelMap, '_propagate_transformix', lambda self, *args: fallbacks.append(args))
+    PropagateLabelMap(config, tmp_path / 'labels.nrrd', outdir).run()
+    assert len(fallbacks) == 1
+
+    def not_implemented(self, *args):
+        raise NotImplementedError
+
+    monkeypatch.setattr(PropagateLabelMap, '_propagate_native', not_implemented)
+    with pytest.raises(NotImplementedError):
+        PropagateLabelMap(config, tmp_path / 'labels.nrrd', outdir).run()
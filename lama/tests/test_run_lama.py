@@ -0,0 +1,123 @@
+"""
+Test that run_registration_schedule runs each stage, and with checkpoints skips stages that are already done
+
+Usage:  pytest -q test_run_lama.py
+"""
+
+from pathlib import Path
+
+import pytest
+
+from lama.checkpoints import Checkpoints
+from lama.registration_pipeline import run_lama
+
+STAGES = [{'stage_id': 'rigid', 'elastix_parameters': {'Transform': 'EulerTransform'}},
+          {'stage_id': 'affine', 'elastix_parameters': {'Transform': 'AffineTransform'}}]
+
+
+class _Config(dict):
+    stage_dirs = {}
+
+
+class _FakeRegistration:
+    """
+    Stands in for TargetBasedRegistration. Copies each moving image to the stage folder
+    """
+    runs = []
+    failed = []  # Names of the specimens to fail
+
+    def __init__(self, elxparam_path, movdir, stagedir, filetype, threads, fixed_mask):
+        self.movdir = Path(movdir)
+        self.stagedir = Path(stagedir)
+        self.checkpoints = None
+        self.specimen_parts = {}
+
+    def set_target(self, target):
+        pass
+
+    def run(self):
+        _FakeRegistration.runs.append(self.stagedir.name)
+        failed = []
+        for img in sorted(self.movdir.rglob('*.nrrd')):
+            if img.stem in _FakeRegistration.failed:
+                failed.append(img)
+                continue
+            out_dir = self.stagedir / img.stem
+            out_dir.mkdir(exist_ok=True)
+            (out_dir / img.name).write_bytes(img.read_bytes())
+        return failed
+
+
+@pytest.fixture
+def config(tmp_path, monkeypatch):
+    monkeypatch.setattr(run_lama, 'TargetBasedRegistration', _FakeRegistration)
+    monkeypatch.setattr(run_lama, 'generate_elx_parameters',
+                        lambda config, do_pairwise: {s['stage_id']: f'(Transform "{s["stage_id"]}")' for s in STAGES})
+    _FakeRegistration.runs = []
+    _FakeRegistration.failed = []
+
+    inputs = tmp_path / 'inputs'
+    inputs.mkdir()
+    for name in ['spec1', 'spec2']:
+        (inputs / f'{name}.nrrd').write_bytes(name.encode())
+    (tmp_path / 'target.nrrd').write_bytes(b'target')
+
+    config = _Config(stage_targets=None, no_qc=True, pairwise_registration=False,
+                     generate_new_target_each_stage=False, inputs=inputs, fixed_volume=tmp_path / 'target.nrrd',
+                     registration_stage_params=STAGES, fixed_mask=None, fix_folding=False, filetype='nrrd',
+                     threads=1, parallel_registrations=1, registration_fail_fast=True)
+    config.stage_dirs = {s['stage_id']: str(tmp_path / 'registrations' / s['stage_id']) for s in STAGES}
+    return config
+
+
+def test_registration_schedule(config):
+    final_dir = run_lama.run_registration_schedule(config)
+    assert final_dir == config.stage_dirs['affine']
+    assert _FakeRegistration.runs == ['rigid', 'affine']
+    assert (Path(final_dir) / 'spec1' / 'spec1.nrrd').is_file()
+
+    # Without checkpoints the stages are always rerun
+    run_lama.run_registration_schedule(config)
+    assert _FakeRegistration.runs == ['rigid', 'affine'] * 2
+
+
+def test_registration_schedule_checkpoints(config, tmp_path, monkeypatch):
+    checkpoint_dir = tmp_path / 'checkpoints'
+    final_dir = run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert final_dir == config.stage_dirs['affine']
+    assert _FakeRegistration.runs == ['rigid', 'affine']
+
+    # A rerun with the same inputs skips both stages
+    run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert _FakeRegistration.runs == ['rigid', 'affine']
+
+    # A changed input redoes the stages
+    (Path(config['inputs']) / 'spec2.nrrd').write_bytes(b'changed')
+    run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert _FakeRegistration.runs == ['rigid', 'affine'] * 2
+
+    # Checkpoints that are disabled never skip, and the inputs are not hashed
+    disabled = Checkpoints(checkpoint_dir, enabled=False)
+    monkeypatch.setattr(disabled, 'file_hash', lambda path: pytest.fail('inputs hashed with resume off'))
+    run_lama.run_registration_schedule(config, checkpoints=disabled)
+    assert _FakeRegistration.runs == ['rigid', 'affine'] * 3
+
+
+def test_registration_schedule_failures_not_done(config, tmp_path):
+    """
+    A stage with failed registrations is not marked done, so a resumed run retries it
+    """
+    checkpoint_dir = tmp_path / 'checkpoints'
+    config['registration_fail_fast'] = False
+    _FakeRegistration.failed = ['spec2']
+    run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert _FakeRegistration.runs == ['rigid', 'affine']
+
+    _FakeRegistration.failed = []
+    final_dir = run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert _FakeRegistration.runs == ['rigid', 'affine'] * 2
+    assert (Path(final_dir) / 'spec2' / 'spec2.nrrd').is_file()
+
+    # Now all done
+    run_lama.run_registration_schedule(config, checkpoints=Checkpoints(checkpoint_dir))
+    assert _FakeRegistration.runs == ['rigid', 'affine'] * 2
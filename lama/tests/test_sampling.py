@@ -0,0 +1,88 @@
+"""
+Test the random combination sampler used for the line-level null distributions
+
+Usage:  pytest -q test_sampling.py
+"""
+
+from itertools import combinations
+
+import numpy as np
+import pytest
+from scipy import stats
+
+from lama.stats.permutation_stats import sampling
+from lama.stats.permutation_stats.sampling import random_combinations, random_partitions
+
+
+@pytest.mark.parametrize('num_items, n, num_combs', [(8, 3, 50), (40, 4, 2000)])  # Enumerated and rejection sampling
+def test_random_combinations(num_items, n, num_combs):
+    rng = np.random.default_rng(0)
+    first = random_combinations(num_items, n, num_combs, rng)
+    assert first.shape == (num_combs, n) and first.dtype == np.int32
+    assert np.all(np.diff(first, axis=1) > 0)
+    assert len(np.unique(first, axis=0)) == num_combs
+
+    # A second block does not repeat the first
+    second = random_combinations(num_items, n, 5, rng, exclude=first)
+    assert len(np.unique(np.vstack([first, second]), axis=0)) == num_combs + 5
+
+    with pytest.raises(ValueError):
+        random_combinations(5, 2, 11, rng)
+
+
+@pytest.mark.parametrize('num_combs', [1, 20])
+def test_random_combinations_uniform(num_combs):
+    """
+    Each of the 28 combinations of 2 from 8 should be drawn equally often
+    """
+    rng = np.random.default_rng(1)
+    all_combs = {c: i for i, c in enumerate(combinations(range(8), 2))}
+    counts = np.zeros(len(all_combs))
+    for _ in range(3000):
+        for c in random_combinations(8, 2, num_combs, rng):
+            counts[all_combs[tuple(c)]] += 1
+
+    assert stats.chisquare(counts).pvalue > 0.001
+
+
+def test_random_partitions(monkeypatch):
+    p = random_partitions(13, 3, 4, 100, np.random.default_rng(2))
+    assert p.shape == (100, 3, 4)
+    assert all(len(np.unique(x)) == 12 for x in p)
+    assert len(np.unique(p.reshape(100, -1), axis=0)) == 100
+
+    # All the partitions can be drawn. The order of the groups matters, so there are 15 * 6 * 1 of 6 into three pairs.
+    # When most of them are needed they are enumerated rather than rejection sampled
+    monkeypatch.setattr(sampling, '_draw_unique', None)
+    p = random_partitions(6, 3, 2, 90, np.random.default_rng(3))
+    assert len(np.unique(p.reshape(90, -1), axis=0)) == 90
+
+    # With items left over: 21 * 10 partitions of 7 into two pairs
+    p = random_partitions(7, 2, 2, 100, np.random.default_rng(3))
+    assert p.shape == (100, 2, 2)
+    assert all(len(np.unique(x)) == 4 for x in p)
+    assert np.all(np.diff(p, axis=2) > 0)
+    assert len(np.unique(p.reshape(100, -1), axis=0)) == 100
+
+    with pytest.raises(ValueError):
+        random_partitions(6, 3, 2, 91, np.random.default_rng(3))
+
+
+def test_rejection_batch_size(monkeypatch):
+    """
+    Each round of rejection sampling draws at most MAX_BATCH_ELEMENTS random values
+    """
+    monkeypatch.setattr(sampling, 'MAX_BATCH_ELEMENTS', 400)
+    sizes = []
+
+    class Rng:
+        def __init__(self):
+            self.rng = np.random.default_rng(4)
+
+        def random(self, size):
+            sizes.append(size)
+            return self.rng.random(size)
+
+    combs = random_combinations(40, 4, 2000, Rng())
+    assert len(np.unique(combs, axis=0)) == 2000
+    assert max(np.prod(s) for s in sizes) <= 400
@@ -0,0 +1,113 @@
+"""
+Test the spatial jacobians computed from elastix transform parameter files against ITK's B-spline and affine transforms
+
+Usage:  pytest -q test_spatial_jacobian.py
+"""
+
+import numpy as np
+import pytest
+import SimpleITK as sitk
+
+from lama.elastix.spatial_jacobian import spatial_jacobian, UnsupportedTransformError
+
+SIZE = (30, 25, 20)
+SPACING = (14.0, 14.0, 14.0)
+ORIGIN = (5.0, -10.0, 0.0)
+GRID_SIZE = (9, 8, 7)
+GRID_SPACING = (75.0, 75.0, 75.0)
+GRID_ORIGIN = (-100.0, -100.0, -100.0)
+
+
+def _write_tform(path, transform_type, params, initial='NoInitialTransform', extra=''):
+    with open(path, 'w') as fh:
+        fh.write(f'(Transform "{transform_type}")\n'
+                 f'(NumberOfParameters {len(params)})\n'
+                 f'(TransformParameters {" ".join(f"{p:.10f}" for p in params)})\n'
+                 f'(InitialTransformParametersFileName "{initial}")\n'
+                 '(HowToCombineTransforms "Compose")\n'
+                 '(FixedImageDimension 3)\n'
+                 '(Size {} {} {})\n(Index 0 0 0)\n'.format(*SIZE) +
+                 '(Spacing {} {} {})\n'.format(*SPACING) +
+                 '(Origin {} {} {})\n'.format(*ORIGIN) +
+                 '(Direction 1 0 0 0 1 0 0 0 1)\n' + extra)
+
+
+def _itk_transforms(tmp_path):
+    rng = np.random.default_rng(3)
+
+    matrix = np.eye(3) + rng.normal(0, 0.05, (3, 3))
+    translation = rng.normal(0, 5, 3)
+    center = np.array([200.0, 150.0, 120.0])
+    _write_tform(tmp_path / 'affine.txt', 'AffineTransform', list(matrix.ravel()) + list(translation),
+                 extra='(CenterOfRotationPoint {} {} {})\n'.format(*center))
+
+    coefs = rng.normal(0, 8, np.prod(GRID_SIZE) * 3)
+    _write_tform(tmp_path / 'bspline.txt', 'BSplineTransform', coefs, initial=str(tmp_path / 'affine.txt'),
+                 extra='(GridSize {} {} {})\n(GridIndex 0 0 0)\n'.format(*GRID_SIZE) +
+                       '(GridSpacing {} {} {})\n'.format(*GRID_SPACING) +
+                       '(GridOrigin {} {} {})\n'.format(*GRID_ORIGIN) +
+                       '(GridDirection 1 0 0 0 1 0 0 0 1)\n(BSplineTransformSplineOrder 3)\n')
+
+    affine = sitk.AffineTransform(3)
+    affine.SetMatrix(matrix.ravel().tolist())
+    affine.SetTranslation(translation.tolist())
+    affine.SetCenter(center.tolist())
+
+    bspline = sitk.BSplineTransform(3, 3)
+    bspline.SetFixedParameters(list(GRID_SIZE) + list(GRID_ORIGIN) + list(GRID_SPACING) + [1, 0, 0, 0, 1, 0, 0, 0, 1])
+    bspline.SetParameters(coefs.tolist())
+
+    return bspline, affine
+
+
+def test_bspline_jacobian(tmp_path):
+    bspline, _ = _itk_transforms(tmp_path)
+
+    # Without the initial transform the separable on-grid evaluation is used
+    with open(tmp_path / 'bspline.txt', 'r') as fh:
+        lines = [l for l in fh if not l.startswith('(InitialTransformParametersFileName')]
+    with open(tmp_path / 'bspline_only.txt', 'w') as fh:
+        fh.writelines(lines)
+
+    _check(spatial_jacobian(tmp_path / 'bspline_only.txt', jacmat=True, deformation=True, slab_voxels=2000), bspline)
+
+
+def test_composed_jacobian(tmp_path):
+    bspline, affine = _itk_transforms(tmp_path)
+
+    # ITK applies the last transform added first
+    composite = sitk.CompositeTransform([bspline, affine])
+
+    _check(spatial_jacobian(tmp_path / 'bspline.txt', jacmat=True, deformation=True), composite)
+
+
+def test_unsupported_transform(tmp_path):
+    _write_tform(tmp_path / 'spline.txt', 'SplineKernelTransform', [0.0] * 6)
+
+    with pytest.raises(UnsupportedTransformError):
+        spatial_jacobian(tmp_path / 'spline.txt')
+
+
+def _check(result, itk_transform):
+    def_field = sitk.TransformToDisplacementField(itk_transform, sitk.sitkVectorFloat64, SIZE, ORIGIN, SPACING)
+    assert np.allclose(result.deformation, sitk.GetArrayFromImage(def_field), atol=1e-4)
+
+    # Jacobian matrices by central differences of the ITK transform at some of the voxels
+    rng = np.random.default_rng(0)
+    eps = 1e-3
+    for _ in range(50):
+        idx = [int(rng.integers(0, s)) for s in SIZE]
+        point = np.array(ORIGIN) + np.array(idx) * np.array(SPACING)
+
+        expected = np.zeros((3, 3))
+        for axis in range(3):
+            step = np.zeros(3)
+            step[axis] = eps
+            expected[:, axis] = (np.array(itk_transform.TransformPoint(tuple(point + step))) -
+                                 np.array(itk_transform.TransformPoint(tuple(point - step)))) / (2 * eps)
+
+        x, y, z = idx
+        assert np.allclose(result.jacmat[z, y, x].reshape(3, 3), expected, atol=1e-4)
+        assert np.isclose(result.det[z, y, x], np.linalg.det(expected), atol=1e-4)
+
+    assert np.allclose(result.log_det, np.log(result.det))
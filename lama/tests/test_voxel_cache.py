@@ -0,0 +1,93 @@
+"""
+Test the on-disk voxel cache used by the voxel-based stats
+
+Usage:  pytest -q test_voxel_cache.py
+"""
+
+from concurrent.futures import ThreadPoolExecutor
+import os
+
+import numpy as np
+import pytest
+
+from lama.stats.standard_stats.voxel_cache import VoxelCache
+
+
+def _inputs(tmp_path, num):
+    paths = []
+    for i in range(num):
+        path = tmp_path / f'spec{i}.nrrd'
+        path.write_bytes(str(i).encode())
+        paths.append(path)
+    return paths
+
+
+def test_voxel_cache_threads(tmp_path):
+    cache = VoxelCache(tmp_path / 'cache', np.ones((4, 4, 4)), 100, 14.0)
+    paths = _inputs(tmp_path, 20)
+    data = np.arange(64, dtype=np.float32)
+
+    def get_put(path):
+        if cache.get(path) is None:
+            cache.put(path, data)
+        return cache.get(path)
+
+    with ThreadPoolExecutor(8) as pool:
+        results = list(pool.map(get_put, paths * 5))
+
+    assert all(np.array_equal(r, data) for r in results)
+    # Each call does two gets. Threads may miss the same input before it is put
+    assert cache.hits + cache.misses == 2 * 20 * 5
+    assert cache.misses >= 20
+    assert cache._size_bytes == sum(f.stat().st_size for f in (tmp_path / 'cache').glob('*.npy'))
+
+
+def test_voxel_cache_evict_missing_entries(tmp_path, monkeypatch):
+    cache = VoxelCache(tmp_path / 'cache', np.ones((4, 4, 4)), 100, 14.0, max_size_gb=1)
+    paths = _inputs(tmp_path, 4)
+    for path in paths:
+        cache.put(path, np.zeros(64))
+    entry_size = cache._size_bytes // 4
+
+    # An entry removed by another process between the listing and the stat is skipped
+    removed = cache._entry(paths[0])
+    real_glob = type(cache.cache_dir).glob
+
+    def glob(self, pattern):
+        entries = list(real_glob(self, pattern))
+        removed.unlink(missing_ok=True)
+        return entries
+
+    monkeypatch.setattr(type(cache.cache_dir), 'glob', glob)
+    cache.max_size_bytes = entry_size * 2
+    cache._evict()
+
+    remaining = list(real_glob(cache.cache_dir, '*.npy'))
+    assert cache._size_bytes == entry_size * len(remaining)
+    assert cache._size_bytes <= cache.max_size_bytes * 0.9
+
+
+def test_voxel_cache_overwrite_and_tmp(tmp_path):
+    cache_dir = tmp_path / 'cache'
+    cache_dir.mkdir()
+    stale = cache_dir / 'stale.tmp'
+    stale.write_bytes(b'partial')
+    os.utime(stale, (0, 0))
+    recent = cache_dir / 'recent.tmp'  # May still be being written by another process
+    recent.write_bytes(b'partial')
+
+    cache = VoxelCache(cache_dir, np.ones((4, 4, 4)), 100, 14.0)
+    assert not stale.exists()
+    assert recent.exists()
+    recent.unlink()
+
+    # Replacing an entry does not add to the size
+    path = _inputs(tmp_path, 1)[0]
+    cache.put(path, np.zeros(64))
+    cache.put(path, np.ones(64))
+    assert cache._size_bytes == cache._entry(path).stat().st_size
+
+    # A put that fails does not leave its temp file
+    with pytest.raises(ValueError):
+        cache.put(path, np.array(['x'] * 64))
+    assert not list(cache_dir.glob('*.tmp'))